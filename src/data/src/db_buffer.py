@@ -0,0 +1,275 @@
+'''
+Sensors write-behind buffer, batched inserts shared by db_server, db_sensors
+
+requirements:
+- starlette
+- db_pool, db_schema
+
+Rows are queued in memory and written by one `executemany` transaction when
+`batch_rows` are pending or every `flush_seconds`. `put` waits while
+`max_rows` are pending (backpressure) and returns a future resolved with its
+committed rows.
+
+Failed flushes put their rows back at the front of the queue and are retried
+with an exponential backoff, up to `max_retries` times. Permanent errors
+(constraints, bad types) write the batch one row at a time instead, dropping
+the failing rows only.
+
+```md
+Config (.env)
++-----------------------+--------+---------------------------------------------+
+| BUFFER_MAX_ROWS       | 10_000 | pending rows before `put` waits             |
+| BUFFER_BATCH_ROWS     |    500 | pending rows triggering a flush             |
+| BUFFER_FLUSH_SECONDS  |    2.0 | max delay before pending rows are flushed   |
+| BUFFER_MAX_RETRIES    |      5 | failed flushes retried before rows dropped  |
+| BUFFER_RETRY_SECONDS  |    0.5 | first retry delay, doubled on each retry    |
++-----------------------+--------+---------------------------------------------+
+```
+'''
+
+import asyncio
+import sqlite3
+from time import monotonic, perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.config import Config
+
+from db_pool import Pool
+from db_schema import INSERT_READING, INSERT_SENSOR_ID
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+CONFIG               = Config(".env")
+BUFFER_MAX_ROWS      = CONFIG("BUFFER_MAX_ROWS",   cast=int, default=10_000)
+BUFFER_BATCH_ROWS    = CONFIG("BUFFER_BATCH_ROWS", cast=int, default=500)
+BUFFER_FLUSH_SECONDS = CONFIG("BUFFER_FLUSH_SECONDS", cast=float, default=2.0)
+BUFFER_MAX_RETRIES   = CONFIG("BUFFER_MAX_RETRIES", cast=int, default=5)
+BUFFER_RETRY_SECONDS = CONFIG("BUFFER_RETRY_SECONDS", cast=float, default=0.5)
+
+# Errors of the rows themselves, retrying them would fail again
+PERMANENT_ERRORS = (
+    sqlite3.IntegrityError,
+    sqlite3.InterfaceError,
+    sqlite3.ProgrammingError,
+    sqlite3.DataError,
+    KeyError,
+    TypeError,
+    ValueError,
+)
+
+
+# ------
+# Buffer
+# -----------------------------------------------------------------------------
+class WriteBuffer:
+    """
+    Write-behind queue of sensors rows: {"ts": int, "sensor_id": str, ...}
+
+    Params
+    - db: Pool
+    - max_rows: int         = BUFFER_MAX_ROWS
+    - batch_rows: int       = BUFFER_BATCH_ROWS
+    - flush_seconds: float  = BUFFER_FLUSH_SECONDS
+    - max_retries: int      = BUFFER_MAX_RETRIES
+    - retry_seconds: float  = BUFFER_RETRY_SECONDS
+    """
+
+    def __init__(
+        self,
+        db: Pool,
+        max_rows: int           = BUFFER_MAX_ROWS,
+        batch_rows: int         = BUFFER_BATCH_ROWS,
+        flush_seconds: float    = BUFFER_FLUSH_SECONDS,
+        max_retries: int        = BUFFER_MAX_RETRIES,
+        retry_seconds: float    = BUFFER_RETRY_SECONDS,
+    ) -> None:
+        self.db             = db
+        self.max_rows       = max_rows
+        self.batch_rows     = min(batch_rows, max_rows)
+        self.flush_seconds  = flush_seconds
+        self.max_retries    = max_retries
+        self.retry_seconds  = retry_seconds
+
+        self._rows: List[Dict[str, Any]]                 = []
+        self._futures: List[Tuple[asyncio.Future, list]] = []  # put rows
+        self._cond                                       = asyncio.Condition()
+        self._kick                                       = asyncio.Event()
+        self._flush_lock                                 = asyncio.Lock()
+        self._task: Optional[asyncio.Task]               = None
+        self._attempts                                   = 0
+        self._retry_at                                   = 0.0
+
+        # Metrics
+        self._flushes       = 0
+        self._flushed_rows  = 0
+        self._errors        = 0
+        self._retries       = 0
+        self._dropped_rows  = 0
+        self._full_waits    = 0
+        self._latency_last  = 0.0
+        self._latency_sum   = 0.0
+        self._latency_max   = 0.0
+
+    def __repr__(self) -> str:
+        return f"WriteBuffer[{len(self._rows)}/{self.max_rows} rows]"
+
+    @property
+    def depth(self) -> int:
+        return len(self._rows)
+
+    def stats(self) -> Dict[str, Any]:
+        '''Queue depth, flushes counts and latencies (ms)'''
+        return {
+            "depth": self.depth,
+            "max_rows": self.max_rows,
+            "flushes": self._flushes,
+            "flushed_rows": self._flushed_rows,
+            "errors": self._errors,
+            "retries": self._retries,
+            "dropped_rows": self._dropped_rows,
+            "full_waits": self._full_waits,
+            "flush_ms_last": self._latency_last * 1_000,
+            "flush_ms_avg": self._latency_sum / max(self._flushes, 1) * 1_000,
+            "flush_ms_max": self._latency_max * 1_000,
+        }
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''Stop the flush task and flush the pending rows'''
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._rows:
+            await self._backoff()
+            await self.flush()
+
+    async def put(self, rows: List[Dict[str, Any]]) -> asyncio.Future:
+        '''Queue rows, waits while the buffer is full
+
+        Returns a future resolved with the rows committed, `rows` but the
+        dropped ones, or with the flush exception.
+        '''
+        fut = asyncio.get_running_loop().create_future()
+        # Mark exceptions as retrieved, awaiting the future is optional
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if not rows:
+            fut.set_result([])
+            return fut
+
+        async with self._cond:
+            while self._rows and len(self._rows) + len(rows) > self.max_rows:
+                self._full_waits += 1
+                self._kick.set()
+                await self._cond.wait()
+            self._rows.extend(rows)
+            self._futures.append((fut, rows))
+            if len(self._rows) >= self.batch_rows:
+                self._kick.set()
+        return fut
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> List[Dict]:
+        ids = [{"sensor_id": i} for i in {r["sensor_id"] for r in rows}]
+        async with self.db.writer() as conn:
+            await conn.executemany(INSERT_SENSOR_ID, ids)
+            cur = await conn.executemany(INSERT_READING, rows)
+            if cur.rowcount != len(rows):
+                # Rolled back, _write_rows finds the rows not inserted
+                raise sqlite3.IntegrityError(
+                    f"{len(rows) - cur.rowcount} rows not inserted"
+                )
+        return rows
+
+    async def _write_rows(self, rows: List[Dict[str, Any]]) -> List[Dict]:
+        '''Write rows one at a time in one transaction, drop the failing ones,
+        get the written rows'''
+        dropped = []
+        async with self.db.writer() as conn:
+            for r in rows:
+                try:
+                    await conn.execute(INSERT_SENSOR_ID, r)
+                    cur = await conn.execute(INSERT_READING, r)
+                    if cur.rowcount != 1:
+                        raise sqlite3.IntegrityError("no sensor_ids row")
+                except PERMANENT_ERRORS as e:
+                    dropped.append((r, e))
+        self._dropped_rows += len(dropped)
+        for r, e in dropped:
+            print(f"{self} row dropped: {r}: {type(e).__name__}: {e}")
+        failed = {id(r) for r, _ in dropped}
+        return [r for r in rows if id(r) not in failed]
+
+    async def _backoff(self) -> None:
+        delay = self._retry_at - monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def flush(self) -> int:
+        '''Write the pending rows in one transaction, get the rows count'''
+        async with self._flush_lock:
+            async with self._cond:
+                rows, futures = self._rows, self._futures
+                self._rows, self._futures = [], []
+                self._cond.notify_all()
+            if not rows:
+                return 0
+
+            t_init = perf_counter()
+            try:
+                try:
+                    written = await self._write(rows)
+                except PERMANENT_ERRORS:
+                    written = await self._write_rows(rows)
+            except Exception as e:
+                self._errors   += 1
+                self._attempts += 1
+                if self._attempts <= self.max_retries:
+                    delay = self.retry_seconds * 2 ** (self._attempts - 1)
+                    self._retries += 1
+                    self._retry_at = monotonic() + delay
+                    print(f"{self} flush of {len(rows)} rows failed, retry "
+                          f"{self._attempts} in {delay:.2f} s: {e}")
+                    async with self._cond:
+                        self._rows[:0]      = rows
+                        self._futures[:0]   = futures
+                    return 0
+
+                self._attempts      = 0
+                self._dropped_rows  += len(rows)
+                print(f"{self} flush of {len(rows)} rows failed "
+                      f"{self.max_retries + 1} times, rows dropped: {e}")
+                for f, _ in futures:
+                    if not f.done():
+                        f.set_exception(e)
+                return 0
+
+            latency = perf_counter() - t_init
+            self._attempts      = 0
+            self._flushes       += 1
+            self._flushed_rows  += len(written)
+            self._latency_last  = latency
+            self._latency_sum   += latency
+            self._latency_max   = max(self._latency_max, latency)
+            ok = {id(r) for r in written}
+            for f, put_rows in futures:
+                if not f.done():
+                    f.set_result([r for r in put_rows if id(r) in ok])
+            return len(written)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            await self._backoff()
+            await self.flush()
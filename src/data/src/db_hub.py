@@ -0,0 +1,249 @@
+'''
+Sensors publish / subscribe hub, db_server WebSocket and SSE push
+
+requirements:
+- starlette
+- db_pool
+
+Rows are grouped by sensor_id and serialised once per publish, subscribers
+get the same JSON text: `[[ts, sensor_id, value], ...]`. Each subscriber has a
+bounded queue, a slow consumer drops its oldest messages instead of slowing
+the publishers down (counted in `dropped`).
+
+Rows committed by other processes (db_sensors) are published by polling
+`PRAGMA data_version`, only while there are subscribers: rows newer than the
+last published ts of their sensor, late rows are not pushed.
+
+```md
+Config (.env)
++-----------------------+--------+---------------------------------------------+
+| HUB_QUEUE             |    100 | messages queued per subscriber              |
+| HUB_POLL_SECONDS      |    0.5 | other processes commits polling period      |
+| HUB_POLL_LIMIT        |  1_000 | max rows published per sensor and poll      |
++-----------------------+--------+---------------------------------------------+
+```
+'''
+
+import asyncio
+import json
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set
+
+from starlette.config import Config
+
+from db_pool import Pool
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+CONFIG              = Config(".env")
+HUB_QUEUE           = CONFIG("HUB_QUEUE",          cast=int,   default=100)
+HUB_POLL_SECONDS    = CONFIG("HUB_POLL_SECONDS",   cast=float, default=0.5)
+HUB_POLL_LIMIT      = CONFIG("HUB_POLL_LIMIT",     cast=int,   default=1_000)
+TS_MIN              = -(2 ** 63)
+
+SELECT_LAST_TS = '''
+    SELECT i.id, i.name, (SELECT MAX(ts) FROM sensors WHERE sensor_id = i.id)
+    FROM sensor_ids i
+'''
+SELECT_SINCE = '''
+    SELECT ts, value FROM sensors
+    WHERE sensor_id = :key AND ts > :ts
+    ORDER BY ts LIMIT :limit
+'''
+
+
+# ----------
+# Subscriber
+# -----------------------------------------------------------------------------
+class Subscriber:
+    """
+    Bounded queue of JSON messages, oldest dropped when full
+
+    Params
+    - sensor_ids: Set[str]  = set(), all sensors if empty
+    - max_messages: int     = HUB_QUEUE
+    """
+
+    def __init__(
+        self,
+        sensor_ids: Set[str]    = set(),
+        max_messages: int       = HUB_QUEUE,
+    ) -> None:
+        self.sensor_ids = set(sensor_ids)
+        self.dropped    = 0
+
+        self._messages: Deque[str]  = deque(maxlen=max_messages)
+        self._event                 = asyncio.Event()
+
+    def __repr__(self) -> str:
+        ids = ",".join(sorted(self.sensor_ids)) or "*"
+        return f"Subscriber[{ids}, {len(self._messages)} queued]"
+
+    def push(self, message: str) -> None:
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(message)
+        self._event.set()
+
+    async def get(self) -> List[str]:
+        '''Wait for messages, get all the queued ones'''
+        await self._event.wait()
+        self._event.clear()
+        messages = list(self._messages)
+        self._messages.clear()
+        return messages
+
+
+# ---
+# Hub
+# -----------------------------------------------------------------------------
+class Hub:
+    """
+    Sensors rows fan-out to subscribers
+
+    Params
+    - db: Pool
+    - poll_seconds: float   = HUB_POLL_SECONDS
+    - poll_limit: int       = HUB_POLL_LIMIT
+    """
+
+    def __init__(
+        self,
+        db: Pool,
+        poll_seconds: float = HUB_POLL_SECONDS,
+        poll_limit: int     = HUB_POLL_LIMIT,
+    ) -> None:
+        self.db             = db
+        self.poll_seconds   = poll_seconds
+        self.poll_limit     = poll_limit
+
+        self._by_sensor: Dict[str, Set[Subscriber]]     = {}
+        self._all: Set[Subscriber]                      = set()
+        self._last_ts: Optional[Dict[str, int]]         = None
+        self._data_version: Optional[int]               = None
+        self._task: Optional[asyncio.Task]              = None
+
+        # Metrics
+        self._published = 0
+        self._messages  = 0
+
+    def __repr__(self) -> str:
+        return f"Hub[{self.n_subscribers} subscribers]"
+
+    @property
+    def n_subscribers(self) -> int:
+        subs = set(self._all)
+        for s in self._by_sensor.values():
+            subs |= s
+        return len(subs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": self.n_subscribers,
+            "published_rows": self._published,
+            "messages": self._messages,
+        }
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @contextmanager
+    def subscribe(self, sensor_ids: List[str] = []) -> Iterator[Subscriber]:
+        '''Subscribe to `sensor_ids` rows, all sensors if empty'''
+        sub = Subscriber(set(sensor_ids))
+        if sub.sensor_ids:
+            for i in sub.sensor_ids:
+                self._by_sensor.setdefault(i, set()).add(sub)
+        else:
+            self._all.add(sub)
+        try:
+            yield sub
+        finally:
+            self._all.discard(sub)
+            for i in sub.sensor_ids:
+                subs = self._by_sensor.get(i, set())
+                subs.discard(sub)
+                if not subs:
+                    self._by_sensor.pop(i, None)
+
+    def publish(self, rows: List[Dict[str, Any]]) -> None:
+        '''Push {"ts", "sensor_id", "value"} rows, one message per sensor'''
+        by_sensor: Dict[str, list] = {}
+        for r in rows:
+            by_sensor.setdefault(r["sensor_id"], []).append(
+                [r["ts"], r["sensor_id"], r["value"]]
+            )
+
+        for name, points in by_sensor.items():
+            if self._last_ts is not None:
+                last = self._last_ts.get(name)
+                ts   = max(p[0] for p in points)
+                self._last_ts[name] = ts if last is None else max(last, ts)
+
+            subs = self._all | self._by_sensor.get(name, set())
+            if not subs:
+                continue
+            message = json.dumps(points)
+            for sub in subs:
+                sub.push(message)
+            self._published += len(points)
+            self._messages  += len(subs)
+
+    async def poll(self) -> None:
+        '''Publish the rows committed by other processes'''
+        if not self._all and not self._by_sensor:
+            self._last_ts = None
+            return
+        data_version = await self.db.data_version()
+        if self._last_ts is not None and data_version == self._data_version:
+            return
+
+        rows = await self.db.fetch_all(SELECT_LAST_TS)
+        if self._last_ts is None:
+            # First poll with subscribers, only publish from now on
+            self._last_ts = {r[1]: r[2] for r in rows if r[2] is not None}
+            self._data_version = data_version
+            return
+
+        # Sensors over `poll_limit` new rows are read again on the next poll
+        self._data_version = data_version
+        new = []
+        for key, name, ts in rows:
+            last = self._last_ts.get(name)
+            if ts is None or (last is not None and ts <= last):
+                continue
+            values = {
+                "key": key,
+                "ts": TS_MIN if last is None else last,
+                "limit": self.poll_limit,
+            }
+            since = await self.db.fetch_all(SELECT_SINCE, values)
+            if len(since) == self.poll_limit:
+                self._data_version = None
+            new.extend(
+                {"ts": r[0], "sensor_id": name, "value": r[1]} for r in since
+            )
+        if new:
+            self.publish(new)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"{self} poll failed: {type(e).__name__}: {e}")
+
@@ -0,0 +1,543 @@
+'''
+MQTT subscriber service, feeds the sensors database next to db_sensors
+
+requirements:
+- aiosqlite, starlette
+- db_buffer, db_pool, db_schema
+
+Subscribes to MQTT_TOPICS with QoS 1 on a persistent session (clean session
+off), decodes the payloads to sensors rows and writes them through the
+write-behind buffer. PUBACKs are sent, in order, only once their rows are
+committed: on a crash, a failed flush or a lost connection the messages stay
+unacknowledged and the broker delivers them again on reconnect
+(at-least-once). Payloads with a "ts" are idempotent on redelivery, others
+are stamped on receipt.
+
+Publishers must publish with QoS 1 too, brokers downgrade QoS 0 messages.
+
+Payloads
+- JSON object: one row per numeric field, sensor_id `<prefix>_<field>`
+- JSON number: one row, sensor_id `<prefix>`
+- "ts": optional, epoch µs or ISO string
+- MQTT_ERROR_VALUE readings are dropped (sensor read errors)
+
+```md
+Config (.env)
++------------------------+----------------+------------------------------------+
+| MQTT_HOST              |      localhost | broker                             |
+| MQTT_PORT              |           1883 |                                    |
+| MQTT_USER              |                |                                    |
+| MQTT_PASSWORD          |                |                                    |
+| MQTT_CLIENT_ID         | db_mqtt_bridge | persistent session id              |
+| MQTT_KEEPALIVE         |             60 | seconds                            |
+| MQTT_TOPICS            |    sen/dht:dht | topic filter:sensor_id prefix, ... |
+| MQTT_ERROR_VALUE       |        -273.15 | dropped readings                   |
+| MQTT_RECONNECT_MAX     |             30 | seconds, reconnect backoff cap     |
++------------------------+----------------+------------------------------------+
+```
+'''
+
+import asyncio
+import json
+import os
+import struct
+import sys
+from datetime import datetime as dt
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from starlette.config import Config
+
+from db_buffer import WriteBuffer
+from db_pool import Pool
+from db_schema import to_epoch_us
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+CONFIG              = Config(".env")
+MQTT_HOST           = CONFIG("MQTT_HOST",       cast=str, default="localhost")
+MQTT_PORT           = CONFIG("MQTT_PORT",       cast=int, default=1883)
+MQTT_USER           = CONFIG("MQTT_USER",       cast=str, default="")
+MQTT_PASSWORD       = CONFIG("MQTT_PASSWORD",   cast=str, default="")
+MQTT_CLIENT_ID      = CONFIG("MQTT_CLIENT_ID",  cast=str,
+                             default="db_mqtt_bridge")
+MQTT_KEEPALIVE      = CONFIG("MQTT_KEEPALIVE",  cast=int, default=60)
+MQTT_TOPICS         = CONFIG("MQTT_TOPICS",     cast=str, default="sen/dht:dht")
+MQTT_ERROR_VALUE    = CONFIG("MQTT_ERROR_VALUE", cast=float, default=-273.15)
+MQTT_RECONNECT_MAX  = CONFIG("MQTT_RECONNECT_MAX", cast=float, default=30)
+
+# Database
+PATH_DATA = Path().cwd() / "bin"
+os.makedirs(PATH_DATA, exist_ok=True)
+DB_URL    = CONFIG("DB_URL", cast=str, default="bin/data.db")
+
+# MQTT 3.1.1 control packets types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+class MQTTError(Exception):
+    pass
+
+
+# -------
+# Helpers
+# -----------------------------------------------------------------------------
+def parse_topics(topics: str) -> Dict[str, str]:
+    '''Get {topic filter: sensor_id prefix} from "filter:prefix,..."'''
+    resp = {}
+    for t in topics.split(","):
+        if t.strip():
+            f, prefix = t.strip().rsplit(":", 1)
+            resp[f] = prefix
+    return resp
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    '''MQTT topic filter matching, + and # wildcards'''
+    f, t = topic_filter.split("/"), topic.split("/")
+    for i, level in enumerate(f):
+        if level == "#":
+            return True
+        if i >= len(t) or level not in ("+", t[i]):
+            return False
+    return len(f) == len(t)
+
+
+def decode_payload(
+    prefix: str,
+    payload: bytes,
+    ts: int,
+    error_value: float = MQTT_ERROR_VALUE,
+) -> List[Dict]:
+    '''Get {"ts", "sensor_id", "value"} rows, `ts` if none in the payload'''
+    data = json.loads(payload)
+    if isinstance(data, dict):
+        ts    = to_epoch_us(data["ts"]) if "ts" in data else ts
+        items = [(f"{prefix}_{k}", v) for k, v in data.items() if k != "ts"]
+    else:
+        items = [(prefix, data)]
+    return [
+        {"ts": ts, "sensor_id": k, "value": float(v)}
+        for k, v in items
+        if isinstance(v, (int, float)) and v != error_value
+    ]
+
+
+def encode_packet(packet_type: int, body: bytes = b"", flags: int = 0) -> bytes:
+    n, length = len(body), bytearray()
+    while True:
+        n, b = divmod(n, 128)
+        length.append(b | 0x80 if n else b)
+        if not n:
+            break
+    return bytes((packet_type << 4 | flags,)) + bytes(length) + body
+
+
+def encode_str(s: str) -> bytes:
+    b = s.encode()
+    return struct.pack("!H", len(b)) + b
+
+
+async def read_packet(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    '''Get (type, flags, body) of the next control packet'''
+    header = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        length |= (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise MQTTError("Malformed remaining length")
+    return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+
+# ------
+# Client
+# -----------------------------------------------------------------------------
+class MQTTClient:
+    """
+    Minimal MQTT 3.1.1 subscriber: QoS 0 / 1 deliveries, explicit PUBACK
+
+    Params
+    - reader: asyncio.StreamReader
+    - writer: asyncio.StreamWriter
+    - keepalive: int                = MQTT_KEEPALIVE
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        keepalive: int  = MQTT_KEEPALIVE,
+    ) -> None:
+        self.reader     = reader
+        self.writer     = writer
+        self.keepalive  = keepalive
+
+        self._packet_id = 0
+        self._lock      = asyncio.Lock()
+
+    async def send(
+        self,
+        packet_type: int,
+        body: bytes = b"",
+        flags: int = 0,
+    ) -> None:
+        async with self._lock:
+            self.writer.write(encode_packet(packet_type, body, flags))
+            await self.writer.drain()
+
+    async def read(self) -> Tuple[int, int, bytes]:
+        if not self.keepalive:
+            return await read_packet(self.reader)
+        return await asyncio.wait_for(
+            read_packet(self.reader), self.keepalive * 1.5
+        )
+
+    async def connect(
+        self,
+        client_id: str,
+        user: str = "",
+        password: str = "",
+        clean_session: bool = False,
+    ) -> bool:
+        '''Connect, get the broker session present flag'''
+        flags = 0x02 if clean_session else 0
+        payload = encode_str(client_id)
+        if user:
+            flags   |= 0x80
+            payload += encode_str(user)
+        if password:
+            flags   |= 0x40
+            payload += encode_str(password)
+        body = encode_str("MQTT")
+        body += struct.pack("!BBH", 4, flags, self.keepalive)
+        await self.send(CONNECT, body + payload)
+
+        packet_type, _, body = await self.read()
+        if packet_type != CONNACK or len(body) != 2:
+            raise MQTTError(f"Expected CONNACK, got: {packet_type}")
+        if body[1] != 0:
+            raise MQTTError(f"Connection refused, return code: {body[1]}")
+        return bool(body[0] & 0x01)
+
+    async def subscribe(self, topic_filters: List[str], qos: int = 1) -> None:
+        '''Send SUBSCRIBE, the SUBACK is checked by `messages`'''
+        self._packet_id = self._packet_id % 0xFFFF + 1
+        body = struct.pack("!H", self._packet_id)
+        for f in topic_filters:
+            body += encode_str(f) + bytes((qos,))
+        await self.send(SUBSCRIBE, body, flags=0x02)
+
+    async def puback(self, packet_id: int) -> None:
+        await self.send(PUBACK, struct.pack("!H", packet_id))
+
+    async def ping_loop(self) -> None:
+        while self.keepalive:
+            await asyncio.sleep(self.keepalive)
+            await self.send(PINGREQ)
+
+    async def messages(
+        self,
+    ) -> AsyncIterator[Tuple[str, Optional[int], bytes]]:
+        '''Iterate (topic, packet id, payload) deliveries, packet id None
+        for QoS 0'''
+        while True:
+            packet_type, flags, body = await self.read()
+            if packet_type == PUBLISH:
+                qos   = flags >> 1 & 0x03
+                size  = struct.unpack_from("!H", body)[0]
+                topic = body[2:2 + size].decode()
+                pos   = 2 + size
+                packet_id = None
+                if qos > 0:
+                    packet_id = struct.unpack_from("!H", body, pos)[0]
+                    pos += 2
+                yield topic, packet_id, body[pos:]
+            elif packet_type == SUBACK:
+                if 0x80 in body[2:]:
+                    raise MQTTError(f"Subscription refused: {list(body[2:])}")
+            elif packet_type != PINGRESP:
+                raise MQTTError(f"Unexpected packet type: {packet_type}")
+
+    async def disconnect(self) -> None:
+        try:
+            await self.send(DISCONNECT)
+        finally:
+            self.writer.close()
+
+
+# ------
+# Bridge
+# -----------------------------------------------------------------------------
+class Bridge:
+    """
+    MQTT topics to sensors rows, at-least-once through a WriteBuffer
+
+    Params
+    - buffer: WriteBuffer
+    - topics: Dict[str, str]    = parse_topics(MQTT_TOPICS)
+    - host: str                 = MQTT_HOST
+    - port: int                 = MQTT_PORT
+    - client_id: str            = MQTT_CLIENT_ID
+    - user: str                 = MQTT_USER
+    - password: str             = MQTT_PASSWORD
+    - keepalive: int            = MQTT_KEEPALIVE
+    - reconnect_max: float      = MQTT_RECONNECT_MAX
+    """
+
+    def __init__(
+        self,
+        buffer: WriteBuffer,
+        topics: Dict[str, str]  = parse_topics(MQTT_TOPICS),
+        host: str               = MQTT_HOST,
+        port: int               = MQTT_PORT,
+        client_id: str          = MQTT_CLIENT_ID,
+        user: str               = MQTT_USER,
+        password: str           = MQTT_PASSWORD,
+        keepalive: int          = MQTT_KEEPALIVE,
+        reconnect_max: float    = MQTT_RECONNECT_MAX,
+    ) -> None:
+        self.buffer         = buffer
+        self.topics         = topics
+        self.host           = host
+        self.port           = port
+        self.client_id      = client_id
+        self.user           = user
+        self.password       = password
+        self.keepalive      = keepalive
+        self.reconnect_max  = reconnect_max
+        self._delay         = 1.0  # Reconnection backoff, seconds
+
+        # Metrics
+        self.received       = 0
+        self.acked          = 0
+        self.rows           = 0
+        self.errors         = 0
+        self.reconnects     = 0
+
+    def __repr__(self) -> str:
+        return f"Bridge[{self.client_id}@{self.host}:{self.port}]"
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "acked": self.acked,
+            "rows": self.rows,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+        }
+
+    def get_prefix(self, topic: str) -> Optional[str]:
+        for f, prefix in self.topics.items():
+            if topic_matches(f, topic):
+                return prefix
+        return None
+
+    async def run(self) -> None:
+        '''Connect and consume forever, reconnects with exponential backoff'''
+        while True:
+            try:
+                await self._session()
+            except (OSError, EOFError, asyncio.TimeoutError, MQTTError) as e:
+                print(f"{self} connection lost: {type(e).__name__}: {e}")
+            self.reconnects += 1
+            print(f"{self} reconnecting in {self._delay}s...")
+            await asyncio.sleep(self._delay)
+            self._delay = min(self._delay * 2, self.reconnect_max)
+
+    async def _session(self) -> None:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        client = MQTTClient(reader, writer, self.keepalive)
+        acks: asyncio.Queue = asyncio.Queue()
+        tasks = []
+        try:
+            present = await client.connect(
+                self.client_id, self.user, self.password
+            )
+            print(f"{self} connected, session present: {present}")
+            self._delay = 1.0
+            await client.subscribe(list(self.topics))
+            for coro in (self._ack(client, acks), client.ping_loop()):
+                task = asyncio.create_task(coro)
+                task.add_done_callback(
+                    lambda t: self._on_task_done(client, t)
+                )
+                tasks.append(task)
+
+            async for topic, packet_id, payload in client.messages():
+                self.received += 1
+                rows = []
+                prefix = self.get_prefix(topic)
+                try:
+                    if prefix is not None:
+                        ts   = to_epoch_us(dt.now())
+                        rows = decode_payload(prefix, payload, ts)
+                except (ValueError, TypeError, KeyError) as e:
+                    # Acknowledged, a redelivery would fail the same way
+                    self.errors += 1
+                    print(f"{self} bad payload on {topic}: {e}: {payload}")
+                fut = await self.buffer.put(rows)
+                self.rows += len(rows)
+                if packet_id is not None:
+                    acks.put_nowait((packet_id, fut))
+        finally:
+            for t in tasks:
+                t.cancel()
+            writer.close()
+
+    def _on_task_done(self, client: MQTTClient, task: asyncio.Task) -> None:
+        '''Drop the connection when the acks or keepalive task failed, the
+        messages loop ends and `run` reconnects'''
+        if task.cancelled() or task.exception() is None:
+            return
+        e = task.exception()
+        self.errors += 1
+        print(f"{self} {task.get_coro().__qualname__} failed, dropping the "
+              f"connection: {type(e).__name__}: {e}")
+        client.writer.close()
+
+    async def _ack(self, client: MQTTClient, acks: asyncio.Queue) -> None:
+        '''PUBACK deliveries in order, once their rows are committed'''
+        while True:
+            packet_id, fut = await acks.get()
+            try:
+                await fut
+            except Exception as e:
+                # Unacknowledged, redelivered on reconnect
+                self.errors += 1
+                print(f"{self} flush failed, dropping the connection: {e}")
+                client.writer.close()
+                return
+            await client.puback(packet_id)
+            self.acked += 1
+
+
+# ---------
+# Execution
+# -----------------------------------------------------------------------------
+async def run() -> None:
+    db     = Pool(DB_URL, readers=1)
+    buffer = WriteBuffer(db)
+    bridge = Bridge(buffer)
+    await db.connect()
+    await buffer.start()
+    print(f"Starting {bridge}, topics: {bridge.topics}...")
+    try:
+        await bridge.run()
+    finally:
+        await buffer.stop()
+        await db.disconnect()
+        print(f"{bridge} stopped, io cleaned up: {bridge.stats()}")
+
+
+# -----
+# Tests
+# -----------------------------------------------------------------------------
+class TestsBroker:
+    """
+    Local broker stand-in: publishes QoS 1 messages, drops the first
+    connection before their PUBACKs, redelivers the unacknowledged ones
+    """
+
+    def __init__(self, messages: List[Tuple[str, bytes]]) -> None:
+        self.messages       = dict(enumerate(messages, start=1))
+        self.acked: List[int]   = []
+        self.connections    = 0
+        self.done           = asyncio.Event()
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self.connections += 1
+        try:
+            packet_type, _, _ = await read_packet(reader)
+            assert packet_type == CONNECT
+            writer.write(encode_packet(CONNACK, bytes((1, 0))))
+            packet_type, _, body = await read_packet(reader)
+            assert packet_type == SUBSCRIBE
+            writer.write(encode_packet(SUBACK, body[:2] + b"\x01"))
+
+            for packet_id, (topic, payload) in self.messages.items():
+                if packet_id in self.acked:
+                    continue
+                dup  = 0x08 if self.connections > 1 else 0
+                body = encode_str(topic) + struct.pack("!H", packet_id)
+                writer.write(encode_packet(PUBLISH, body + payload, 0x02 | dup))
+            await writer.drain()
+            if self.connections == 1:
+                return  # Connection lost before the PUBACKs
+
+            while len(self.acked) < len(self.messages):
+                packet_type, _, body = await read_packet(reader)
+                if packet_type == PUBACK:
+                    self.acked.append(struct.unpack("!H", body)[0])
+            self.done.set()
+            await reader.read()
+        finally:
+            writer.close()
+
+
+async def run_tests() -> None:
+    db_path = "bin/tests_mqtt.db"
+    for ext in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + ext):
+            os.remove(db_path + ext)
+
+    messages = [
+        ("sen/dht", b'{"ts": 1620000000000000, "temp": 21.5, "rh": 40}'),
+        ("sen/dht", b'{"ts": 1620000001000000, "temp": -273.15, "rh": 41}'),
+        ("sen/dht", b'{"temp": 22, "rh": 42}'),
+        ("sen/bmp/1", b"1013.25"),
+        ("sen/dht", b"not json"),
+        ("other", b"1"),
+    ]
+    broker = TestsBroker(messages)
+    server = await asyncio.start_server(broker.handle, "localhost", 0)
+    port   = server.sockets[0].getsockname()[1]
+
+    db     = Pool(db_path, readers=1)
+    buffer = WriteBuffer(db, flush_seconds=0.1)
+    bridge = Bridge(
+        buffer,
+        topics={"sen/dht": "dht", "sen/bmp/+": "bmp"},
+        port=port,
+        client_id="tests",
+        keepalive=5,
+    )
+    await db.connect()
+    await buffer.start()
+    task = asyncio.create_task(bridge.run())
+    try:
+        await asyncio.wait_for(broker.done.wait(), 10)
+        rows = await db.fetch_all("SELECT * FROM sensors_view ORDER BY ts")
+        rows = [tuple(r) for r in rows]
+        print(f"broker: {broker.connections} connections, {broker.acked}")
+        print(f"bridge: {bridge.stats()}")
+        print(f"rows: {rows}")
+        assert sorted(broker.acked) == list(broker.messages)
+        # Redelivered payloads with a ts are written once, error values dropped
+        assert sum(r[0] == 1620000000000000 for r in rows) == 2
+        assert [r[1] for r in rows if r[0] == 1620000001000000] == ["dht_rh"]
+        assert {"dht_temp", "dht_rh", "bmp"} <= {r[1] for r in rows}
+        print("tests: ok")
+    finally:
+        task.cancel()
+        await buffer.stop()
+        await db.disconnect()
+        server.close()
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1] in ("run", "tests"), "arg: [run|tests]"
+    if sys.argv[-1] == "run":
+        asyncio.run(run())
+    elif sys.argv[-1] == "tests":
+        asyncio.run(run_tests())
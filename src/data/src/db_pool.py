@@ -0,0 +1,203 @@
+'''
+Sensors database connections pool, shared by db_server and db_sensors
+
+requirements:
+- aiosqlite, starlette
+- db_schema
+
+One writer connection serialised by a lock and a few reader connections, all
+long-lived and in WAL mode: readers never wait for the writer, other processes
+(db_server, db_sensors) share the same database file concurrently. The schema
+is set up once, on `connect`.
+
+```md
+Config (.env)
++--------------------+------------+--------------------------------------------+
+| DB_READERS         |          2 | reader connections                         |
+| DB_SYNCHRONOUS     |     NORMAL | WAL: durable at checkpoints, never corrupt |
+| DB_MMAP_SIZE       | 67_108_864 | bytes, memory-mapped reads                 |
+| DB_BUSY_TIMEOUT    |      5_000 | ms, waiting for other processes locks      |
+| DB_CACHED_STMTS    |        256 | prepared statements cached per connection  |
++--------------------+------------+--------------------------------------------+
+```
+'''
+
+import asyncio
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+import aiosqlite
+from starlette.config import Config
+
+from db_schema import init_db
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+CONFIG          = Config(".env")
+DB_READERS      = CONFIG("DB_READERS",      cast=int, default=2)
+DB_SYNCHRONOUS  = CONFIG("DB_SYNCHRONOUS",  cast=str, default="NORMAL")
+DB_MMAP_SIZE    = CONFIG("DB_MMAP_SIZE",    cast=int, default=67_108_864)
+DB_BUSY_TIMEOUT = CONFIG("DB_BUSY_TIMEOUT", cast=int, default=5_000)
+DB_CACHED_STMTS = CONFIG("DB_CACHED_STMTS", cast=int, default=256)
+PRAGMAS         = {
+    "journal_mode": "WAL",
+    "synchronous": DB_SYNCHRONOUS,
+    "mmap_size": DB_MMAP_SIZE,
+    "busy_timeout": DB_BUSY_TIMEOUT,
+    "temp_store": "MEMORY",
+}
+
+
+# ----
+# Pool
+# -----------------------------------------------------------------------------
+class Pool:
+    """
+    aiosqlite connections pool
+
+    Params
+    - db_path: str
+    - readers: int              = DB_READERS
+    - pragmas: Dict[str, Any]   = PRAGMAS
+
+    `fetch_*` and `execute*` mirror `databases.Database`, `writer()` yields
+    the writer connection for a transaction: committed on exit, rolled back
+    on error.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        readers: int                = DB_READERS,
+        pragmas: Dict[str, Any]     = PRAGMAS,
+    ) -> None:
+        self.db_path    = db_path
+        self.n_readers  = readers
+        self.pragmas    = pragmas
+
+        self._writer: Optional[aiosqlite.Connection]    = None
+        self._writer_lock                               = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection]       = []
+        self._idle_readers: asyncio.Queue               = asyncio.Queue()
+
+    def __repr__(self) -> str:
+        return f"Pool[{self.db_path}, readers: {self.n_readers}]"
+
+    @property
+    def is_connected(self) -> bool:
+        return self._writer is not None
+
+    async def _open(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self.db_path,
+            cached_statements=DB_CACHED_STMTS,
+        )
+        conn.row_factory = sqlite3.Row
+        for k, v in self.pragmas.items():
+            await conn.execute(f"PRAGMA {k} = {v}")
+        return conn
+
+    async def connect(self) -> None:
+        if self.is_connected:
+            return
+        init_db(self.db_path)
+        self._writer = await self._open()
+        for _ in range(self.n_readers):
+            conn = await self._open()
+            self._readers.append(conn)
+            self._idle_readers.put_nowait(conn)
+
+    async def disconnect(self) -> None:
+        if not self.is_connected:
+            return
+        async with self._writer_lock:
+            for conn in self._readers:
+                await conn.close()
+            await self._writer.close()
+        self._writer        = None
+        self._readers       = []
+        self._idle_readers  = asyncio.Queue()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self.is_connected:
+            raise RuntimeError(f"{self} is not connected")
+        conn = await self._idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self.is_connected:
+            raise RuntimeError(f"{self} is not connected")
+        async with self._writer_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def data_version(self) -> int:
+        '''Get the writer `PRAGMA data_version`, changed by other connections
+        commits, other processes included'''
+        if not self.is_connected:
+            raise RuntimeError(f"{self} is not connected")
+        async with self._writer_lock:
+            async with self._writer.execute("PRAGMA data_version") as c:
+                return (await c.fetchone())[0]
+
+    async def fetch_all(
+        self,
+        query: str,
+        values: Optional[Dict[str, Any]] = None,
+    ) -> List[sqlite3.Row]:
+        async with self.reader() as conn:
+            return await conn.execute_fetchall(query, values or {})
+
+    async def fetch_one(
+        self,
+        query: str,
+        values: Optional[Dict[str, Any]] = None,
+    ) -> Optional[sqlite3.Row]:
+        async with self.reader() as conn:
+            async with conn.execute(query, values or {}) as c:
+                return await c.fetchone()
+
+    async def iterate_chunks(
+        self,
+        query: str,
+        values: Optional[Dict[str, Any]] = None,
+        chunk_size: int = 1_000,
+    ) -> AsyncIterator[List[sqlite3.Row]]:
+        '''Iterate rows by chunks of `chunk_size`, holds a reader meanwhile'''
+        async with self.reader() as conn:
+            async with conn.execute(query, values or {}) as c:
+                while True:
+                    rows = await c.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def execute(
+        self,
+        query: str,
+        values: Optional[Dict[str, Any]] = None,
+    ) -> int:
+        async with self.writer() as conn:
+            async with conn.execute(query, values or {}) as c:
+                return c.rowcount
+
+    async def execute_many(
+        self,
+        query: str,
+        values: Iterable[Dict[str, Any]],
+    ) -> int:
+        async with self.writer() as conn:
+            async with conn.executemany(query, values) as c:
+                return c.rowcount
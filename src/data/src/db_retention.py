@@ -0,0 +1,170 @@
+'''
+Sensors database retention: drop expired raw rows and rollups, reclaim pages
+
+requirements:
+- starlette
+- db_pool, db_schema
+
+Raw rows are folded into the rollup tables on insert (db_schema triggers), so
+expiring a tier only drops rows, coarser tiers keep their history.
+
+```md
+Config (.env)
++-------------------------+---------+-----------------------------------------+
+| RETENTION_RAW_DAYS      |      30 | sensors rows, days, 0: keep forever     |
+| RETENTION_1M_DAYS       |      90 | sensors_1m rows                         |
+| RETENTION_1H_DAYS       |     730 | sensors_1h rows                         |
+| RETENTION_1D_DAYS       |       0 | sensors_1d rows                         |
+| RETENTION_BATCH         |   2_000 | max rows deleted per transaction        |
+| RETENTION_PAUSE         |    0.05 | seconds between transactions            |
+| RETENTION_VACUUM_PAGES  |     256 | max pages reclaimed per transaction     |
+| RETENTION_JOB_MINUTES   |      60 | db_sensors retention job period         |
++-------------------------+---------+-----------------------------------------+
+```
+'''
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime as dt
+from typing import Dict, Optional
+
+from starlette.config import Config
+
+from db_pool import Pool
+from db_schema import ROLLUPS, to_epoch_us
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+CONFIG  = Config(".env")
+DAY_US  = 86_400_000_000
+
+
+@dataclass
+class RetentionPolicy:
+    """Days to keep per table, 0 keeps forever
+
+    Tables are expired on whole days, a rollup bucket is never left with
+    part of its raw rows.
+    """
+    raw_days: int       = 30
+    rollup_1m_days: int = 90
+    rollup_1h_days: int = 730
+    rollup_1d_days: int = 0
+    batch: int          = 2_000
+    pause: float        = 0.05
+    vacuum_pages: int   = 256
+
+    def __post_init__(self) -> None:
+        days = [d or float("inf") for d in self.tables.values()]
+        if days != sorted(days):
+            raise ValueError(
+                "Retention days must not decrease from raw to 1d rollups: "
+                f"{self.tables}"
+            )
+        if self.batch < 1 or self.vacuum_pages < 1:
+            raise ValueError("Retention batch and vacuum pages must be > 0")
+
+    @property
+    def tables(self) -> Dict[str, int]:
+        return {
+            "sensors": self.raw_days,
+            "sensors_1m": self.rollup_1m_days,
+            "sensors_1h": self.rollup_1h_days,
+            "sensors_1d": self.rollup_1d_days,
+        }
+
+
+RETENTION = RetentionPolicy(
+    raw_days       = CONFIG("RETENTION_RAW_DAYS",     cast=int, default=30),
+    rollup_1m_days = CONFIG("RETENTION_1M_DAYS",      cast=int, default=90),
+    rollup_1h_days = CONFIG("RETENTION_1H_DAYS",      cast=int, default=730),
+    rollup_1d_days = CONFIG("RETENTION_1D_DAYS",      cast=int, default=0),
+    batch          = CONFIG("RETENTION_BATCH",        cast=int, default=2_000),
+    pause          = CONFIG("RETENTION_PAUSE",      cast=float, default=0.05),
+    vacuum_pages   = CONFIG("RETENTION_VACUUM_PAGES", cast=int, default=256),
+)
+RETENTION_JOB_MINUTES = CONFIG("RETENTION_JOB_MINUTES", cast=int, default=60)
+assert set(RETENTION.tables) == {"sensors"} | {f"sensors_{t}" for t in ROLLUPS}
+
+
+# ---------
+# Execution
+# -----------------------------------------------------------------------------
+async def expire_table(
+    db: Pool,
+    table: str,
+    cutoff: int,
+    policy: RetentionPolicy = RETENTION,
+) -> int:
+    '''Delete `table` rows older than `cutoff` (epoch µs), in bounded batches
+
+    Each batch is a (sensor_id, ts) primary key range delete, in its own
+    writer transaction so concurrent writers only wait for one batch.
+    '''
+    deleted = 0
+    keys = [r[0] for r in await db.fetch_all("SELECT id FROM sensor_ids")]
+
+    for key in keys:
+        while True:
+            async with db.writer() as conn:
+                # Upper ts bound of the next `batch` expired rows
+                async with conn.execute(
+                    f'''SELECT ts FROM {table}
+                    WHERE sensor_id = ? AND ts < ?
+                    ORDER BY ts LIMIT 1 OFFSET ?''',
+                    (key, cutoff, policy.batch - 1)
+                ) as c:
+                    row = await c.fetchone()
+                upper = row[0] + 1 if row else cutoff
+
+                async with conn.execute(
+                    f"DELETE FROM {table} WHERE sensor_id = ? AND ts < ?",
+                    (key, upper)
+                ) as c:
+                    deleted += c.rowcount
+            await asyncio.sleep(policy.pause)
+            if row is None:
+                break
+    return deleted
+
+
+async def reclaim_pages(
+    db: Pool,
+    policy: RetentionPolicy = RETENTION,
+) -> int:
+    '''Incremental vacuum of the free pages, in bounded batches'''
+    reclaimed = 0
+    if (await db.fetch_one("PRAGMA auto_vacuum"))[0] != 2:
+        return reclaimed
+
+    while True:
+        free = (await db.fetch_one("PRAGMA freelist_count"))[0]
+        if free == 0:
+            break
+        async with db.writer() as conn:
+            # executescript steps the pragma to completion, execute frees a
+            # single page
+            await conn.executescript(
+                f"PRAGMA incremental_vacuum({min(free, policy.vacuum_pages)})"
+            )
+        reclaimed += min(free, policy.vacuum_pages)
+        await asyncio.sleep(policy.pause)
+    return reclaimed
+
+
+async def apply_retention(
+    db: Pool,
+    policy: RetentionPolicy = RETENTION,
+    now: Optional[dt] = None,
+) -> Dict[str, int]:
+    '''Expire every table per `policy`, get deleted rows and reclaimed pages'''
+    now = to_epoch_us(now or dt.now())
+    resp = {}
+    for table, days in policy.tables.items():
+        if days > 0:
+            cutoff = (now - days * DAY_US) // DAY_US * DAY_US
+            resp[table] = await expire_table(db, table, cutoff, policy)
+    resp["pages"] = await reclaim_pages(db, policy)
+    return resp
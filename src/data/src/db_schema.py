@@ -0,0 +1,271 @@
+'''
+Sensors time-series schema, shared by db_server and db_sensors
+
+requirements:
+- python stdlib only
+
+```md
+Tables (schema v2)
++------------+-----------------------------------------------------------+
+| sensor_ids | id INTEGER PK, name TEXT UNIQUE: sensor name dictionary   |
+| sensors    | (sensor_id, ts) PK WITHOUT ROWID, value REAL              |
+|            | - sensor_id: sensor_ids.id                                |
+|            | - ts: INTEGER, epoch microseconds                         |
+| sensors_1m | (sensor_id, ts) PK WITHOUT ROWID, rollups of non NULL     |
+| sensors_1h | values: n, v_sum, v_min, v_max, ts_last, v_last           |
+| sensors_1d | - ts: INTEGER, bucket start, epoch microseconds           |
++------------+-----------------------------------------------------------+
+Views
++--------------+---------------------------------------------------------+
+| sensors_view | ts, sensor_id (name), value                             |
++--------------+---------------------------------------------------------+
+```
+
+The schema version is stored in `PRAGMA user_version`, `init_db` applies the
+missing migrations in order, each one in its own transaction. Databases use
+`auto_vacuum = INCREMENTAL`, legacy ones are vacuumed once to enable it.
+
+Rollups are maintained by triggers on `sensors`: inserts, late ones included,
+are folded into their buckets, updated values recompute their buckets from the
+raw rows. Deletes are not propagated, rollups outlive the raw rows.
+'''
+
+import sqlite3
+from datetime import datetime as dt, timedelta, timezone
+from typing import Callable, Dict, Union
+
+
+# ------
+# Schema
+# -----------------------------------------------------------------------------
+SCHEMA_VERSION = 2
+EPOCH          = dt(1970, 1, 1, tzinfo=timezone.utc)
+US             = timedelta(microseconds=1)
+ROLLUPS        = {  # Rollup tables buckets widths, µs
+    "1m": 60_000_000,
+    "1h": 3_600_000_000,
+    "1d": 86_400_000_000,
+}
+
+# Statements, named parameters: ts (epoch µs), sensor_id (name), value
+INSERT_SENSOR_ID = "INSERT OR IGNORE INTO sensor_ids (name) VALUES (:sensor_id)"
+INSERT_READING   = '''
+    INSERT INTO sensors (sensor_id, ts, value)
+    SELECT id, :ts, :value FROM sensor_ids WHERE name = :sensor_id
+    ON CONFLICT (sensor_id, ts) DO UPDATE SET value = excluded.value
+'''
+
+
+# -------
+# Helpers
+# -----------------------------------------------------------------------------
+def to_epoch_us(ts: Union[dt, str, int, float]) -> int:
+    '''Get epoch microseconds from a datetime, an ISO string or epoch µs
+
+    Naive datetimes are local time, as written by `dt.now()`.
+    '''
+    if isinstance(ts, (int, float)):
+        return int(ts)
+    if isinstance(ts, str):
+        ts = ts.strip()
+        if ts.lstrip("-").isdigit():
+            return int(ts)
+        ts = dt.fromisoformat(ts.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.astimezone()
+    return (ts - EPOCH) // US
+
+
+def from_epoch_us(ts: int) -> dt:
+    '''Get an UTC datetime from epoch microseconds'''
+    return EPOCH + ts * US
+
+
+def _ts_to_us(ts) -> Union[int, None]:
+    '''Legacy TEXT timestamps conversion, NULL if not parsable'''
+    try:
+        return to_epoch_us(ts)
+    except (TypeError, ValueError):
+        return None
+
+
+# ----------
+# Migrations
+# -----------------------------------------------------------------------------
+def _migrate_v1(conn: sqlite3.Connection) -> None:
+    '''Time-series tables, rewrite legacy `sensors (id, ts TEXT, ...)` rows'''
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(sensors)")]
+    is_legacy = "id" in cols
+    if is_legacy:
+        conn.execute("ALTER TABLE sensors RENAME TO sensors_legacy")
+
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS sensor_ids
+        (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )'''
+    )
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS sensors
+        (
+            sensor_id INTEGER NOT NULL REFERENCES sensor_ids (id),
+            ts INTEGER NOT NULL,
+            value REAL,
+            PRIMARY KEY (sensor_id, ts)
+        ) WITHOUT ROWID'''
+    )
+    conn.execute(
+        '''CREATE VIEW IF NOT EXISTS sensors_view AS
+        SELECT s.ts, i.name AS sensor_id, s.value
+        FROM sensors s JOIN sensor_ids i ON i.id = s.sensor_id'''
+    )
+
+    if is_legacy:
+        conn.create_function("ts_to_us", 1, _ts_to_us, deterministic=True)
+        conn.execute(
+            '''INSERT OR IGNORE INTO sensor_ids (name)
+            SELECT DISTINCT sensor_id FROM sensors_legacy
+            WHERE sensor_id IS NOT NULL'''
+        )
+        conn.execute(
+            '''INSERT INTO sensors (sensor_id, ts, value)
+            SELECT i.id, t.ts, t.value FROM (
+                SELECT sensor_id, ts_to_us(ts) AS ts, value
+                FROM sensors_legacy ORDER BY id
+            ) t JOIN sensor_ids i ON i.name = t.sensor_id
+            WHERE t.ts IS NOT NULL
+            ON CONFLICT (sensor_id, ts) DO UPDATE SET value = excluded.value'''
+        )
+        conn.execute("DROP TABLE sensors_legacy")
+
+
+def _migrate_v2(conn: sqlite3.Connection) -> None:
+    '''Rollup tables, maintained by triggers, backfilled from raw rows'''
+    on_insert = []
+    on_update = []
+    for tier, width in ROLLUPS.items():
+        t = f"sensors_{tier}"
+        conn.execute(
+            f'''CREATE TABLE IF NOT EXISTS {t}
+            (
+                sensor_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                v_sum REAL NOT NULL,
+                v_min REAL NOT NULL,
+                v_max REAL NOT NULL,
+                ts_last INTEGER NOT NULL,
+                v_last REAL NOT NULL,
+                PRIMARY KEY (sensor_id, ts)
+            ) WITHOUT ROWID'''
+        )
+        conn.execute(
+            f'''INSERT INTO {t}
+            SELECT sensor_id, ts / {width} * {width} AS b, COUNT(value),
+                SUM(value), MIN(value), MAX(value), MAX(ts), 0
+            FROM sensors WHERE value IS NOT NULL GROUP BY sensor_id, b'''
+        )
+        conn.execute(
+            f'''UPDATE {t} SET v_last = (
+                SELECT value FROM sensors s
+                WHERE s.sensor_id = {t}.sensor_id AND s.ts = {t}.ts_last
+            )'''
+        )
+
+        # Fold new points into their bucket, whatever their arrival order
+        on_insert.append(
+            f'''INSERT INTO {t} VALUES (
+                NEW.sensor_id, NEW.ts / {width} * {width}, 1,
+                NEW.value, NEW.value, NEW.value, NEW.ts, NEW.value
+            )
+            ON CONFLICT (sensor_id, ts) DO UPDATE SET
+                n       = n + 1,
+                v_sum   = v_sum + excluded.v_sum,
+                v_min   = MIN(v_min, excluded.v_min),
+                v_max   = MAX(v_max, excluded.v_max),
+                ts_last = MAX(ts_last, excluded.ts_last),
+                v_last  = CASE WHEN excluded.ts_last >= ts_last
+                    THEN excluded.v_last ELSE v_last END;'''
+        )
+        # Overwritten points: recompute their bucket, min/max may shrink
+        on_update.append(
+            f'''DELETE FROM {t} WHERE sensor_id = NEW.sensor_id
+                AND ts = NEW.ts / {width} * {width};
+            INSERT INTO {t}
+            SELECT sensor_id, ts / {width} * {width} AS b, COUNT(value),
+                SUM(value), MIN(value), MAX(value), MAX(ts), (
+                    SELECT value FROM sensors
+                    WHERE sensor_id = NEW.sensor_id
+                        AND ts >= NEW.ts / {width} * {width}
+                        AND ts < (NEW.ts / {width} + 1) * {width}
+                        AND value IS NOT NULL
+                    ORDER BY ts DESC LIMIT 1
+                )
+            FROM sensors
+            WHERE sensor_id = NEW.sensor_id
+                AND ts >= NEW.ts / {width} * {width}
+                AND ts < (NEW.ts / {width} + 1) * {width}
+                AND value IS NOT NULL
+            GROUP BY sensor_id, b;'''
+        )
+
+    conn.execute(
+        f'''CREATE TRIGGER IF NOT EXISTS sensors_rollups_insert
+        AFTER INSERT ON sensors WHEN NEW.value IS NOT NULL
+        BEGIN
+            {" ".join(on_insert)}
+        END'''
+    )
+    conn.execute(
+        f'''CREATE TRIGGER IF NOT EXISTS sensors_rollups_update
+        AFTER UPDATE OF value ON sensors WHEN OLD.value IS NOT NEW.value
+        BEGIN
+            {" ".join(on_update)}
+        END'''
+    )
+
+
+MIGRATIONS: Dict[int, Callable[[sqlite3.Connection], None]] = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+}
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db(db_path: str) -> int:
+    '''Create or migrate the database to SCHEMA_VERSION, returns the version
+
+    Params
+    - db_path: str, sqlite database file path
+    '''
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        # Incremental vacuum lets db_retention reclaim pages in small steps,
+        # only effective before the first table, or after a VACUUM
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+        while get_version(conn) < SCHEMA_VERSION:
+            # Re-read the version under the write lock, another process may
+            # have migrated in between
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                v = get_version(conn) + 1
+                if v <= SCHEMA_VERSION:
+                    MIGRATIONS[v](conn)
+                    conn.execute(f"PRAGMA user_version = {v}")
+                    print(f"Database schema migrated to v{v}: {db_path}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print(f"Database vacuum, enabling incremental vacuum: {db_path}")
+            conn.execute("VACUUM")
+        return get_version(conn)
+    finally:
+        conn.close()
@@ -1,20 +1,33 @@
 '''
 requirements:
 - aiosqlite, apscheduler, starlette
+- db_buffer, db_pool, db_schema, db_retention
+- rpi_acquisition (rpi/src), SENSORS_SOURCE sim or rpi
+
+SENSORS_SOURCE selects the sensors data:
+- random: random values, one row per sensor every JOB_SECONDS
+- sim: rpi_acquisition simulated drivers, no hardware
+- rpi: rpi_acquisition drivers of rpi/src, RPI_HAL=sim for simulated buses
 '''
 
 import asyncio
 import atexit
 import os
+import sys
 from pathlib import Path
 from datetime import datetime as dt
 from dataclasses import dataclass, field
 from random import randint, random
+from typing import List
 
-import aiosqlite
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from starlette.config import Config
 
+from db_buffer import WriteBuffer
+from db_pool import Pool
+from db_retention import RETENTION_JOB_MINUTES, apply_retention
+from db_schema import to_epoch_us
+
 
 # ------
 # Config
@@ -24,8 +37,23 @@ JOB_SECONDS = 5  # Seconds, cronjob executions
 PATH_DATA   = Path().cwd() / "bin"
 os.makedirs(PATH_DATA, exist_ok=True)
 
+# Sensors
+SENSORS_SOURCE  = CONFIG("SENSORS_SOURCE", cast=str, default="random")
+PATH_RPI_SRC    = CONFIG(
+    "PATH_RPI_SRC",
+    cast=Path,
+    default=Path(__file__).resolve().parents[2] / "rpi" / "src",
+)
+assert SENSORS_SOURCE in ("random", "sim", "rpi"), \
+    "SENSORS_SOURCE: random | sim | rpi"
+
 # Database
 DB_URL = CONFIG("DB_URL", cast=str, default="bin/data.db")
+DB     = Pool(DB_URL, readers=1)
+BUFFER = WriteBuffer(DB)
+
+# rpi_acquisition tasks, SENSORS_SOURCE sim or rpi
+ACQUISITION: List[asyncio.Task] = []
 
 
 # -------
@@ -53,27 +81,15 @@ def read_sensor_data() -> SensorsData:
 # Execution
 # -----------------------------------------------------------------------------
 async def save_sensors_data(
-    db_conn: aiosqlite.Connection,
+    buffer: WriteBuffer,
     data: SensorsData,
-) -> None:
-    d = [(data.ts, k, v) for k, v in data.__dict__.items() if k != "ts"]
-
-    async with db_conn.cursor() as c:
-        await c.execute(
-            '''CREATE TABLE IF NOT EXISTS sensors
-            (
-                id INTEGER PRIMARY KEY,
-                ts TEXT,
-                sensor_id TEXT,
-                value REAL
-            )'''
-        )
-        await c.executemany(
-            "INSERT INTO sensors (ts, sensor_id, value) VALUES (?, ?, ?)",
-            d
-        )
-
-    await db_conn.commit()
+) -> asyncio.Future:
+    ts = to_epoch_us(data.ts)
+    d  = [
+        {"ts": ts, "sensor_id": k, "value": v}
+        for k, v in data.__dict__.items() if k != "ts"
+    ]
+    return await buffer.put(d)
 
 
 async def db_job() -> None:
@@ -81,25 +97,80 @@ async def db_job() -> None:
     data    = read_sensor_data()
     data.ts = t_init
 
-    async with aiosqlite.connect(DB_URL) as db:
-        await save_sensors_data(db, data)
+    # put only queues the rows: wait for their flush, report its latency
+    fut = await save_sensors_data(BUFFER, data)
+    try:
+        await fut
+    except Exception as e:
+        print(f"db_job write failed: {e}, data: {data.__repr__()}")
+        return
+
+    stats = BUFFER.stats()
+    print(f"db_job write took {stats['flush_ms_last']:.3f}ms, "
+          f"data: {data.__repr__()}")
+    print(f"db_job buffer: {stats}")
+
+
+async def acquisition_job(simulated: bool) -> None:
+    '''Sample the rpi_acquisition sources, drain their batches into BUFFER'''
+    sys.path.insert(0, str(PATH_RPI_SRC))
+    import rpi_acquisition as acq
+
+    sources = acq.get_simulated_sources() if simulated else acq.get_sources()
+    s = acq.Scheduler(sources)
+    print(f"Starting acquisition: {s}")
+    s.start()
+    try:
+        async for rows in acq.batches(s.queue, BUFFER.batch_rows):
+            await BUFFER.put(rows)
+    finally:
+        await s.stop()
+        print(f"acquisition stopped: {s.stats()}")
+
+
+async def retention_job() -> None:
+    t_init = dt.now()
+
+    resp = await apply_retention(DB)
 
     cycle_duration = (dt.now() - t_init).total_seconds()
-    print(f"db_job took {cycle_duration:.6f}s, data: {data.__repr__()}")
+    print(f"retention_job took {cycle_duration:.6f}s, expired: {resp}")
 
 
 def cleanup():
-    print("db job stopped. io cleaned up.")
+    print(f"db job stopped. io cleaned up. buffer: {BUFFER.stats()}")
+
+
+async def shutdown() -> None:
+    for t in ACQUISITION:
+        t.cancel()
+    await asyncio.gather(*ACQUISITION, return_exceptions=True)
+    await BUFFER.stop()
+    await DB.disconnect()
 
 
 async def run() -> None:
     atexit.register(cleanup)
+    await DB.connect()
+    await BUFFER.start()
 
     job_defaults = {"max_instances": 2, "coalesce": False}
     scheduler = AsyncIOScheduler(job_defaults=job_defaults)
-    scheduler.add_job(db_job, "cron", second=f"*/{JOB_SECONDS}", args=[])
-
-    print(f"Starting db job, run every {JOB_SECONDS} seconds...")
+    if SENSORS_SOURCE == "random":
+        scheduler.add_job(db_job, "cron", second=f"*/{JOB_SECONDS}", args=[])
+    else:
+        ACQUISITION.append(asyncio.create_task(
+            acquisition_job(simulated=SENSORS_SOURCE == "sim")
+        ))
+    scheduler.add_job(
+        retention_job,
+        "interval",
+        minutes=RETENTION_JOB_MINUTES,
+        next_run_time=dt.now(),
+        max_instances=1,
+    )
+
+    print(f"Starting db job, sensors source: {SENSORS_SOURCE}...")
     scheduler.start()
 
 
@@ -109,4 +180,5 @@ if __name__ == "__main__":
         loop.create_task(run())
         loop.run_forever()
     finally:
+        loop.run_until_complete(shutdown())
         loop.close()
@@ -1,32 +1,47 @@
 '''
 requirements:
-- databases[sqlite], SQLAlchemy, starlette, uvicorn, pyyaml
+- starlette, uvicorn, pyyaml, numpy
+- db_buffer, db_hub, db_pool, db_retention, db_schema, db_wire
 '''
 
+import asyncio
+import csv
+import io
 import os
 import sys
 import json
 import logging
+import math
+import time
 from pathlib import Path
-from datetime import datetime as dt
+from dataclasses import dataclass, field
+from datetime import datetime as dt, timedelta
 from random import random, randint
-from typing import Literal
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Tuple
 
-import databases
-import sqlalchemy
+import numpy as np
 import uvicorn
 import yaml
 from starlette.applications import Starlette
 from starlette.config import Config
-from starlette.routing import Route
+from starlette.routing import Route, WebSocketRoute
 from starlette.endpoints import HTTPEndpoint
+from starlette.datastructures import QueryParams
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.schemas import SchemaGenerator
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.testclient import TestClient
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from db_buffer import WriteBuffer
+from db_hub import Hub
+from db_pool import Pool
+from db_retention import DAY_US, RETENTION
+from db_schema import ROLLUPS, to_epoch_us
+import db_wire
 
 
 # ------
@@ -39,18 +54,34 @@ os.makedirs(PATH_DATA, exist_ok=True)
 # Database
 HOST    = CONFIG("HOST",    cast=str, default="localhost")
 PORT    = CONFIG("PORT",    cast=int, default=3333)
-DB_URL  = CONFIG("DB_URL",  cast=str, default="bin/data.db")
-DB_URL  = f"sqlite:///{DB_URL}"
-DB      = databases.Database(DB_URL)
-MTA     = sqlalchemy.MetaData()
-SENSORS = sqlalchemy.Table("sensors", MTA,
-    sqlalchemy.Column("id", sqlalchemy.INTEGER, primary_key=True),
-    sqlalchemy.Column("ts", sqlalchemy.TEXT),
-    sqlalchemy.Column("sensor_id", sqlalchemy.TEXT),
-    sqlalchemy.Column("value", sqlalchemy.REAL),
-)
-ENGINE = sqlalchemy.create_engine(DB_URL)
-MTA.create_all(ENGINE)
+DB_PATH = CONFIG("DB_URL",  cast=str, default="bin/data.db")
+DB      = Pool(DB_PATH)
+BUFFER  = WriteBuffer(DB)
+BUFFER_PUT_TIMEOUT = CONFIG("BUFFER_PUT_TIMEOUT", cast=float, default=5.0)
+
+# Queries
+QUERY_LIMIT     = CONFIG("QUERY_LIMIT",     cast=int, default=1_000)
+QUERY_LIMIT_MAX = CONFIG("QUERY_LIMIT_MAX", cast=int, default=10_000)
+TS_MIN          = -(2 ** 63)
+TS_MAX          = 2 ** 63 - 1
+BUCKETS         = {  # Aggregation buckets widths, µs
+    "1m": 60_000_000,
+    "5m": 300_000_000,
+    "15m": 900_000_000,
+    "1h": 3_600_000_000,
+    "6h": 21_600_000_000,
+    "1d": 86_400_000_000,
+    "1w": 604_800_000_000,
+}
+LTTB_POINTS     = CONFIG("LTTB_POINTS", cast=int, default=500)
+LTTB_OVERSAMPLE = CONFIG("LTTB_OVERSAMPLE", cast=int, default=10)
+STREAM_CHUNK    = CONFIG("STREAM_CHUNK", cast=int, default=1_000)
+STREAM_TYPES    = {  # Accept header: streamed GET /sensors media types
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+LATEST_REFRESH  = CONFIG("LATEST_REFRESH_SECONDS", cast=float, default=1.0)
+SSE_KEEPALIVE   = CONFIG("SSE_KEEPALIVE_SECONDS", cast=float, default=15.0)
 
 # Server
 SCHEMAS = SchemaGenerator(
@@ -58,64 +89,791 @@ SCHEMAS = SchemaGenerator(
 )
 
 
+# -------
+# Queries
+# -----------------------------------------------------------------------------
+SELECT_SENSOR_KEYS = "SELECT id, name FROM sensor_ids ORDER BY id"
+SELECT_RANGE = {
+    # (sensor_id, ts) primary key range scans, one sensor per statement
+    order: f'''
+        SELECT ts, value FROM sensors
+        WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to
+        ORDER BY ts {order} LIMIT :limit
+    '''
+    for order in ("asc", "desc")
+}
+SELECT_BUCKETS = '''
+    WITH g AS (
+        SELECT ts / :width AS b, MIN(value) AS v_min, MAX(value) AS v_max,
+            AVG(value) AS v_mean, COUNT(value) AS n, MAX(ts) AS ts_last
+        FROM sensors
+        WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to
+            AND value IS NOT NULL
+        GROUP BY b ORDER BY b LIMIT :limit
+    )
+    SELECT g.b * :width AS ts, v_min, v_max, v_mean, n, s.value AS v_last
+    FROM g JOIN sensors s ON s.sensor_id = :key AND s.ts = g.ts_last
+    ORDER BY g.b
+'''
+SELECT_ROLLUP_BUCKETS = {
+    # Same rows as SELECT_BUCKETS, read from the rollup tier
+    tier: f'''
+        WITH g AS (
+            SELECT ts / :width AS b, MIN(v_min) AS v_min, MAX(v_max) AS v_max,
+                SUM(v_sum) / SUM(n) AS v_mean, SUM(n) AS n,
+                MAX(ts_last) AS ts_last
+            FROM sensors_{tier}
+            WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to
+            GROUP BY b ORDER BY b LIMIT :limit
+        )
+        SELECT g.b * :width AS ts, g.v_min, g.v_max, v_mean, g.n, r.v_last
+        FROM g JOIN sensors_{tier} r ON r.sensor_id = :key
+            AND r.ts = g.ts_last / {width} * {width}
+        ORDER BY g.b
+    '''
+    for tier, width in ROLLUPS.items()
+}
+SELECT_LATEST = '''
+    SELECT i.name, s.ts, s.value FROM sensor_ids i
+    JOIN sensors s ON s.sensor_id = i.id
+        AND s.ts = (SELECT MAX(ts) FROM sensors WHERE sensor_id = i.id)
+'''
+SELECT_ROLLUP_SERIES = {
+    # Buckets means, lttb series of the ranges read from a rollup tier
+    tier: f'''
+        SELECT ts, v_sum / n AS value FROM sensors_{tier}
+        WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to
+        ORDER BY ts
+    '''
+    for tier in ROLLUPS
+}
+SELECT_EXTENT = {
+    # First and last buckets of a sensor, bounds the lttb time range
+    tier: f'''
+        SELECT
+            (SELECT MIN(ts) FROM sensors_{tier}
+             WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to),
+            (SELECT MAX(ts) FROM sensors_{tier}
+             WHERE sensor_id = :key AND ts >= :ts_from AND ts < :ts_to)
+    '''
+    for tier in ROLLUPS
+}
+
+
+def check_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    '''Validate a POSTed row: sensor_id non-empty string, value finite real
+    number or None'''
+    sensor_id, value = row["sensor_id"], row["value"]
+    if not isinstance(sensor_id, str) or not sensor_id:
+        raise ValueError(f"sensor_id: non-empty string, got {sensor_id!r}")
+    if value is not None and (
+        not isinstance(value, (int, float)) or not math.isfinite(value)
+    ):
+        raise ValueError(f"value: real number or null, got {value!r}")
+    return row
+
+
+def _get_sensor_ids(params: QueryParams) -> List[str]:
+    '''Get sensor_id params, repeated and/or comma separated'''
+    return [i for v in params.getlist("sensor_id") for i in v.split(",") if i]
+
+
+@dataclass
+class RangeQuery:
+    """Typed GET /sensors query
+
+    Rows are sorted by sensor key then by ts (`order`), pages are resumed from
+    `cursor`: `<sensor key>:<ts>` of the last row of the previous page.
+    Streamed queries are not paged, `limit` defaults to unbounded (-1).
+
+    Params
+    - sensor_ids: List[str] = [], all sensors if empty
+    - ts_from: int          = TS_MIN, epoch µs, inclusive
+    - ts_to: int            = TS_MAX, epoch µs, exclusive
+    - limit: int            = QUERY_LIMIT
+    - cursor: (int, int)    = None
+    - order: str            = "asc" | "desc"
+    """
+    sensor_ids: List[str]               = field(default_factory=list)
+    ts_from: int                        = TS_MIN
+    ts_to: int                          = TS_MAX
+    limit: int                          = QUERY_LIMIT
+    cursor: Optional[Tuple[int, int]]   = None
+    order: Literal["asc", "desc"]       = "asc"
+
+    @classmethod
+    def from_params(
+        cls,
+        params: QueryParams,
+        stream: bool = False,
+    ) -> "RangeQuery":
+        for k in ("where", "order_by"):
+            if k in params:
+                raise ValueError(
+                    f"'{k}' is not supported, use: sensor_id, from, to, "
+                    "limit, cursor, order"
+                )
+
+        q = cls(sensor_ids=_get_sensor_ids(params))
+        if stream:
+            q.limit = -1
+        if "from" in params:
+            q.ts_from = to_epoch_us(params["from"])
+        if "to" in params:
+            q.ts_to = to_epoch_us(params["to"])
+        if "limit" in params:
+            q.limit = int(params["limit"])
+            if stream and q.limit < 1:
+                raise ValueError("limit: > 0")
+            if not stream and not 0 < q.limit <= QUERY_LIMIT_MAX:
+                raise ValueError(f"limit: range[1, {QUERY_LIMIT_MAX}]")
+        if "cursor" in params:
+            key, ts = params["cursor"].split(":")
+            q.cursor = (int(key), int(ts))
+        if "order" in params:
+            q.order = params["order"].lower()
+            if q.order not in ("asc", "desc"):
+                raise ValueError("order: asc | desc")
+        return q
+
+
+@dataclass
+class AggregateQuery:
+    """Typed GET /sensors/aggregate query
+
+    Params
+    - sensor_ids: List[str] = [], all sensors if empty
+    - ts_from: int          = TS_MIN, epoch µs, inclusive
+    - ts_to: int            = TS_MAX, epoch µs, exclusive
+    - bucket: str           = "1h", BUCKETS key
+    - mode: str             = "buckets" | "lttb"
+    - points: int           = LTTB_POINTS, lttb max points per sensor
+    - limit: int            = QUERY_LIMIT_MAX, max buckets per sensor
+    """
+    sensor_ids: List[str]               = field(default_factory=list)
+    ts_from: int                        = TS_MIN
+    ts_to: int                          = TS_MAX
+    bucket: str                         = "1h"
+    mode: Literal["buckets", "lttb"]    = "buckets"
+    points: int                         = LTTB_POINTS
+    limit: int                          = QUERY_LIMIT_MAX
+
+    @classmethod
+    def from_params(cls, params: QueryParams) -> "AggregateQuery":
+        q = cls(sensor_ids=_get_sensor_ids(params))
+        if "from" in params:
+            q.ts_from = to_epoch_us(params["from"])
+        if "to" in params:
+            q.ts_to = to_epoch_us(params["to"])
+        if "bucket" in params:
+            q.bucket = params["bucket"]
+            if q.bucket not in BUCKETS:
+                raise ValueError(f"bucket: {' | '.join(BUCKETS)}")
+        if "mode" in params:
+            q.mode = params["mode"].lower()
+            if q.mode not in ("buckets", "lttb"):
+                raise ValueError("mode: buckets | lttb")
+        if "points" in params:
+            q.points = int(params["points"])
+            if not 2 < q.points <= QUERY_LIMIT_MAX:
+                raise ValueError(f"points: range[3, {QUERY_LIMIT_MAX}]")
+        if "limit" in params:
+            q.limit = int(params["limit"])
+            if not 0 < q.limit <= QUERY_LIMIT_MAX:
+                raise ValueError(f"limit: range[1, {QUERY_LIMIT_MAX}]")
+        return q
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    '''Largest-Triangle-Three-Buckets downsampling, get the kept indices
+
+    Params
+    - x: np.ndarray, sorted
+    - y: np.ndarray
+    - n: int, max points kept, first and last points are always kept
+
+    Resources
+    - https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+    '''
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    # n - 2 buckets over x[1:-1], the last point is its own bucket
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    edges = np.append(edges, size)
+    edges[-2] = size - 1
+    counts = np.diff(edges)
+    x_avg  = np.add.reduceat(x, edges[:-1]) / counts
+    y_avg  = np.add.reduceat(y, edges[:-1]) / counts
+
+    idx = np.empty(n, dtype=np.int64)
+    idx[0], idx[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - x_avg[i + 1]) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (y_avg[i + 1] - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+async def get_sensor_keys(names: List[str] = []) -> List[Tuple[int, str]]:
+    '''Get (key, name) of the sensors names, all sensors if empty'''
+    rows = await DB.fetch_all(SELECT_SENSOR_KEYS)
+    keys = [(r["id"], r["name"]) for r in rows]
+    if names:
+        names = set(names)
+        keys  = [k for k in keys if k[1] in names]
+    return keys
+
+
+async def fetch_range(q: RangeQuery) -> Tuple[list, Optional[str]]:
+    '''Get a page of [ts, sensor_id, value] rows and the next page cursor'''
+    rows = []
+    for key, name in await get_sensor_keys(q.sensor_ids):
+        ts_from, ts_to = q.ts_from, q.ts_to
+        if q.cursor is not None:
+            if key < q.cursor[0]:
+                continue
+            if key == q.cursor[0]:
+                if q.order == "asc":
+                    ts_from = max(ts_from, q.cursor[1] + 1)
+                else:
+                    ts_to = min(ts_to, q.cursor[1])
+
+        values = {
+            "key": key,
+            "ts_from": ts_from,
+            "ts_to": ts_to,
+            "limit": q.limit - len(rows),
+        }
+        for r in await DB.fetch_all(SELECT_RANGE[q.order], values):
+            rows.append([r["ts"], name, r["value"]])
+
+        if len(rows) >= q.limit:
+            return rows, f"{key}:{rows[-1][0]}"
+    return rows, None
+
+
+async def iter_sensor(
+    key: int,
+    ts_from: int,
+    ts_to: int,
+    order: Literal["asc", "desc"] = "asc",
+    limit: int = -1,
+) -> AsyncIterator[list]:
+    '''Iterate chunks of (ts, value) rows of one sensor, -1: no limit
+
+    Keyset pages of STREAM_CHUNK rows, one short read per chunk: no reader nor
+    read transaction is held between chunks, slow clients do not block other
+    reads nor WAL checkpoints.
+    '''
+    while limit:
+        size   = STREAM_CHUNK if limit < 0 else min(STREAM_CHUNK, limit)
+        values = {"key": key, "ts_from": ts_from, "ts_to": ts_to,
+                  "limit": size}
+        rows = await DB.fetch_all(SELECT_RANGE[order], values)
+        if rows:
+            yield rows
+        if len(rows) < size:
+            break
+        if order == "asc":
+            ts_from = rows[-1]["ts"] + 1
+        else:
+            ts_to = rows[-1]["ts"]
+        if limit > 0:
+            limit -= len(rows)
+
+
+async def iter_range(q: RangeQuery) -> AsyncIterator[list]:
+    '''Iterate chunks of [ts, sensor_id, value] rows, whole range at once'''
+    n = 0
+    for key, name in await get_sensor_keys(q.sensor_ids):
+        limit  = q.limit - n if q.limit > 0 else -1
+        chunks = iter_sensor(key, q.ts_from, q.ts_to, q.order, limit)
+        async for rows in chunks:
+            n += len(rows)
+            yield [[r["ts"], name, r["value"]] for r in rows]
+        if 0 < q.limit <= n:
+            break
+
+
+async def encode_ndjson(chunks: AsyncIterator[list]) -> AsyncIterator[str]:
+    async for rows in chunks:
+        yield "".join(f"{json.dumps(r)}\n" for r in rows)
+
+
+async def encode_csv(chunks: AsyncIterator[list]) -> AsyncIterator[str]:
+    buf = io.StringIO()
+    w   = csv.writer(buf)
+    w.writerow(("ts", "sensor_id", "value"))
+    async for rows in chunks:
+        w.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def get_stream_type(r: Request) -> Optional[str]:
+    '''Get the streamed format from the Accept header, None: paged JSON'''
+    accept = r.headers.get("accept", "")
+    for k, v in STREAM_TYPES.items():
+        if v.split(";")[0] in accept:
+            return k
+    return None
+
+
+def is_kept(table: str, ts_from: int) -> bool:
+    '''Check the `table` rows from `ts_from` on are not expired by retention'''
+    days = RETENTION.tables[table]
+    now  = to_epoch_us(dt.now())
+    return not days or ts_from >= (now - days * DAY_US) // DAY_US * DAY_US
+
+
+def get_lttb_tier(ts_from: int, span: int, points: int) -> Optional[str]:
+    '''Get the finest series kept from `ts_from` on with at most
+    LTTB_OVERSAMPLE rows per point over `span` µs: None (raw rows) or a rollup
+    tier, the coarsest kept tier if none is fine enough'''
+    n     = points * LTTB_OVERSAMPLE
+    tiers = sorted(
+        [t for t in ROLLUPS if is_kept(f"sensors_{t}", ts_from)],
+        key=ROLLUPS.get,
+    )
+    if is_kept("sensors", ts_from) and span <= min(ROLLUPS.values()) * n:
+        return None
+    for t in tiers:
+        if span <= ROLLUPS[t] * n:
+            return t
+    return tiers[-1] if tiers else max(ROLLUPS, key=ROLLUPS.get)
+
+
+async def fetch_series(
+    key: int,
+    ts_from: int,
+    ts_to: int,
+    points: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''Get the (ts, value) series downsampled by lttb, not NULL values
+
+    Wide or expired ranges are read from the rollup tier buckets means, raw
+    rows are streamed by chunks, only the numpy arrays are kept.
+    '''
+    coarsest = max(ROLLUPS, key=ROLLUPS.get)
+    width    = ROLLUPS[coarsest]
+    values   = {
+        "key": key,
+        "ts_from": max(TS_MIN, ts_from // width * width),
+        "ts_to": ts_to,
+    }
+    first, last = await DB.fetch_one(SELECT_EXTENT[coarsest], values)
+    if first is None:
+        return np.empty(0, np.int64), np.empty(0, np.float64)
+
+    ts_from = max(ts_from, first)
+    span    = min(ts_to, last + width) - ts_from
+    tier    = get_lttb_tier(ts_from, span, points)
+    if tier is not None:
+        values = {"key": key, "ts_from": ts_from, "ts_to": ts_to}
+        rows   = await DB.fetch_all(SELECT_ROLLUP_SERIES[tier], values)
+        n      = len(rows)
+        return (
+            np.fromiter((r["ts"] for r in rows), np.int64, n),
+            np.fromiter((r["value"] for r in rows), np.float64, n),
+        )
+
+    ts, v = [np.empty(0, np.int64)], [np.empty(0, np.float64)]
+    async for rows in iter_sensor(key, ts_from, ts_to):
+        rows = [r for r in rows if r["value"] is not None]
+        n    = len(rows)
+        ts.append(np.fromiter((r["ts"] for r in rows), np.int64, n))
+        v.append(np.fromiter((r["value"] for r in rows), np.float64, n))
+    return np.concatenate(ts), np.concatenate(v)
+
+
+def get_rollup_tier(width: int, ts_from: int = TS_MIN) -> Optional[str]:
+    '''Get the coarsest rollup tier that can build `width` buckets and still
+    keeps the rows from `ts_from` on
+
+    Tiers expired after `ts_from` by retention are skipped for the next tier
+    that can build the width, the coarsest one if none keeps them all.
+    '''
+    tiers = [t for t, w in ROLLUPS.items() if width % w == 0]
+    kept  = [t for t in tiers if is_kept(f"sensors_{t}", ts_from)]
+    return max(kept or tiers, key=ROLLUPS.get, default=None)
+
+
+async def fetch_aggregate(q: AggregateQuery) -> Dict[str, list]:
+    '''Get buckets: [ts, min, max, mean, count, last] or lttb: [ts, value]
+    rows, by sensor_id
+
+    Buckets are read from the coarsest matching rollup tier, the time range is
+    widened to whole buckets. Lttb series are read by `fetch_series`.
+    '''
+    resp  = {}
+    width = BUCKETS[q.bucket]
+    if q.mode == "buckets":
+        q.ts_from = max(TS_MIN, q.ts_from // width * width)
+        q.ts_to   = min(TS_MAX, -(-q.ts_to // width) * width)
+    tier = get_rollup_tier(width, q.ts_from)
+
+    for key, name in await get_sensor_keys(q.sensor_ids):
+        values = {"key": key, "ts_from": q.ts_from, "ts_to": q.ts_to}
+        if q.mode == "buckets":
+            values.update(width=width, limit=q.limit)
+            query = SELECT_ROLLUP_BUCKETS.get(tier, SELECT_BUCKETS)
+            rows  = await DB.fetch_all(query, values)
+            resp[name] = [
+                [r["ts"], r["v_min"], r["v_max"], r["v_mean"], r["n"],
+                 r["v_last"]]
+                for r in rows
+            ]
+        else:
+            ts, v = await fetch_series(key, q.ts_from, q.ts_to, q.points)
+            idx   = lttb(ts.astype(np.float64), v, q.points)
+            resp[name] = list(zip(ts[idx].tolist(), v[idx].tolist()))
+    return resp
+
+
+# ------------
+# Latest cache
+# -----------------------------------------------------------------------------
+class LatestCache:
+    """
+    Last [ts, value] of every sensor, answered from memory
+
+    Committed POST rows are folded in on flush, other writers (db_sensors) are
+    picked up by a reload when `PRAGMA data_version` changed, checked at most
+    every `refresh_seconds`. `etag` changes with every update.
+
+    Params
+    - db: Pool
+    - refresh_seconds: float    = LATEST_REFRESH
+    """
+
+    def __init__(
+        self,
+        db: Pool,
+        refresh_seconds: float  = LATEST_REFRESH,
+    ) -> None:
+        self.db                 = db
+        self.refresh_seconds    = refresh_seconds
+
+        self._latest: Dict[str, list]       = {}
+        self._boot                          = time.time_ns()
+        self._version                       = 0
+        self._data_version: Optional[int]   = None
+        self._checked                       = 0.0
+        self._body: Optional[bytes]         = None
+        self._lock                          = asyncio.Lock()
+
+    def __repr__(self) -> str:
+        return f"LatestCache[{len(self._latest)} sensors, {self.etag}]"
+
+    @property
+    def etag(self) -> str:
+        return f'"{self._boot:x}-{self._version}"'
+
+    @property
+    def body(self) -> bytes:
+        '''JSON body of every sensor, serialised once per version'''
+        if self._body is None:
+            self._body = json.dumps(self._latest).encode()
+        return self._body
+
+    def get(self, names: List[str] = []) -> Dict[str, list]:
+        if not names:
+            return self._latest
+        return {k: self._latest[k] for k in names if k in self._latest}
+
+    def update(self, rows: List[Dict]) -> None:
+        '''Fold {"ts", "sensor_id", "value"} rows in, newest ts wins'''
+        changed = False
+        for r in rows:
+            last = self._latest.get(r["sensor_id"])
+            if last is None or r["ts"] >= last[0]:
+                self._latest[r["sensor_id"]] = [r["ts"], r["value"]]
+                changed = True
+        if changed:
+            self._version   += 1
+            self._body      = None
+
+    async def load(self) -> None:
+        '''Reload every sensor from the database'''
+        data_version = await self.db.data_version()
+        rows = await self.db.fetch_all(SELECT_LATEST)
+        self._latest        = {r["name"]: [r["ts"], r["value"]] for r in rows}
+        self._data_version  = data_version
+        self._version       += 1
+        self._body          = None
+
+    async def refresh(self) -> None:
+        '''Reload if another connection committed, rate limited'''
+        now = time.monotonic()
+        if now - self._checked < self.refresh_seconds:
+            return
+        async with self._lock:
+            if now - self._checked < self.refresh_seconds:
+                return
+            self._checked = now
+            if await self.db.data_version() != self._data_version:
+                await self.load()
+
+
+LATEST = LatestCache(DB)
+HUB    = Hub(DB)
+
+
+def on_committed(rows: List[Dict]) -> None:
+    '''Committed POST rows, as inserted by the buffer: latest values cache,
+    subscribers'''
+    LATEST.update(rows)
+    HUB.publish(rows)
+
+
 # ---------
 # Endpoints
 # -----------------------------------------------------------------------------
 class Sensors(HTTPEndpoint):
     async def get(self, r: Request) -> JSONResponse:
         '''
+        parameters:
+          - {name: sensor_id, in: query, schema: {type: string}}
+          - {name: from, in: query, schema: {type: string}}
+          - {name: to, in: query, schema: {type: string}}
+          - {name: limit, in: query, schema: {type: integer}}
+          - {name: cursor, in: query, schema: {type: string}}
+          - {name: order, in: query, schema: {type: string}}
         responses:
           '200':
-            description: Sensors data.
+            description: >
+              Sensors data, next page cursor in X-Next-Cursor. Accept:
+              application/x-ndjson or text/csv streams the whole range instead,
+              application/x-sensors-columnar gets the page as db_wire payload.
             example: [
-              {"ts": "2021-...", "sensor_id": "sen_01", "value": 26.1},
-              {"ts": "2021-...", "sensor_id": "sen_02", "value": 54},
-              {"ts": "2021-...", "sensor_id": "sen_03", "value": 26}
+              [1620000000000000, "sen_01", 26.1],
+              [1620000000000000, "sen_02", 54],
+              [1620000000000000, "sen_03", 26]
             ]
         '''
         try:
-            whereclause = None
-            order_by    = None
-            limit       = None
-            for k, v in r.query_params.items():
-                if k == "where":
-                    whereclause = sqlalchemy.sql.text(v)
-                elif k == "order_by":
-                    order_by = sqlalchemy.sql.text(v)
-                elif k == "limit":
-                    limit = v
-
-            q = SENSORS.select() \
-                .where(whereclause) \
-                .order_by(order_by) \
-                .limit(limit)
-            resp = []
-            for r in await DB.fetch_all(q):
-                resp.append(tuple(r))
-
-            return JSONResponse(resp, status_code=200)
+            if db_wire.WIRE_TYPE in r.headers.get("accept", ""):
+                q = RangeQuery.from_params(r.query_params)
+                resp, cursor = await fetch_range(q)
+                headers = {"X-Next-Cursor": cursor} if cursor else None
+                return Response(
+                    db_wire.encode(resp),
+                    status_code=200,
+                    headers=headers,
+                    media_type=db_wire.WIRE_TYPE,
+                )
+
+            stream = get_stream_type(r)
+            q = RangeQuery.from_params(r.query_params, stream=bool(stream))
+            if stream == "ndjson":
+                content = encode_ndjson(iter_range(q))
+            elif stream == "csv":
+                content = encode_csv(iter_range(q))
+            if stream:
+                return StreamingResponse(
+                    content,
+                    status_code=200,
+                    media_type=STREAM_TYPES[stream],
+                )
+
+            resp, cursor = await fetch_range(q)
+            headers = {"X-Next-Cursor": cursor} if cursor else None
+            return JSONResponse(resp, status_code=200, headers=headers)
         except Exception as e:
             return JSONResponse(f"{type(e).__name__}: {e}", status_code=400)
 
     async def post(self, r: Request) -> JSONResponse:
         '''
+        requestBody:
+          content:
+            application/json:
+              example: [
+                {"ts": "2021-...", "sensor_id": "sen_01", "value": 26.1},
+                {"ts": "2021-...", "sensor_id": "sen_02", "value": 54},
+                {"ts": "2021-...", "sensor_id": "sen_03", "value": 26}
+              ]
+            application/x-sensors-columnar:
+              schema: {type: string, format: binary, description: db_wire}
         responses:
-          200:
-            description: Sensors data.
-            example: [
-              {"ts": "2021-...", "sensor_id": "sen_01", "value": 26.1},
-              {"ts": "2021-...", "sensor_id": "sen_02", "value": 54},
-              {"ts": "2021-...", "sensor_id": "sen_03", "value": 26}
-            ]
+          202:
+            description: >
+              Rows count, queued in the write-behind buffer, committed within
+              BUFFER_FLUSH_SECONDS.
+          400:
+            description: >
+              Bad row: unparsable ts, sensor_id not a non-empty string, value
+              not a real number or null.
+          503:
+            description: Write-behind buffer full.
         '''
         try:
-            v = await r.json()
-            q = SENSORS.insert()
-            await DB.execute_many(query=q, values=v)
-            return JSONResponse(status_code=200)
+            content_type = r.headers.get("content-type", "")
+            if content_type.startswith(db_wire.WIRE_TYPE):
+                v = db_wire.decode(await r.body())
+            else:
+                v = [
+                    {
+                        "ts": to_epoch_us(d["ts"]),
+                        "sensor_id": d["sensor_id"],
+                        "value": d["value"],
+                    }
+                    for d in await r.json()
+                ]
+            v = [check_row(d) for d in v]
         except Exception as e:
             return JSONResponse(f"{type(e).__name__}: {e}", status_code=400)
 
+        try:
+            fut = await asyncio.wait_for(BUFFER.put(v), BUFFER_PUT_TIMEOUT)
+            fut.add_done_callback(
+                lambda f: f.cancelled() or f.exception()
+                or on_committed(f.result())
+            )
+            return JSONResponse(len(v), status_code=202)
+        except asyncio.TimeoutError:
+            return JSONResponse(f"Buffer full: {BUFFER}", status_code=503)
+
+
+async def sensors_aggregate(r: Request) -> JSONResponse:
+    '''
+    parameters:
+      - {name: sensor_id, in: query, schema: {type: string}}
+      - {name: from, in: query, schema: {type: string}}
+      - {name: to, in: query, schema: {type: string}}
+      - {name: bucket, in: query, schema: {type: string}}
+      - {name: mode, in: query, schema: {type: string, enum: [buckets, lttb]}}
+      - {name: points, in: query, schema: {type: integer}}
+      - {name: limit, in: query, schema: {type: integer}}
+    responses:
+      '200':
+        description: >
+          Sensors data by sensor_id, buckets: [ts, min, max, mean, count, last]
+          or lttb: [ts, value].
+        example: {
+          "sen_01": [[1620000000000000, 24.2, 26.1, 25.3, 720, 25.9]]
+        }
+    '''
+    try:
+        q = AggregateQuery.from_params(r.query_params)
+        return JSONResponse(await fetch_aggregate(q), status_code=200)
+    except Exception as e:
+        return JSONResponse(f"{type(e).__name__}: {e}", status_code=400)
+
+
+async def sensors_latest(r: Request) -> Response:
+    '''
+    parameters:
+      - {name: sensor_id, in: query, schema: {type: string}}
+      - {name: If-None-Match, in: header, schema: {type: string}}
+    responses:
+      '200':
+        description: Last [ts, value] by sensor_id, ETag header.
+        example: {"sen_01": [1620000000000000, 26.1]}
+      '304':
+        description: Not modified since If-None-Match.
+    '''
+    await LATEST.refresh()
+    headers = {"ETag": LATEST.etag}
+    inm = r.headers.get("if-none-match", "")
+    if inm and (inm.strip() == "*" or LATEST.etag in inm.split(", ")):
+        return Response(status_code=304, headers=headers)
+
+    names = _get_sensor_ids(r.query_params)
+    if names:
+        return JSONResponse(LATEST.get(names), status_code=200, headers=headers)
+    return Response(
+        LATEST.body,
+        status_code=200,
+        headers=headers,
+        media_type="application/json",
+    )
+
+
+async def sensors_ws(ws: WebSocket) -> None:
+    '''New rows of the `sensor_id` query params (all if none) pushed as JSON
+    text messages: [[ts, sensor_id, value], ...]'''
+    await ws.accept()
+    with HUB.subscribe(_get_sensor_ids(ws.query_params)) as sub:
+        recv = asyncio.ensure_future(ws.receive())
+        try:
+            while True:
+                get = asyncio.ensure_future(sub.get())
+                await asyncio.wait(
+                    {recv, get}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if recv.done():  # Client messages are ignored
+                    get.cancel()
+                    if recv.result()["type"] == "websocket.disconnect":
+                        break
+                    recv = asyncio.ensure_future(ws.receive())
+                    continue
+                for message in get.result():
+                    await ws.send_text(message)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            recv.cancel()
+
+
+async def sensors_sse(r: Request) -> StreamingResponse:
+    '''
+    parameters:
+      - {name: sensor_id, in: query, schema: {type: string}}
+    responses:
+      '200':
+        description: >
+          Server-sent events, new rows as JSON data: [[ts, sensor_id, value]].
+    '''
+    names = _get_sensor_ids(r.query_params)
+
+    async def events() -> AsyncIterator[str]:
+        with HUB.subscribe(names) as sub:
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    messages = await asyncio.wait_for(sub.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "".join(f"data: {m}\n\n" for m in messages)
+
+    return StreamingResponse(
+        events(),
+        status_code=200,
+        headers={"Cache-Control": "no-cache"},
+        media_type="text/event-stream",
+    )
+
+
+async def metrics(r: Request) -> JSONResponse:
+    '''
+    responses:
+      '200':
+        description: >
+          Write-behind buffer metrics, latencies in ms, subscriptions hub.
+        example: {
+          "buffer": {
+            "depth": 3, "max_rows": 10000, "flushes": 12, "flushed_rows": 36,
+            "errors": 0, "full_waits": 0, "flush_ms_last": 0.8,
+            "flush_ms_avg": 0.9, "flush_ms_max": 2.1
+          },
+          "hub": {"subscribers": 2, "published_rows": 36, "messages": 24}
+        }
+    '''
+    return JSONResponse(
+        {"buffer": BUFFER.stats(), "hub": HUB.stats()}, status_code=200
+    )
+
 
 def openapi_schema(request):
     return SCHEMAS.OpenAPIResponse(request=request)
@@ -127,9 +885,14 @@ def openapi_schema(request):
 async def on_startup() -> None:
     print("Starting db server...")
     await DB.connect()
+    await BUFFER.start()
+    await LATEST.load()
+    await HUB.start()
 
 
 async def on_shutdown() -> None:
+    await HUB.stop()
+    await BUFFER.stop()
     await DB.disconnect()
     print("DB server stopped, io cleaned up, db disconnected.")
 
@@ -138,6 +901,11 @@ APP = Starlette(
     debug=True,
     routes=[
         Route("/sensors", endpoint=Sensors, methods=["GET", "POST"]),
+        Route("/sensors/aggregate", endpoint=sensors_aggregate),
+        Route("/sensors/latest", endpoint=sensors_latest),
+        Route("/sensors/sse", endpoint=sensors_sse),
+        WebSocketRoute("/sensors/ws", endpoint=sensors_ws),
+        Route("/metrics", endpoint=metrics),
         Route("/schema", endpoint=openapi_schema, include_in_schema=False)
     ],
     middleware=[
@@ -218,27 +986,131 @@ class TestsClient:
                 self.log.error(f"err: {r.status_code}: {r.content}")
             self.log.debug(f"Sensors.get[{r.status_code}] - {r.content}")
 
-            params = {
-                "where": "sensor_id == 'sen_02'",
-                "order_by": "id desc",
-                "limit": 2
-            }
+            params = {"sensor_id": "sen_02", "order": "desc", "limit": 2}
             r = c.get("/sensors", params=params)
             if r.status_code != 200:
                 self.log.error(f"err: {r.status_code}: {r.content}")
             self.log.debug(f"Sensors.get[{r.status_code}] - {r.content}")
 
+            if "X-Next-Cursor" in r.headers:
+                params["cursor"] = r.headers["X-Next-Cursor"]
+                r = c.get("/sensors", params=params)
+                if r.status_code != 200:
+                    self.log.error(f"err: {r.status_code}: {r.content}")
+                self.log.debug(f"Sensors.get[{r.status_code}] - {r.content}")
+
+            for accept in STREAM_TYPES.values():
+                params = {"sensor_id": "sen_02", "limit": 3}
+                r = c.get("/sensors", params=params, headers={"accept": accept})
+                if r.status_code != 200:
+                    self.log.error(f"err: {r.status_code}: {r.content}")
+                self.log.debug(f"Sensors.get[{r.status_code}] - {r.content}")
+
+            params = {"sensor_id": "sen_02", "limit": 3}
+            headers = {"accept": db_wire.WIRE_TYPE}
+            r = c.get("/sensors", params=params, headers=headers)
+            if r.status_code != 200:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(
+                f"Sensors.get[{r.status_code}] - {len(r.content)} bytes - "
+                f"{db_wire.decode(r.content)}"
+            )
+
+            r = c.get("/sensors", params={"where": "1 == 1"})
+            if r.status_code != 400:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(f"Sensors.get[{r.status_code}] - {r.content}")
+
+            for params in (
+                {"sensor_id": "sen_01,sen_02", "bucket": "1m"},
+                {"sensor_id": "sen_02", "mode": "lttb", "points": 3},
+            ):
+                r = c.get("/sensors/aggregate", params=params)
+                if r.status_code != 200:
+                    self.log.error(f"err: {r.status_code}: {r.content}")
+                self.log.debug(
+                    f"SensorsAggregate.get[{r.status_code}] - {r.content}"
+                )
+
         elif test == "POST":
             body = json.dumps(self._get_sensors_inputs())
             r = c.post("/sensors", data=body)
-            if r.status_code != 200:
+            if r.status_code != 202:
                 self.log.error(f"err: {r.status_code}: {r.content}")
             self.log.debug(f"Sensors.post[{r.status_code}]")
 
+            body = db_wire.encode([
+                [to_epoch_us(d["ts"]), d["sensor_id"], d["value"]]
+                for d in self._get_sensors_inputs()
+            ])
+            headers = {"content-type": db_wire.WIRE_TYPE}
+            r = c.post("/sensors", data=body, headers=headers)
+            if r.status_code != 202:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(f"Sensors.post[{r.status_code}] - {len(body)} bytes")
+
+            with c.websocket_connect("/sensors/ws?sensor_id=sen_01") as ws:
+                body = json.dumps(self._get_sensors_inputs())
+                c.post("/sensors", data=body)
+                c.portal.call(BUFFER.flush)
+                self.log.debug(f"SensorsWs[{ws.receive_text()}]")
+
+            r = c.get("/sensors/latest")
+            if r.status_code != 200:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(f"SensorsLatest.get[{r.status_code}] - {r.content}")
+
+            headers = {"if-none-match": r.headers["etag"]}
+            r = c.get("/sensors/latest", headers=headers)
+            if r.status_code != 304:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(f"SensorsLatest.get[{r.status_code}]")
+
+            r = c.get("/metrics")
+            if r.status_code != 200:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(f"Metrics.get[{r.status_code}] - {r.content}")
+
+            # Bad rows are rejected, nothing queued
+            for bad in ({"sensor_id": None}, {"value": "abc"}):
+                body = self._get_sensors_inputs()
+                body[0].update(bad)
+                r = c.post("/sensors", data=json.dumps(body))
+                if r.status_code != 400:
+                    self.log.error(f"err: {r.status_code}: {r.content}")
+                self.log.debug(f"Sensors.post[{r.status_code}] - {r.content}")
+
+            # NULL values are skipped by the lttb series
+            body = self._get_sensors_inputs()
+            body[1]["value"] = None
+            c.post("/sensors", data=json.dumps(body))
+            c.portal.call(BUFFER.flush)
+            params = {"sensor_id": "sen_02", "mode": "lttb", "points": 3}
+            r = c.get("/sensors/aggregate", params=params)
+            if r.status_code != 200:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(
+                f"SensorsAggregate.get[{r.status_code}] - {r.content}"
+            )
+
+            # Ranges beyond the raw rows retention are read from a rollup tier
+            body = self._get_sensors_inputs()
+            body[1]["ts"] = f"{dt.now() - timedelta(days=400)}"
+            c.post("/sensors", data=json.dumps(body))
+            c.portal.call(BUFFER.flush)
+            r = c.get("/sensors/aggregate", params=params)
+            old = to_epoch_us(dt.now() - timedelta(days=RETENTION.raw_days))
+            if r.status_code != 200 or r.json()["sen_02"][0][0] > old:
+                self.log.error(f"err: {r.status_code}: {r.content}")
+            self.log.debug(
+                f"SensorsAggregate.get[{r.status_code}] - {r.content}"
+            )
+
     def run_tests(self) -> None:
-        self.test_schema()
-        self.test_endpoints("GET")
-        self.test_endpoints("POST")
+        with c:  # Runs on_startup / on_shutdown
+            self.test_schema()
+            self.test_endpoints("GET")
+            self.test_endpoints("POST")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+'''
+Sensors columnar binary wire format, POST / GET /sensors bulk payloads
+
+requirements:
+- numpy
+
+Media type `application/x-sensors-columnar`, little-endian, one payload holds
+`n_rows` rows of (ts, sensor_id, value), column by column:
+
+```md
+Layout
++------------+----------------------+------------------------------------------+
+| header     | 22 bytes             | "<4sBBBBHIq"                             |
+|            | - magic: 4s          | b"SNSR"                                  |
+|            | - version: u8        | WIRE_VERSION                             |
+|            | - idx_width: u8      | 1 | 2, sensor index bytes                |
+|            | - ts_width: u8       | 2 | 4 | 8, ts delta bytes                |
+|            | - value_width: u8    | 4 | 8, float32 | float64                 |
+|            | - n_sensors: u16     | sensor dictionary entries                |
+|            | - n_rows: u32        | rows                                     |
+|            | - ts0: i64           | epoch µs, ts reference                   |
+| dictionary | n_sensors entries    | u8 length + utf-8 sensor_id              |
+| idx        | n_rows * idx_width   | uint, dictionary index of each row       |
+| ts         | n_rows * ts_width    | int, delta from the previous row ts      |
+|            |                      | (first row: from ts0)                    |
+| value      | n_rows * value_width | float, NaN: NULL                         |
++------------+----------------------+------------------------------------------+
+```
+
+Columns use the narrowest widths holding the payload, values are float32 when
+exact or when the sender opts in (`value_width=4`, sensors resolution is far
+coarser). Rows keep their order, sorted rows give small ts deltas.
+'''
+
+import json
+import struct
+import sys
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+# ------
+# Config
+# -----------------------------------------------------------------------------
+WIRE_TYPE     = "application/x-sensors-columnar"
+WIRE_VERSION  = 1
+MAGIC         = b"SNSR"
+HEADER        = struct.Struct("<4sBBBBHIq")
+IDX_TYPES     = {1: "<u1", 2: "<u2"}
+TS_TYPES      = {2: "<i2", 4: "<i4", 8: "<i8"}
+VALUE_TYPES   = {4: "<f4", 8: "<f8"}
+
+
+# -------
+# Helpers
+# -----------------------------------------------------------------------------
+def _int_width(lo: int, hi: int, types: Dict[int, str]) -> int:
+    '''Get the narrowest `types` width holding lo..hi'''
+    for w, t in types.items():
+        info = np.iinfo(t)
+        if info.min <= lo and hi <= info.max:
+            return w
+    raise ValueError(f"Out of range for {list(types.values())}: [{lo}, {hi}]")
+
+
+# --------
+# Encoding
+# -----------------------------------------------------------------------------
+def encode(
+    rows: Iterable[Sequence[Any]],
+    value_width: Optional[int] = None,
+) -> bytes:
+    '''Encode [ts (epoch µs), sensor_id, value] rows, value None: NULL
+
+    Params
+    - rows: Iterable[Sequence[Any]]
+    - value_width: int  = None, 4 | 8, None: float32 only when exact
+    '''
+    rows  = list(rows)
+    n     = len(rows)
+    names: Dict[str, int] = {}
+    idx   = np.fromiter(
+        (names.setdefault(r[1], len(names)) for r in rows), np.int64, n
+    )
+    ts    = np.fromiter((r[0] for r in rows), np.int64, n)
+    v     = np.fromiter(
+        (np.nan if r[2] is None else r[2] for r in rows), np.float64, n
+    )
+    if len(names) > 2 ** 16 - 1:
+        raise ValueError(f"Too many sensor_ids: {len(names)}")
+
+    ts0     = int(ts[0]) if n else 0
+    deltas  = np.diff(ts, prepend=ts0)
+    idx_w   = _int_width(0, max(len(names) - 1, 0), IDX_TYPES)
+    ts_w    = _int_width(
+        int(deltas.min(initial=0)), int(deltas.max(initial=0)), TS_TYPES
+    )
+    v_w     = value_width or (4 if np.array_equal(
+        v.astype(np.float32), v, equal_nan=True
+    ) else 8)
+    if v_w not in VALUE_TYPES:
+        raise ValueError(f"value_width: {list(VALUE_TYPES)}")
+
+    parts = [HEADER.pack(MAGIC, WIRE_VERSION, idx_w, ts_w, v_w, len(names),
+                         n, ts0)]
+    for name in names:
+        b = name.encode()
+        if len(b) > 255:
+            raise ValueError(f"sensor_id longer than 255 bytes: {name}")
+        parts.append(bytes((len(b),)) + b)
+    parts.append(idx.astype(IDX_TYPES[idx_w]).tobytes())
+    parts.append(deltas.astype(TS_TYPES[ts_w]).tobytes())
+    parts.append(v.astype(VALUE_TYPES[v_w]).tobytes())
+    return b"".join(parts)
+
+
+def decode_columns(data: bytes) -> Dict[str, Any]:
+    '''Decode a payload to columns: sensor_ids (dictionary), idx, ts, value'''
+    if len(data) < HEADER.size:
+        raise ValueError(f"Payload too short: {len(data)} bytes")
+    magic, version, idx_w, ts_w, v_w, n_sensors, n, ts0 = HEADER.unpack_from(
+        data
+    )
+    if magic != MAGIC or version != WIRE_VERSION:
+        raise ValueError(f"Not a v{WIRE_VERSION} payload: {magic}, {version}")
+    if idx_w not in IDX_TYPES or ts_w not in TS_TYPES or v_w not in VALUE_TYPES:
+        raise ValueError(f"Bad widths: {idx_w}, {ts_w}, {v_w}")
+
+    pos   = HEADER.size
+    names = []
+    for _ in range(n_sensors):
+        size = data[pos]
+        names.append(data[pos + 1:pos + 1 + size].decode())
+        pos += 1 + size
+    if len(data) != pos + n * (idx_w + ts_w + v_w):
+        raise ValueError(f"Payload size mismatch: {len(data)} bytes")
+
+    idx   = np.frombuffer(data, IDX_TYPES[idx_w], n, pos)
+    pos  += n * idx_w
+    ts    = np.frombuffer(data, TS_TYPES[ts_w], n, pos)
+    pos  += n * ts_w
+    v     = np.frombuffer(data, VALUE_TYPES[v_w], n, pos)
+    if n and int(idx.max()) >= n_sensors:
+        raise ValueError("Sensor index out of the dictionary")
+    return {
+        "sensor_ids": names,
+        "idx": idx,
+        "ts": np.cumsum(ts, dtype=np.int64) + ts0,
+        "value": v.astype(np.float64),
+    }
+
+
+def decode(data: bytes) -> List[Dict[str, Any]]:
+    '''Decode a payload to {"ts", "sensor_id", "value"} rows, NaN: None'''
+    c     = decode_columns(data)
+    names = c["sensor_ids"]
+    v     = c["value"]
+    nulls = np.isnan(v)
+    value = np.where(nulls, None, v).tolist() if nulls.any() else v.tolist()
+    return [
+        {"ts": t, "sensor_id": names[i], "value": x}
+        for t, i, x in zip(c["ts"].tolist(), c["idx"].tolist(), value)
+    ]
+
+
+# ---------
+# Benchmark
+# -----------------------------------------------------------------------------
+def benchmark(n: int = 10_000) -> None:
+    '''Compare payload sizes and parse times with the JSON POST body'''
+    from datetime import datetime as dt, timedelta
+
+    t0   = dt(2021, 5, 3)
+    rows = [
+        [t0 + timedelta(seconds=i // 3), f"sen_0{i % 3 + 1}",
+         round(20 + (i % 97) / 10, 1)]
+        for i in range(n)
+    ]
+    as_json = json.dumps(
+        [{"ts": f"{t}", "sensor_id": s, "value": v} for t, s, v in rows]
+    ).encode()
+    rows_us = [
+        [(t - dt(1970, 1, 1)) // timedelta(microseconds=1), s, v]
+        for t, s, v in rows
+    ]
+    as_wire = encode(rows_us)
+    as_f4   = encode(rows_us, value_width=4)
+
+    def timeit(f, k: int = 5) -> float:
+        t = perf_counter()
+        for _ in range(k):
+            f()
+        return (perf_counter() - t) / k * 1_000
+
+    ms_json = timeit(lambda: [
+        (dt.fromisoformat(d["ts"]), d["sensor_id"], d["value"])
+        for d in json.loads(as_json)
+    ])
+    ms_wire = timeit(lambda: decode(as_wire))
+    ms_cols = timeit(lambda: decode_columns(as_wire))
+    print(f"{n} rows, parse: to rows | to columns")
+    print(f"- json:     {len(as_json):>9} bytes, {ms_json:7.2f} ms")
+    print(f"- wire:     {len(as_wire):>9} bytes, {ms_wire:7.2f} ms | "
+          f"{ms_cols:5.2f} ms")
+    print(f"- wire f4:  {len(as_f4):>9} bytes")
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1] in ("benchmark",), "arg: [benchmark]"
+    benchmark()
@@ -1,7 +1,8 @@
 import json
-from time import sleep
+from time import gmtime, sleep, time_ns
 
 import dht
+import ntptime
 from machine import Pin, idle, unique_id
 from network import WLAN, STA_IF, AP_IF
 from ubinascii import hexlify
@@ -16,6 +17,8 @@ MQTT_USER           = ""
 MQTT_PASSWORD       = ""
 SENSOR              = dht.DHT22(Pin(4))  # GPIO
 SENSOR_ERROR_VALUE  = -273.15
+# Device epoch (2000-01-01 on most ports) to unix epoch, us
+EPOCH_OFFSET_US     = 946_684_800_000_000 if gmtime(0)[0] == 2000 else 0
 
 
 def connect_to_access_point(
@@ -31,6 +34,16 @@ def connect_to_access_point(
     print(f"Connected. Network config: {sta.ifconfig()}")
 
 
+def sync_clock() -> bool:
+    """Set the RTC to UTC from NTP, readings are stamped with it"""
+    try:
+        ntptime.settime()
+        return True
+    except Exception as e:
+        print(f"Error NTP sync, readings stamped by db_mqtt: {e}")
+        return False
+
+
 def publish_sensor_data(
     sensor: dht.DHTBase = SENSOR,
     ip_address: str     = MQTT_IP_ADDRESS,
@@ -39,7 +52,8 @@ def publish_sensor_data(
     password: str       = MQTT_PASSWORD,
     keepalive: int      = 0,
     ssl: bool           = False,
-    ssl_params: any     = {}
+    ssl_params: any     = {},
+    timestamps: bool    = True,
 ) -> None:
     client_id = hexlify(unique_id())
     c = MQTTClient(
@@ -61,6 +75,9 @@ def publish_sensor_data(
 
     while True:
         data = {"temp": SENSOR_ERROR_VALUE, "rh": SENSOR_ERROR_VALUE}
+        if timestamps:
+            # Reading time, epoch us: redeliveries update the same rows
+            data["ts"] = time_ns() // 1_000 + EPOCH_OFFSET_US
         try:
             sensor.measure()
             data["temp"] = sensor.temperature()
@@ -69,7 +86,11 @@ def publish_sensor_data(
             pass
 
         print(f"Publishing sensor data: {data}")
-        c.publish(b"sen/dht", json.dumps(data, ensure_ascii=False).encode())
+        c.publish(
+            b"sen/dht",
+            json.dumps(data, ensure_ascii=False).encode(),
+            qos=1,  # Acknowledged by the broker, db_mqtt at-least-once
+        )
         sleep(1)
     # c.disconnect()
 
@@ -77,4 +98,4 @@ def publish_sensor_data(
 if __name__ == "__main__":
     WLAN(AP_IF).active(False)
     connect_to_access_point()
-    publish_sensor_data()
+    publish_sensor_data(timestamps=sync_clock())
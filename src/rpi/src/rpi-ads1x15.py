@@ -1,17 +1,50 @@
+import sys
+import threading
+import time
 from time import sleep
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-import board
-import busio
 import adafruit_ads1x15.ads1115 as ADS
+import numpy as np
 from adafruit_ads1x15.analog_in import AnalogIn
 
+import rpi_hal
 
-i2c = busio.I2C(board.SCL, board.SDA)
-ads = ADS.ADS1115(i2c)
+
+ADS1115_ADDR        = 0x48
+ADS1115_REG_CONV    = 0x00
+ADS1115_REG_CONFIG  = 0x01
+ADS1115_REG_LO      = 0x02
+ADS1115_REG_HI      = 0x03
+ADS1115_CONFIG_POR  = 0x8583    # Power-on config: single-shot, comparator off
+ADS1115_CODES       = 32_768    # Codes per +-full scale: LSB = FSR / 32_768
+ADS1115_MUX         = {  # Config MUX[14:12]: inputs
+    "P0-P1": 0, "P0-P3": 1, "P1-P3": 2, "P2-P3": 3,
+    "P0": 4, "P1": 5, "P2": 6, "P3": 7,
+}
+ADS1115_FSR         = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512,
+                       16: 0.256}  # Gain: +-V full scale
+ADS1115_PGA         = {g: i for i, g in enumerate(ADS1115_FSR)}
+ADS1115_DATA_RATES  = {8: 0, 16: 1, 32: 2, 64: 3, 128: 4, 250: 5, 475: 6,
+                       860: 7}  # Samples/s: config DR[7:5]
+ALERT_GPIO          = 22        # BCM, ALERT/RDY, open drain: pulled up
+RING_SIZE           = 4_096     # Samples per channel
+
+
+_ads: Optional[ADS.ADS1115] = None
+
+
+def get_ads() -> ADS.ADS1115:
+    """ADS1115 on i²c bus 1, opened on first use"""
+    global _ads
+    if _ads is None:
+        _ads = ADS.ADS1115(rpi_hal.board_i2c())
+    return _ads
 
 
 def test_channels() -> None:
     try:
+        ads = get_ads()
         channels = {
             # Single-ended inputs
             "Sgl-0": AnalogIn(ads, ADS.P0),
@@ -25,7 +58,9 @@ def test_channels() -> None:
             print("\nChannel\tVoltage\tValue")
             print("-------\t-------\t-----")
             for k, v in channels.items():
-                print(f"{k}\t{v.voltage:>5.3f}\t{v.value:>5} V")
+                value = v.value  # One conversion per channel
+                volts = value * ADS1115_FSR[ads.gain] / ADS1115_CODES
+                print(f"{k}\t{volts:>5.3f}\t{value:>5} V")
 
             sleep(1)
     except Exception as e:
@@ -34,7 +69,7 @@ def test_channels() -> None:
 
 def test_potentiometer(pin: int=ADS.P0, max_voltage: float=4.096) -> None:
     try:
-        c = AnalogIn(ads, pin)
+        c = AnalogIn(get_ads(), pin)
         while True:
             pct = c.voltage / max_voltage * 100
             pct = 0 if pct <= 0 else pct
@@ -44,6 +79,244 @@ def test_potentiometer(pin: int=ADS.P0, max_voltage: float=4.096) -> None:
         print(f"{e}")
 
 
+# ------
+# Stream
+# -----------------------------------------------------------------------------
+class Channel(NamedTuple):
+    """
+    ADS1115 input
+
+    Params
+    - name: str
+    - mux: str      = "P0", ADS1115_MUX: "P0".."P3", "P0-P1" differential
+    - gain: float   = 1, ADS1115_FSR
+    """
+    name: str
+    mux: str        = "P0"
+    gain: float     = 1
+
+
+class ADS1115Stream:
+    """
+    ADS1115 sampling paced by its ALERT/RDY conversion-ready interrupt
+
+    Thresholds Hi MSB 1, Lo MSB 0 set ALERT/RDY in conversion-ready mode, its
+    falling edges run a pigpio callback:
+    - 1 channel: continuous conversions, each one is read
+    - n channels: single-shot conversions chained round-robin, the callback
+      reads the finished conversion, then starts the next channel one. Mux
+      changes in continuous mode could return a conversion started on the
+      previous input, a read overlapping the next conversion could return
+      it at 100 kHz i²c and 860 SPS.
+
+    Samples are stored in preallocated per-channel rings, volts and
+    timestamps (time.monotonic at the conversion end, from pigpio ticks). A
+    watchdog restarts the conversions if no interrupt came for 0.1 s.
+
+    Params
+    - channels: List[Channel]
+    - data_rate: int    = 860, conversions/s, ADS1115_DATA_RATES
+    - alert_gpio: int   = ALERT_GPIO
+    - size: int         = RING_SIZE, samples per channel
+    - i2c_addr: int     = ADS1115_ADDR
+    - port: int         = 1, i²c bus
+    """
+
+    def __init__(
+        self,
+        channels: List[Channel],
+        data_rate: int      = 860,
+        alert_gpio: int     = ALERT_GPIO,
+        size: int           = RING_SIZE,
+        i2c_addr: int       = ADS1115_ADDR,
+        port: int           = 1,
+    ) -> None:
+        if not channels:
+            raise ValueError("No channels")
+        self.channels   = channels
+        self.data_rate  = data_rate
+        self.alert_gpio = alert_gpio
+        self.size       = size
+        self.i2c_addr   = i2c_addr
+        self.index      = {c.name: i for i, c in enumerate(channels)}
+
+        # Rings
+        self.volts      = np.zeros((len(channels), size))
+        self.times      = np.zeros((len(channels), size))
+        self.counts     = np.zeros(len(channels), np.int64)
+
+        # Metrics
+        self.errors     = 0
+        self.restarts   = 0
+
+        single_shot = len(channels) > 1
+        self._configs   = [self._config(c, single_shot) for c in channels]
+        self._lsb       = [ADS1115_FSR[c.gain] / ADS1115_CODES
+                           for c in channels]
+        self._current   = 0
+        self._lock      = threading.Lock()
+        self._running   = False
+        self._t_last    = 0.0
+        self._tick_last = 0
+        self._cb        = None
+        self._watchdog: Optional[threading.Thread] = None
+
+        self.bus        = rpi_hal.smbus.SMBus(port)
+        self._pigpio    = rpi_hal.pigpio
+        self.pi         = None  # pigpio connection, start / stop
+
+    def __repr__(self) -> str:
+        return f"ADS1115Stream[{[c.name for c in self.channels]}, " \
+            f"{self.data_rate} SPS]"
+
+    def _config(self, channel: Channel, single_shot: bool) -> int:
+        return (
+            single_shot << 15                       # OS: start
+            | ADS1115_MUX[channel.mux] << 12
+            | ADS1115_PGA[channel.gain] << 9
+            | single_shot << 8                      # MODE
+            | ADS1115_DATA_RATES[self.data_rate] << 5
+        )                                           # COMP_QUE 00: 1 conv.
+
+    def _write(self, register: int, value: int) -> None:
+        self.bus.write_i2c_block_data(self.i2c_addr, register,
+                                      [value >> 8, value & 0xFF])
+
+    def _read_conversion(self) -> int:
+        data = self.bus.read_i2c_block_data(self.i2c_addr, ADS1115_REG_CONV,
+                                            2)
+        return int.from_bytes(bytes(data), "big", signed=True)
+
+    def start(self) -> None:
+        self.pi = self._pigpio.pi()
+        self._write(ADS1115_REG_HI, 0x8000)
+        self._write(ADS1115_REG_LO, 0x0000)
+        self.pi.set_mode(self.alert_gpio, self._pigpio.INPUT)
+        self.pi.set_pull_up_down(self.alert_gpio, self._pigpio.PUD_UP)
+        self._cb = self.pi.callback(self.alert_gpio,
+                                    self._pigpio.FALLING_EDGE,
+                                    self._on_ready)
+        self._running   = True
+        self._t_last    = time.monotonic()
+        self._tick_last = self.pi.get_current_tick()
+        self._write(ADS1115_REG_CONFIG, self._configs[self._current])
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        '''Stop the conversions, power-on config and thresholds: ALERT/RDY
+        off, close the pigpio connection'''
+        self._running = False
+        if self._cb is not None:
+            self._cb.cancel()
+            self._cb = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+        with self._lock:
+            self._write(ADS1115_REG_CONFIG, ADS1115_CONFIG_POR)
+            self._write(ADS1115_REG_LO, 0x8000)
+            self._write(ADS1115_REG_HI, 0x7FFF)
+        if self.pi is not None:
+            self.pi.stop()
+            self.pi = None
+
+    def _on_ready(self, gpio: int, level: int, tick: int) -> None:
+        '''ALERT/RDY falling edge: conversion of the current channel done'''
+        with self._lock:
+            if not self._running:
+                return
+            t = self._t_last + self._pigpio.tickDiff(self._tick_last,
+                                                     tick) / 1e6
+            self._t_last, self._tick_last = t, tick
+            i = self._current
+            try:
+                code = self._read_conversion()
+                if len(self.channels) > 1:
+                    self._current = (i + 1) % len(self.channels)
+                    self._write(ADS1115_REG_CONFIG,
+                                self._configs[self._current])
+            except OSError as e:
+                self.errors += 1
+                print(f"{self} read failed: {e}")
+                return
+            n = self.counts[i] % self.size
+            self.volts[i, n] = code * self._lsb[i]
+            self.times[i, n] = t
+            self.counts[i] += 1
+
+    def _watch(self) -> None:
+        while self._running:
+            sleep(0.1)
+            with self._lock:
+                if self._running and time.monotonic() - self._t_last > 0.1:
+                    try:
+                        self._write(ADS1115_REG_CONFIG,
+                                    self._configs[self._current])
+                        self.restarts += 1
+                    except OSError as e:
+                        self.errors += 1
+                        print(f"{self} restart failed: {e}")
+                    self._t_last    = time.monotonic()
+                    self._tick_last = self.pi.get_current_tick()
+
+    def get(self, name: str, n: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        '''Last `n` samples of channel `name`, 0: ring: (times, volts)'''
+        i = self.index[name]
+        with self._lock:
+            count = int(self.counts[i])
+            n = min(n or self.size, count, self.size)
+            idx = np.arange(count - n, count) % self.size
+            return self.times[i, idx], self.volts[i, idx]
+
+    def latest(self, name: str) -> Optional[float]:
+        i = self.index[name]
+        with self._lock:
+            count = int(self.counts[i])
+            return float(self.volts[i, (count - 1) % self.size]) \
+                if count else None
+
+    def rates(self, seconds: float = 1.0) -> Dict[str, float]:
+        '''Samples/s of each channel over the last `seconds`'''
+        resp = {}
+        for c in self.channels:
+            t, _ = self.get(c.name)
+            resp[c.name] = float(np.count_nonzero(t >= t[-1] - seconds)) \
+                / seconds if len(t) else 0.0
+        return resp
+
+
+def test_stream(seconds: float = 0) -> None:
+    stream = ADS1115Stream([
+        Channel("pot", "P0", 1),
+        Channel("tds", "P1", 2/3),
+    ])
+    print(f"Starting {stream}...")
+    stream.start()
+    t_init = time.monotonic()
+    try:
+        while not seconds or time.monotonic() - t_init < seconds:
+            sleep(1)
+            rates = stream.rates()
+            print(" ".join(
+                f"{c.name}: {stream.latest(c.name):>6.3f} V "
+                f"{rates[c.name]:>5.0f}/s" for c in stream.channels
+                if stream.latest(c.name) is not None
+            ) + f", errors: {stream.errors}, restarts: {stream.restarts}")
+    finally:
+        stream.stop()
+
+
 if __name__ == "__main__":
-    # test_channels()
-    test_potentiometer()
+    mode = sys.argv[1] if len(sys.argv) > 1 else "potentiometer"
+    assert mode in ("channels", "potentiometer", "stream"), \
+        "arg: [channels|potentiometer|stream]"
+    if mode == "channels":
+        test_channels()
+    elif mode == "stream":
+        try:
+            test_stream()
+        except KeyboardInterrupt:
+            pass
+    else:
+        test_potentiometer()
@@ -1,9 +1,10 @@
 from signal import pause
 from datetime import datetime as dt
 
-import RPi.GPIO as GPIO
 from gpiozero import Button
 
+import rpi_hal
+
 
 # ------
 # Config
@@ -15,21 +16,27 @@ RELS            = (REL_IN1, REL_IN2)
 LED_IN1         = 23    # 16, GPIO 23
 LED_IN2         = 24    # 18, GPIO 24
 LEDS            = (LED_IN1, LED_IN2)
-GPIO.setmode(GPIO.BCM)  # GPIO, BCM (Broadcom SOC: GPIO numbers)
-GPIO.setup(RELS, GPIO.OUT, initial=GPIO.HIGH if INVERTED_RELAYS else GPIO.LOW)
-GPIO.setup(LEDS, GPIO.OUT, initial=GPIO.LOW)
-BTN = Button(18)
+BTN_IN          = 18    # 12, GPIO 18
+
+
+def setup_gpio() -> Button:
+    GPIO = rpi_hal.GPIO
+    GPIO.setmode(GPIO.BCM)  # GPIO, BCM (Broadcom SOC: GPIO numbers)
+    GPIO.setup(RELS, GPIO.OUT,
+               initial=GPIO.HIGH if INVERTED_RELAYS else GPIO.LOW)
+    GPIO.setup(LEDS, GPIO.OUT, initial=GPIO.LOW)
+    return Button(BTN_IN, pin_factory=rpi_hal.gpiozero_pin_factory())
 
 
 # ---------
 # Execution
 # -----------------------------------------------------------------------------
 def set_relay(i: int, s: bool) -> None:
-    GPIO.output(i, not s if INVERTED_RELAYS else s)
+    rpi_hal.GPIO.output(i, not s if INVERTED_RELAYS else s)
 
 
 def get_relay_state(i: int) -> None:
-    s = GPIO.input(i)
+    s = rpi_hal.GPIO.input(i)
     return not s if INVERTED_RELAYS else s
 
 
@@ -37,14 +44,15 @@ def alt_states() -> None:
     s = not get_relay_state(RELS[0])
     set_relay(RELS[0], s)
     set_relay(RELS[1], not s)
-    GPIO.output(LEDS[0], s)
-    GPIO.output(LEDS[1], not s)
+    rpi_hal.GPIO.output(LEDS[0], s)
+    rpi_hal.GPIO.output(LEDS[1], not s)
     print(f"{dt.now()}\tStates: [0: {s}]\t[1: {not s}]")
 
 
 def run() -> None:
-    BTN.wait_for_press()
-    BTN.when_pressed = lambda: alt_states()
+    btn = setup_gpio()
+    btn.wait_for_press()
+    btn.when_pressed = lambda: alt_states()
     pause()
 
 
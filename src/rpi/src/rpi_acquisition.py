@@ -0,0 +1,320 @@
+'''
+Multi-sensor acquisition scheduler, one asyncio timeline for every driver
+
+Blocking driver reads run in thread pool executors, one single-thread
+executor per bus: devices sharing the i²c bus are read one at a time, other
+buses (1-Wire, pigpio) are read concurrently. Samples are timestamped when
+their read starts and emitted into one asyncio queue as db_sensors rows:
+{"ts": epoch µs, "sensor_id": str, "value": float}.
+
+Usage
+- python rpi_acquisition.py sim: simulated drivers, no hardware
+- python rpi_acquisition.py hal: drivers of rpi/src on rpi_hal simulated buses
+- python rpi_acquisition.py run: drivers of rpi/src, on the RPi
+'''
+
+import asyncio
+import importlib.util
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import ModuleType
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+
+PATH_SRC            = Path(__file__).parent
+SENSOR_ERROR_VALUE  = -273.15
+QUEUE_MAX_SAMPLES   = 10_000
+
+
+# -------
+# Sources
+# -----------------------------------------------------------------------------
+@dataclass
+class Source:
+    """
+    Periodic blocking read of one device
+
+    Params
+    - name: str, sensor_id prefix
+    - read: Callable[[], Dict[str, float]], {field: value}, blocking
+    - period: float = 1.0, seconds
+    - bus: str      = "", executor group, "": own executor
+    """
+    name: str
+    read: Callable[[], Dict[str, float]]
+    period: float   = 1.0
+    bus: str        = ""
+
+    # Metrics
+    reads: int      = field(default=0, init=False)
+    errors: int     = field(default=0, init=False)
+    missed: int     = field(default=0, init=False)
+    read_ms: float  = field(default=0.0, init=False)
+
+    def __post_init__(self) -> None:
+        if self.period <= 0:
+            raise ValueError(f"{self.name}: period must be > 0")
+        self.bus = self.bus or self.name
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "reads": self.reads,
+            "errors": self.errors,
+            "missed": self.missed,
+            "read_ms": self.read_ms,
+        }
+
+
+def load_driver(file_name: str) -> ModuleType:
+    '''Import a rpi/src driver file, names like rpi_sen-dht.py included'''
+    path = PATH_SRC / file_name
+    spec = importlib.util.spec_from_file_location(path.stem.replace("-", "_"),
+                                                  path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_sources(rates: Dict[str, float] = {}) -> List[Source]:
+    '''Get the rpi/src drivers sources, `rates`: {name: period} overrides
+
+    Drivers open their rpi_hal buses on first use, drivers whose libraries
+    are not installed are skipped.
+    '''
+    sources = []
+
+    dht_mod = load_driver("rpi_sen-dht.py")
+    pi = dht_mod.rpi_hal.pigpio.pi()
+    if pi.connected:
+        dht = dht_mod.DHT(pi, 17)
+
+        def read_dht() -> Dict[str, float]:
+            r = dht.read()
+            if r.status != dht_mod.Status.ok:
+                raise IOError(f"{dht} status: {r.status}")
+            return {"temp": r.temperature, "rh": r.relative_humidity}
+        sources.append(Source("dht", read_dht, rates.get("dht", 2.0), "gpio"))
+
+    bmp388 = load_driver("rpi_sen-bmp388.py").BMP388()
+
+    def read_bmp388() -> Dict[str, float]:
+        t, p, a = bmp388.get_data()
+        return {"temp": t / 100, "press": p, "alt": a / 100}
+    sources.append(Source("bmp388", read_bmp388, rates.get("bmp388", 1.0),
+                          "i2c-1"))
+
+    ds18b20 = load_driver("rpi_sen-ds18b20.py")
+    sources.append(Source(
+        "ds18b20",
+        lambda: {"temp": ds18b20.read_ds18b20()},
+        rates.get("ds18b20", 2.0),
+        "w1",
+    ))
+
+    try:
+        tds = load_driver("rpi_sen-tds_cqr.py")
+        sources.append(Source(
+            "tds",
+            lambda: {"ppm": tds.read_tds_cqr()},
+            rates.get("tds", 1.0),
+            "i2c-1",
+        ))
+
+        tcs = load_driver("rpi_sen-tcs34725.py").get_tcs()
+        sources.append(Source(
+            "tcs34725",
+            lambda: {"lux": tcs.lux, "cct": tcs.color_temperature},
+            rates.get("tcs34725", 1.0),
+            "i2c-1",
+        ))
+    except ImportError as e:
+        print(f"tds, tcs34725 skipped: {e}")
+    return sources
+
+
+def get_simulated_sources(rates: Dict[str, float] = {}) -> List[Source]:
+    '''Get sources mimicking the rpi/src drivers values and bus latencies'''
+    state = {"temp": 21.0, "rh": 45.0, "press": 101_325.0}
+
+    def walk(k: str, step: float) -> float:
+        state[k] += random.uniform(-step, step)
+        return round(state[k], 2)
+
+    def read(latency: float, f: Callable[[], Dict[str, float]]):
+        def _read() -> Dict[str, float]:
+            time.sleep(latency)
+            return f()
+        return _read
+
+    return [
+        Source("dht", read(0.25, lambda: {
+            "temp": walk("temp", 0.1), "rh": walk("rh", 0.5)
+        }), rates.get("dht", 2.0), "gpio"),
+        Source("bmp388", read(0.004, lambda: {
+            "temp": walk("temp", 0.1), "press": walk("press", 5.0)
+        }), rates.get("bmp388", 1.0), "i2c-1"),
+        Source("ds18b20", read(0.75, lambda: {
+            "temp": walk("temp", 0.1)
+        }), rates.get("ds18b20", 2.0), "w1"),
+        Source("tds", read(0.008, lambda: {
+            "ppm": round(random.gauss(250.0, 5.0), 2)
+        }), rates.get("tds", 1.0), "i2c-1"),
+        Source("tcs34725", read(0.15, lambda: {
+            "lux": round(random.gauss(300.0, 10.0), 2),
+            "cct": round(random.gauss(5_000.0, 50.0), 2),
+        }), rates.get("tcs34725", 1.0), "i2c-1"),
+    ]
+
+
+# ---------
+# Scheduler
+# -----------------------------------------------------------------------------
+class Scheduler:
+    """
+    Samples sources at their period, one single-thread executor per bus
+
+    Reads are scheduled on absolute deadlines: a late read does not shift the
+    next ones, deadlines missed while a read was running are skipped.
+
+    Params
+    - sources: List[Source]
+    - queue: asyncio.Queue  = None, asyncio.Queue(QUEUE_MAX_SAMPLES)
+    """
+
+    def __init__(
+        self,
+        sources: List[Source],
+        queue: Optional[asyncio.Queue] = None,
+    ) -> None:
+        self.sources    = sources
+        self.queue      = queue or asyncio.Queue(QUEUE_MAX_SAMPLES)
+        self.dropped    = 0
+
+        self._executors: Dict[str, ThreadPoolExecutor] = {
+            s.bus: ThreadPoolExecutor(1, thread_name_prefix=s.bus)
+            for s in sources
+        }
+        self._tasks: List[asyncio.Task] = []
+
+    def __repr__(self) -> str:
+        return f"Scheduler[{len(self.sources)} sources, " \
+            f"buses: {list(self._executors)}]"
+
+    def stats(self) -> Dict[str, dict]:
+        resp = {s.name: s.stats() for s in self.sources}
+        resp["queue"] = {"depth": self.queue.qsize(), "dropped": self.dropped}
+        return resp
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._sample(s)) for s in self.sources
+        ]
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # In-flight bus reads finish off the event loop
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(None, e.shutdown)
+            for e in self._executors.values()
+        ))
+
+    def _emit(self, sample: Dict) -> None:
+        '''Queue a sample, drops the oldest one when full'''
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(sample)
+
+    async def _sample(self, source: Source) -> None:
+        loop     = asyncio.get_running_loop()
+        executor = self._executors[source.bus]
+
+        def read():
+            t_ns   = time.time_ns()
+            t_init = time.perf_counter()
+            values = source.read()
+            return t_ns // 1_000, values, time.perf_counter() - t_init
+
+        deadline = time.monotonic()
+        while True:
+            try:
+                ts, values, latency = await loop.run_in_executor(executor,
+                                                                 read)
+                source.reads  += 1
+                source.read_ms = latency * 1_000
+                for k, v in values.items():
+                    if v is not None and v != SENSOR_ERROR_VALUE:
+                        self._emit({
+                            "ts": ts,
+                            "sensor_id": f"{source.name}_{k}",
+                            "value": float(v),
+                        })
+            except Exception as e:
+                source.errors += 1
+                print(f"{source.name} read failed: {type(e).__name__}: {e}")
+
+            deadline += source.period
+            now = time.monotonic()
+            if now > deadline:
+                missed = int((now - deadline) // source.period) + 1
+                source.missed += missed
+                deadline += missed * source.period
+            await asyncio.sleep(deadline - now)
+
+
+async def batches(
+    queue: asyncio.Queue,
+    max_rows: int = 500,
+    max_seconds: float = 1.0,
+) -> AsyncIterator[List[Dict]]:
+    '''Iterate lists of queued samples, for db_sensors `buffer.put`'''
+    while True:
+        rows = [await queue.get()]
+        deadline = time.monotonic() + max_seconds
+        while len(rows) < max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        yield rows
+
+
+# ---------
+# Execution
+# -----------------------------------------------------------------------------
+async def run(simulated: bool, seconds: float = 0) -> None:
+    sources = get_simulated_sources() if simulated else get_sources()
+    s = Scheduler(sources)
+    print(f"Starting {s}...")
+    s.start()
+    t_init = time.monotonic()
+    try:
+        async for rows in batches(s.queue):
+            print(f"{len(rows)} samples: {[r['sensor_id'] for r in rows]}")
+            if seconds and time.monotonic() - t_init > seconds:
+                break
+    finally:
+        await s.stop()
+        print(f"{s} stopped: {s.stats()}")
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1] in ("run", "sim", "hal"), "arg: [run|sim|hal]"
+    if sys.argv[-1] == "hal":
+        import rpi_hal
+        rpi_hal.set_backend("sim")
+    try:
+        asyncio.run(run(simulated=sys.argv[-1] == "sim"))
+    except KeyboardInterrupt:
+        pass
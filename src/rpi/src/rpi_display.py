@@ -0,0 +1,482 @@
+'''
+Display compositor, declarative widgets over the SSD1306 and LCD drivers
+
+Widgets are laid out on a grid of character cells and bound to keys of the
+display values. A page is drawn once when shown, its static texts are not
+drawn again: `update` marks the widgets of the values that changed and
+`refresh` redraws the ones whose rendering changed, at most once per period
+of the display.
+
+Surfaces draw the widgets on a device:
+- LCDSurface: LCD cells, bar gauges with custom characters
+- SSD1306Surface: glyph atlas blits into the SSD1306 frame
+
+Usage
+- python rpi_display.py lcd: dashboard on the LCD
+- python rpi_display.py ssd1306: dashboard on the SSD1306
+- RPI_HAL=sim python rpi_display.py benchmark: refresh costs, simulated
+'''
+
+import random
+import sys
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from rpi_acquisition import load_driver
+
+
+REFRESH_PERIOD  = 0.2   # s, min between device refreshes
+FONT_PATH       = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+FONT_SIZE       = 12
+LCD_CHARMAP     = str.maketrans({"°": chr(0xDF), "µ": chr(0xE4)})  # ROM A00
+LCD_BAR_CHARS   = [  # CGRAM 0..4: 0..4 columns filled, 0xFF: full block
+    [(0x1F << (5 - k)) & 0x1F] * 8 for k in range(5)
+]
+
+
+# -------
+# Widgets
+# -----------------------------------------------------------------------------
+class Widget(ABC):
+    """Grid cells of a page, rendered from the value bound to `key`"""
+    col: int
+    row: int
+    width: int
+    key: str
+
+    @abstractmethod
+    def render(self, value: Any, surface: Any) -> Any:
+        '''Hashable content, drawn when it differs from the last drawn'''
+
+    def draw(self, surface: Any, content: Any) -> None:
+        surface.text(self.col, self.row, content)
+
+
+@dataclass
+class Text(Widget):
+    """
+    Static text
+
+    Params
+    - col: int
+    - row: int
+    - text: str
+    - width: int = 0, cells, 0: len(text)
+    """
+    col: int
+    row: int
+    text: str
+    width: int  = 0
+    key: str    = field(default="", init=False)
+
+    def __post_init__(self) -> None:
+        self.width = self.width or len(self.text)
+
+    def render(self, value: Any, surface: Any) -> str:
+        return self.text.ljust(self.width)[:self.width]
+
+
+@dataclass
+class Value(Widget):
+    """
+    Formatted value, label left and value right aligned
+
+    Params
+    - col: int
+    - row: int
+    - width: int, cells
+    - key: str
+    - fmt: str      = "{:.2f}"
+    - label: str    = ""
+    - unit: str     = ""
+    """
+    col: int
+    row: int
+    width: int
+    key: str
+    fmt: str    = "{:.2f}"
+    label: str  = ""
+    unit: str   = ""
+
+    def render(self, value: Any, surface: Any) -> str:
+        v = "-" if value is None else self.fmt.format(value)
+        n = max(self.width - len(self.label), 0)
+        return f"{self.label}{v + self.unit:>{n}}"[:self.width]
+
+
+@dataclass
+class Bar(Widget):
+    """
+    Bar gauge, rendered as a fill level in surface steps
+
+    Params
+    - col: int
+    - row: int
+    - width: int, cells
+    - key: str
+    - lo: float = 0.0
+    - hi: float = 100.0
+    """
+    col: int
+    row: int
+    width: int
+    key: str
+    lo: float   = 0.0
+    hi: float   = 100.0
+
+    def render(self, value: Any, surface: Any) -> int:
+        steps = self.width * surface.bar_steps
+        if value is None:
+            return 0
+        fill = (value - self.lo) / (self.hi - self.lo)
+        return round(min(max(fill, 0.0), 1.0) * steps)
+
+    def draw(self, surface: Any, content: int) -> None:
+        surface.bar(self.col, self.row, self.width, content)
+
+
+@dataclass
+class Page:
+    """
+    Params
+    - widgets: List[Widget]
+    - duration: float = 0, seconds shown before the next page, 0: stays
+    """
+    widgets: List[Widget]
+    duration: float = 0
+
+    def __post_init__(self) -> None:
+        self.by_key: Dict[str, List[int]] = {}
+        for i, w in enumerate(self.widgets):
+            if w.key:
+                self.by_key.setdefault(w.key, []).append(i)
+
+
+# --------
+# Surfaces
+# -----------------------------------------------------------------------------
+class LCDSurface:
+    """
+    LCD cells, composed by a refresh and displayed in one i²c write
+
+    A batch draws into the composed screen, its changed cells are sent by one
+    `lcd_display_screen` call on exit: a page change is not blanked first.
+
+    Params
+    - lcd: rpi_screen-lcd LCD
+    """
+    bar_steps = 5  # Pixel columns per cell
+
+    def __init__(self, lcd: Any) -> None:
+        self.lcd    = lcd
+        self.cols   = lcd.cols
+        self.rows   = lcd.rows
+        self._cells = [[" "] * self.cols for _ in range(self.rows)]
+        lcd.lcd_load_custom_chars(LCD_BAR_CHARS)
+
+    def __repr__(self) -> str:
+        return f"LCDSurface[{self.cols}x{self.rows}]"
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        yield
+        self.lcd.lcd_display_screen(["".join(r) for r in self._cells])
+
+    def clear(self) -> None:
+        '''Blank the composed cells, sent with the next batch'''
+        for r in self._cells:
+            r[:] = " " * self.cols
+
+    def text(self, col: int, row: int, text: str) -> None:
+        text = text.translate(LCD_CHARMAP)[:self.cols - col]
+        self._cells[row][col:col + len(text)] = text
+
+    def bar(self, col: int, row: int, width: int, level: int) -> None:
+        full, part = divmod(level, self.bar_steps)
+        cells = chr(0xFF) * full + (chr(part) if part else "")
+        self.text(col, row, cells.ljust(width))
+
+
+class SSD1306Surface:
+    """
+    SSD1306 frame, cells of the driver glyph atlas size, page-aligned
+
+    Texts are blitted from the glyph atlas straight into the page-ordered
+    frame, the driver only sends the columns that changed.
+
+    Params
+    - ssd1306: rpi_screen-ssd1306 SSD1306_I2C
+    - font_path: str    = FONT_PATH
+    - font_size: int    = FONT_SIZE
+    """
+
+    def __init__(
+        self,
+        ssd1306: Any,
+        font_path: str  = FONT_PATH,
+        font_size: int  = FONT_SIZE,
+    ) -> None:
+        self.ssd1306    = ssd1306
+        self.atlas      = ssd1306.load_font(font_path, font_size)
+        self.cell_w     = self.atlas.width
+        self.pages      = self.atlas.pages
+        self.cols       = ssd1306.width // self.cell_w
+        self.rows       = ssd1306.height // (8 * self.pages)
+        self.bar_steps  = self.cell_w
+
+        # Bar gauge columns: filled, empty (top and bottom lines)
+        full = np.zeros(8 * self.pages, bool)
+        full[2:-2] = True
+        empty = np.zeros_like(full)
+        empty[[2, -3]] = True
+        self._bar_full, self._bar_empty = (
+            np.packbits(c.reshape(self.pages, 8), axis=1,
+                        bitorder="little")[:, :1]
+            for c in (full, empty)
+        )
+
+    def __repr__(self) -> str:
+        return f"SSD1306Surface[{self.cols}x{self.rows}, {self.atlas}]"
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        yield
+        self.ssd1306.flush()
+
+    def clear(self) -> None:
+        self.ssd1306.frame[:] = 0
+
+    def text(self, col: int, row: int, text: str) -> None:
+        self.ssd1306.draw_text(col * self.cell_w, row * self.pages, text)
+
+    def bar(self, col: int, row: int, width: int, level: int) -> None:
+        x, page = col * self.cell_w, row * self.pages
+        cells = self.ssd1306.frame[page:page + self.pages,
+                                   x:x + width * self.cell_w]
+        cells[:] = self._bar_empty
+        cells[:, [0, -1]] = self._bar_full
+        cells[:, :level] = self._bar_full
+
+
+# -------
+# Display
+# -----------------------------------------------------------------------------
+class Display:
+    """
+    Pages of widgets on a surface
+
+    `update` stores the values and marks the changed keys, `refresh` draws
+    the widgets of the marked keys whose rendering changed, in one surface
+    batch. Refreshes closer than `period` are skipped, marks are kept.
+
+    Params
+    - surface: LCDSurface | SSD1306Surface
+    - pages: List[Page]
+    - period: float = REFRESH_PERIOD, seconds
+    """
+
+    def __init__(
+        self,
+        surface: Any,
+        pages: List[Page],
+        period: float = REFRESH_PERIOD,
+    ) -> None:
+        self.surface    = surface
+        self.pages      = pages
+        self.period     = period
+        self.values: Dict[str, Any] = {}
+        self.page       = 0
+
+        # Metrics
+        self.refreshes  = 0
+        self.draws      = 0
+
+        self._dirty: set            = set()
+        self._drawn: Dict[int, Any] = {}
+        self._shown     = False
+        self._t_page    = 0.0
+        self._t_refresh = -float("inf")
+
+    def __repr__(self) -> str:
+        return f"Display[{self.surface}, {len(self.pages)} pages]"
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for k, v in values.items():
+            if k not in self.values or self.values[k] != v:
+                self.values[k] = v
+                self._dirty.add(k)
+
+    def show(self, page: int) -> None:
+        '''Show `page` on the next refresh, every widget drawn'''
+        self.page   = page % len(self.pages)
+        self._shown = False
+
+    def refresh(self, now: Optional[float] = None) -> bool:
+        '''Draw the changes, returns True if the surface was drawn'''
+        now = time.monotonic() if now is None else now
+        if now - self._t_refresh < self.period:
+            return False
+
+        page = self.pages[self.page]
+        if self._shown and page.duration \
+                and now - self._t_page >= page.duration:
+            self.show(self.page + 1)
+            page = self.pages[self.page]
+
+        if not self._shown:
+            self.surface.clear()
+            self._drawn  = {}
+            self._t_page = now
+            self._shown  = True
+            indexes = range(len(page.widgets))
+        elif self._dirty:
+            indexes = sorted({
+                i for k in self._dirty for i in page.by_key.get(k, ())
+            })
+        else:
+            return False
+        self._dirty.clear()
+
+        drawn = False
+        with self.surface.batch():
+            for i in indexes:
+                w = page.widgets[i]
+                content = w.render(self.values.get(w.key), self.surface)
+                if i in self._drawn and self._drawn[i] == content:
+                    continue
+                w.draw(self.surface, content)
+                self._drawn[i] = content
+                self.draws += 1
+                drawn = True
+        self._t_refresh = now
+        self.refreshes += drawn
+        return drawn
+
+
+def get_dashboard(
+    cols: int,
+    rows: int,
+    keys: List[str],
+    duration: float = 3.0,
+) -> List[Page]:
+    '''Pages of `keys` values in 2 columns under a title row, then bars'''
+    w = cols // 2
+    per_page = 2 * (rows - 1)
+    pages = []
+    for i in range(0, len(keys), per_page):
+        widgets = [Text(0, 0, f"Sensors {i // per_page + 1}", cols)]
+        for j, k in enumerate(keys[i:i + per_page]):
+            widgets.append(Value(w * (j % 2), 1 + j // 2, w - 1, k,
+                                 label=f"{k}:"))
+        pages.append(Page(widgets, duration))
+
+    bars = [Text(0, 0, "Levels", cols)]
+    for j, k in enumerate(keys[:rows - 1]):
+        bars.append(Text(0, 1 + j, f"{k}:", 4))
+        bars.append(Bar(4, 1 + j, cols - 4, k, 0.0, 100.0))
+    pages.append(Page(bars, duration))
+    return pages
+
+
+# ---------
+# Execution
+# -----------------------------------------------------------------------------
+def get_surfaces() -> List[Any]:
+    '''Surfaces of the rpi/src screen drivers whose libraries are installed'''
+    surfaces = [LCDSurface(load_driver("rpi_screen-lcd.py").LCD(4, 20))]
+    try:
+        ssd1306 = load_driver("rpi_screen-ssd1306.py").SSD1306_I2C()
+        surfaces.append(SSD1306Surface(ssd1306))
+    except ImportError as e:
+        print(f"ssd1306 skipped: {e}")
+    return surfaces
+
+
+def walk(values: Dict[str, float], step: float = 0.5) -> Dict[str, float]:
+    '''Random walk of `values`, rounded as sensor readings'''
+    for k in values:
+        values[k] = round(min(max(values[k] + random.uniform(-step, step),
+                                  0.0), 100.0), 1)
+    return values
+
+
+def benchmark(seconds: float = 2.0) -> None:
+    '''Refresh costs of a 12 values dashboard, i²c transfers included'''
+    keys = [f"s{i:02d}" for i in range(12)]
+
+    for surface in get_surfaces():
+        device = getattr(surface, "lcd", None) or surface.ssd1306
+        display = Display(surface, get_dashboard(surface.cols, surface.rows,
+                                                 keys, 0), period=0)
+        values = {k: random.uniform(10, 90) for k in keys}
+        display.update(values)
+        display.refresh()
+        print(f"{display}")
+
+        def run(name: str, step) -> None:
+            n_bytes = device.bytes_sent
+            n, t_init = 0, time.perf_counter()
+            while time.perf_counter() - t_init < seconds:
+                step()
+                n += 1
+            ms = (time.perf_counter() - t_init) / n * 1_000
+            print(f"  {name:<15}: {ms:>8.3f} ms, "
+                  f"{(device.bytes_sent - n_bytes) / n:>5.0f} bytes"
+                  f" per refresh")
+
+        def stable() -> None:
+            display.update(values)
+            display.refresh()
+
+        def one_value() -> None:
+            display.update({keys[0]: round(random.uniform(10, 90), 1)})
+            display.refresh()
+
+        def changing() -> None:
+            display.update(walk(values))
+            display.refresh()
+
+        def redrawn() -> None:
+            display.update(walk(values))
+            display.show(display.page)
+            display.refresh()
+
+        run("stable values", stable)
+        run("one value", one_value)
+        run("all values", changing)
+        run("full redraw", redrawn)
+
+
+def run(device: str) -> None:
+    surfaces = get_surfaces()
+    surface = surfaces[0] if device == "lcd" else surfaces[-1]
+    keys = ["temp", "rh", "press", "tds", "lux", "cct"]
+    display = Display(surface, get_dashboard(surface.cols, surface.rows,
+                                             keys))
+    values = {k: 50.0 for k in keys}
+    print(f"Starting {display}...")
+    try:
+        while True:
+            display.update(walk(values))
+            display.refresh()
+            time.sleep(0.05)
+    finally:
+        print(f"{display}: {display.refreshes} refreshes, "
+              f"{display.draws} widgets drawn")
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1] in ("lcd", "ssd1306", "benchmark"), \
+        "arg: [lcd|ssd1306|benchmark]"
+    try:
+        if sys.argv[-1] == "benchmark":
+            benchmark()
+        else:
+            run(sys.argv[-1])
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,1107 @@
+'''
+Hardware abstraction layer: i²c, GPIO, 1-Wire and pigpio buses
+
+Drivers get their buses from here instead of importing the hardware modules,
+as `rpi_hal.smbus` like attributes looked up when used: drivers import with
+any backend, nothing is imported or opened before a driver is used. The
+backend is picked by the RPI_HAL environment variable, or `set_backend`,
+before using drivers:
+- hw: smbus2, board (blinka), RPi.GPIO, pigpio and /sys/bus/w1
+- sim: simulated buses and devices, with i²c transfer, conversion and 1-Wire
+  latencies (SIM_I2C_DEVICES, SIM_DHT_GPIOS)
+- replay: bus calls replayed from a recording
+
+hw and sim bus calls are recorded to RPI_HAL_RECORDING when set, one JSON
+line per call: {"bus", "call", "args", "kwargs", "result", "error", "s"}.
+Replay checks the calls order per bus and returns the recorded results and
+buffers, RPI_HAL_REALTIME=1 sleeps the recorded durations: drivers must
+take the recording code paths (e.g. the BMP388 soft reset on CMD_RDY).
+pigpio edges callbacks are not recorded, see the rpi_sen-dht.py replay.
+
+Usage
+- rpi_hal.GPIO, rpi_hal.pigpio, rpi_hal.smbus: RPi.GPIO, pigpio, smbus2 like
+- rpi_hal.board_i2c(): board.I2C() like, for the adafruit drivers
+- rpi_hal.w1_read("28*", "temperature"): 1-Wire sysfs file of a device
+- python rpi_hal.py benchmark: drivers and scheduler on simulated buses
+'''
+
+import builtins
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from glob import glob
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, List, Optional, TextIO, Tuple
+
+
+BACKENDS            = ("hw", "sim", "replay")
+PATH_W1             = "/sys/bus/w1/devices"
+SIM_I2C_HZ          = 100_000   # RPi default i²c clock
+SIM_W1_CONVERSION   = 0.75      # s, DS18B20 12 bits conversion
+SIM_DHT_GPIOS       = (4, 17, 27)
+SIM_DHT_RESPONSE    = 0.005     # s, frame edges delivered after the release
+SIM_ADS_ALERT_GPIO  = 22        # ADS1115 ALERT/RDY, on the SimPi
+
+
+# -------
+# Backend
+# -----------------------------------------------------------------------------
+class ReplayError(RuntimeError):
+    pass
+
+
+_backend: str                           = "hw"
+_realtime: bool                         = False
+_recording: Optional[TextIO]            = None
+_recording_lock                         = threading.Lock()
+_replaying: Dict[str, Deque[dict]]      = {}
+_resolved: Dict[str, Any]               = {}
+
+
+def set_backend(
+    backend: str,
+    recording: Optional[Path] = None,
+    realtime: bool = False,
+) -> None:
+    '''Select the buses backend, drivers imported afterwards use it
+
+    Params
+    - backend: str              = "hw" | "sim" | "replay"
+    - recording: Optional[Path] = None, hw | sim: record to, replay: from
+    - realtime: bool            = False, replay: sleep the recorded durations
+    '''
+    global _backend, _realtime, _recording, _replaying, _sim_pigpio
+
+    if backend not in BACKENDS:
+        raise ValueError(f"backend: {BACKENDS}")
+    if backend == "replay" and recording is None:
+        raise ValueError("replay: recording required")
+    if _recording is not None:
+        _recording.close()
+        _recording = None
+
+    _backend    = backend
+    _realtime   = realtime
+    _replaying  = {}
+    _resolved.clear()
+    # Simulated buses: new devices, pigpio state and pipes
+    if _sim_pigpio is not None:
+        _sim_pigpio.pi().stop()
+        _sim_pigpio = None
+    _sim_i2c.clear()
+    if recording is None:
+        return
+    if backend == "replay":
+        with open(recording, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                _replaying.setdefault(entry["bus"], deque()).append(entry)
+    else:
+        Path(recording).parent.mkdir(parents=True, exist_ok=True)
+        _recording = open(recording, "w")
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def _resolve(name: str) -> Any:
+    if name not in _resolved:
+        if _backend == "replay":
+            _resolved[name] = _replay_bus(name)
+        else:
+            bus = _hw_bus(name) if _backend == "hw" else _sim_bus(name)
+            _resolved[name] = bus if _recording is None else _record(name, bus)
+    return _resolved[name]
+
+
+def __getattr__(name: str) -> Any:
+    '''Lazy GPIO, pigpio and smbus: `rpi_hal.smbus`, resolved on access'''
+    if name in ("GPIO", "pigpio", "smbus"):
+        return _resolve(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def board_i2c() -> Any:
+    '''i²c bus 1 for the adafruit drivers, board.I2C() like'''
+    return _resolve("board_i2c")
+
+
+def w1_read(pattern: str, name: str) -> str:
+    '''Read `name` of the first 1-Wire device matching `pattern`'''
+    return _resolve("w1").read(pattern, name)
+
+
+def notify_pipe(handle: int) -> str:
+    '''Path of a pigpio notification pipe, see pigpio.pi.notify_open'''
+    if _backend == "hw":
+        return f"/dev/pigpio{handle}"
+    return _resolve("pigpio").pipe_path(handle)
+
+
+def gpiozero_pin_factory() -> Any:
+    '''gpiozero pin factory, None: gpiozero default (hardware)'''
+    if _backend == "hw":
+        return None
+    from gpiozero.pins.mock import MockFactory
+    return MockFactory()
+
+
+# --
+# hw
+# -----------------------------------------------------------------------------
+class W1:
+    """1-Wire sysfs reads"""
+
+    def read(self, pattern: str, name: str) -> str:
+        path = glob(f"{PATH_W1}/{pattern}")[0] + f"/{name}"
+        with open(path, "r") as f:
+            return f.read()
+
+
+def _hw_bus(name: str) -> Any:
+    if name == "smbus":
+        import smbus2
+        return smbus2
+    if name == "GPIO":
+        import RPi.GPIO as GPIO
+        return GPIO
+    if name == "pigpio":
+        import pigpio
+        return pigpio
+    if name == "board_i2c":
+        import board
+        return board.I2C()
+    if name == "w1":
+        return W1()
+    raise KeyError(name)
+
+
+# ---------------
+# Record / replay
+# -----------------------------------------------------------------------------
+def _dump(v: Any) -> Any:
+    if isinstance(v, (bytes, bytearray)) or hasattr(v, "__bytes__"):
+        return {"hex": bytes(v).hex()}
+    if isinstance(v, (list, tuple)):
+        return [_dump(x) for x in v]
+    if isinstance(v, dict):
+        return {k: _dump(x) for k, x in v.items()}
+    return v
+
+
+def _load(v: Any) -> Any:
+    if isinstance(v, dict):
+        if "hex" in v:
+            return bytes.fromhex(v["hex"])
+        return {k: _load(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_load(x) for x in v]
+    return v
+
+
+class Recorder:
+    """
+    Bus proxy recording its calls, buffers arguments as filled by the call
+
+    Params
+    - bus: Any
+    - name: str, recording bus name
+    """
+
+    def __init__(self, bus: Any, name: str) -> None:
+        self._bus   = bus
+        self._name  = name
+
+    def __repr__(self) -> str:
+        return f"Recorder[{self._name}]"
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._bus, attr)
+        if not callable(value) or attr.startswith("_"):
+            return value
+
+        def call(*args, **kwargs):
+            result, error = None, None
+            t_init = time.perf_counter()
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                error = e
+            entry = json.dumps({
+                "bus": self._name,
+                "call": attr,
+                "args": _dump(args),
+                "kwargs": _dump(kwargs),
+                "result": _dump(result),
+                "error": error and [type(error).__name__, str(error)],
+                "s": round(time.perf_counter() - t_init, 6),
+            })
+            with _recording_lock:
+                _recording.write(entry + "\n")
+            if error is not None:
+                raise error
+            return result
+        return call
+
+
+class ReplayBus:
+    """
+    Bus replaying the recorded calls of `name`
+
+    Params
+    - name: str
+    - template: Any = None, constants source (SimGPIO for RPi.GPIO)
+    """
+
+    def __init__(self, name: str, template: Any = None) -> None:
+        self._name      = name
+        self._template  = template
+
+    def __repr__(self) -> str:
+        return f"ReplayBus[{self._name}]"
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._template, attr, None)
+        if value is not None and not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            return self._replay(attr, args)
+        return call
+
+    def _replay(self, attr: str, args: tuple) -> Any:
+        entries = _replaying.get(self._name)
+        if not entries:
+            raise ReplayError(f"{self}: no recorded call left for {attr}")
+        entry = entries.popleft()
+        if entry["call"] != attr:
+            raise ReplayError(f"{self}: {attr} called, {entry['call']} "
+                              f"recorded")
+
+        # Fill the buffers as the recorded call did
+        for arg, recorded in zip(args, entry["args"]):
+            if isinstance(arg, bytearray):
+                arg[:] = _load(recorded)
+            elif isinstance(getattr(arg, "buf", None), bytearray):
+                arg.buf[:] = _load(recorded)
+
+        if _realtime:
+            time.sleep(entry["s"])
+        if entry["error"] is not None:
+            name, msg = entry["error"]
+            error = getattr(builtins, name, RuntimeError)
+            raise (error if isinstance(error, type) else RuntimeError)(msg)
+        return _load(entry["result"])
+
+
+def _record(name: str, bus: Any) -> Any:
+    if name == "smbus":
+        def SMBus(bus_id: int = 1) -> Recorder:
+            return Recorder(bus.SMBus(bus_id), f"i2c-{bus_id}")
+        return SimpleNamespace(SMBus=SMBus, i2c_msg=bus.i2c_msg)
+    if name == "pigpio":
+        return bus  # edges callbacks: not recorded
+    return Recorder(bus, {"board_i2c": "i2c-1"}.get(name, name.lower()))
+
+
+def _replay_bus(name: str) -> Any:
+    if name == "smbus":
+        return SimpleNamespace(
+            SMBus=lambda bus_id=1: ReplayBus(f"i2c-{bus_id}"),
+            i2c_msg=SimI2CMsg,
+        )
+    if name == "pigpio":
+        return _sim_bus("pigpio")
+    if name == "GPIO":
+        return ReplayBus("gpio", SimGPIO)
+    return ReplayBus({"board_i2c": "i2c-1"}.get(name, name))
+
+
+# -----------
+# Sim devices
+# -----------------------------------------------------------------------------
+class SimDevice:
+    """
+    i²c register map device, auto-incremented register pointer
+
+    A write sets the pointer to its first byte and writes the next ones from
+    it, a read reads from the pointer. `update(reg, n)` refreshes registers
+    before a read, `on_write(reg, data)` handles writes side effects.
+    """
+
+    def __init__(self) -> None:
+        self.regs       = bytearray(256)
+        self.pointer    = 0
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}[{self.pointer:#04x}]"
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.pointer = data[0]
+            if len(data) > 1:
+                self.regs[self.pointer:self.pointer + len(data) - 1] = data[1:]
+                self.on_write(self.pointer, bytes(data[1:]))
+
+    def read(self, n: int) -> bytes:
+        self.update(self.pointer, n)
+        return bytes(self.regs[self.pointer:self.pointer + n])
+
+    def update(self, reg: int, n: int) -> None:
+        pass
+
+    def on_write(self, reg: int, data: bytes) -> None:
+        pass
+
+
+class SimBMP388(SimDevice):
+    """BMP388 at ~21°C, ~1_000 hPa: data, calibration and FIFO registers"""
+    CALIBRATION = (27_846, 19_290, -7, -1_212, -3_326, 35, 0, 25_340, 30_440,
+                   3, -6, 16_235, -5, 21)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.regs[0x00]         = 0x50  # chip id
+        self.regs[0x03]         = 0x70  # cmd_rdy, drdy_press, drdy_temp
+        self.regs[0x31:0x46]    = struct.pack("<HHbhhbbHHbbhbb",
+                                              *self.CALIBRATION)
+        self.adc_T      = 8_300_000.0
+        self.adc_P      = 6_500_000.0
+        self._fifo_t: Optional[float] = None
+
+    def _sample(self) -> Tuple[bytes, bytes]:
+        self.adc_T += random.uniform(-200, 200)
+        self.adc_P += random.uniform(-500, 500)
+        return (
+            int(self.adc_T).to_bytes(3, "little"),
+            int(self.adc_P).to_bytes(3, "little"),
+        )
+
+    @property
+    def _fifo_period(self) -> float:
+        return 2 ** (self.regs[0x18] & 0x07) / (200 / 2 ** self.regs[0x1D])
+
+    def _fifo_frames(self) -> int:
+        if self._fifo_t is None:
+            return 0
+        n = int((time.monotonic() - self._fifo_t) / self._fifo_period)
+        return min(n, 512 // 7)
+
+    def on_write(self, reg: int, data: bytes) -> None:
+        fifo_on = self.regs[0x17] & 0x01
+        if reg == 0x17 or (reg == 0x7E and data[0] == 0xB0):
+            self._fifo_t = time.monotonic() if fifo_on else None
+
+    def update(self, reg: int, n: int) -> None:
+        if reg == 0x04:
+            t, p = self._sample()
+            self.regs[0x04:0x0A] = p + t
+        elif reg == 0x12:
+            length = self._fifo_frames() * 7
+            self.regs[0x12:0x14] = length.to_bytes(2, "little")
+
+    def read(self, n: int) -> bytes:
+        if self.pointer != 0x14:
+            return super().read(n)
+
+        # FIFO data: temperature + pressure frames, then empty frames
+        frames = min(n // 7, self._fifo_frames())
+        if frames:
+            self._fifo_t += frames * self._fifo_period
+        data = b"".join(b"\x94" + b"".join(self._sample())
+                        for _ in range(frames))
+        return data + b"\x80" * (n - len(data))
+
+
+class SimADS1115(SimDevice):
+    """
+    ADS1115 ADC, 16 bits big-endian registers: conversion, config, thresholds
+
+    Conversions are latched at their end: the conversion register holds the
+    previous result meanwhile. ALERT/RDY, in conversion-ready mode, drives
+    `alert_gpio` of the SimPi: high during single-shot conversions, an 8 µs
+    low pulse per continuous conversion.
+
+    Params
+    - volts: Dict[int, float]   = None, AIN0..AIN3 voltages
+    - alert_gpio: int           = SIM_ADS_ALERT_GPIO
+    """
+    DATA_RATES  = (8, 16, 32, 64, 128, 250, 475, 860)
+    FSR         = (6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256)
+
+    def __init__(
+        self,
+        volts: Optional[Dict[int, float]] = None,
+        alert_gpio: int = SIM_ADS_ALERT_GPIO,
+    ) -> None:
+        super().__init__()
+        self.volts      = volts or {0: 1.65, 1: 0.9, 2: 0.5, 3: 3.0}
+        self.alert_gpio = alert_gpio
+        self.config     = 0x8583
+        self.lo_thresh  = 0x8000
+        self.hi_thresh  = 0x7FFF
+        self._ready_at  = 0.0
+        self._result    = 0
+        self._pending: Optional[int] = None
+        self._continuous: Optional[threading.Thread] = None
+
+    @property
+    def conversion_time(self) -> float:
+        return 1 / self.DATA_RATES[(self.config >> 5) & 0x07]
+
+    @property
+    def conversion_ready(self) -> bool:
+        '''ALERT/RDY mode: Hi_thresh MSB 1, Lo_thresh MSB 0, comparator on'''
+        return bool(self.hi_thresh & 0x8000) \
+            and not self.lo_thresh & 0x8000 and self.config & 0x03 != 0x03
+
+    def _alert(self, level: int) -> None:
+        if self.conversion_ready:
+            pi = _sim_bus("pigpio").pi()
+            pi._set_level(self.alert_gpio, level, pi.get_current_tick())
+
+    def _latch(self, done: bool = False) -> None:
+        if self._pending is not None \
+                and (done or time.monotonic() >= self._ready_at):
+            self._result, self._pending = self._pending, None
+
+    def _converted(self) -> None:
+        self._latch(done=True)
+        self._alert(0)
+
+    def _run_continuous(self) -> None:
+        while not self.config & 0x0100:
+            time.sleep(self.conversion_time)
+            self._result = self._conversion()
+            self._alert(0)
+            self._alert(1)
+        self._continuous = None
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        self.pointer = data[0] & 0x03
+        if len(data) < 3:
+            return
+        value = (data[1] << 8) | data[2]
+        if self.pointer == 1:
+            self.config = value & 0x7FFF
+            if not value & 0x0100:  # continuous
+                if self._continuous is None:
+                    self._continuous = threading.Thread(
+                        target=self._run_continuous, daemon=True
+                    )
+                    self._continuous.start()
+            elif value & 0x8000:  # single-shot start
+                self._latch()
+                self._pending  = self._conversion()
+                self._ready_at = time.monotonic() + self.conversion_time
+                self._alert(1)
+                threading.Timer(self.conversion_time,
+                                self._converted).start()
+        elif self.pointer == 2:
+            self.lo_thresh = value
+        elif self.pointer == 3:
+            self.hi_thresh = value
+
+    def _conversion(self) -> int:
+        mux = (self.config >> 12) & 0x07
+        pos, neg = ((0, 1), (0, 3), (1, 3), (2, 3))[mux] if mux < 4 \
+            else (mux - 4, None)
+        v = self.volts[pos] - (self.volts[neg] if neg is not None else 0.0)
+        v += random.gauss(0, 0.0005)
+        code = int(v / self.FSR[(self.config >> 9) & 0x07] * 32_768)
+        return max(-32_768, min(32_767, code)) & 0xFFFF
+
+    def read(self, n: int) -> bytes:
+        if self.pointer == 0:
+            self._latch()
+            value = self._result
+        elif self.pointer == 1:
+            ready = time.monotonic() >= self._ready_at
+            value = self.config | (0x8000 if ready else 0)
+        else:
+            value = self.lo_thresh if self.pointer == 2 else self.hi_thresh
+        return value.to_bytes(2, "big")[:n]
+
+
+class SimTCS34725(SimDevice):
+    """TCS34725 color sensor, command bit registers, RGBC after ATIME"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.regs[0x01]     = 0xFF  # ATIME: 2.4 ms
+        self.regs[0x12]     = 0x44  # id
+        self._enabled_at    = 0.0
+
+    def write(self, data: bytes) -> None:
+        if data:
+            data = bytes((data[0] & 0x1F,)) + bytes(data[1:])
+        super().write(data)
+
+    def on_write(self, reg: int, data: bytes) -> None:
+        if reg == 0x00 and data[0] & 0x02:  # AEN
+            self._enabled_at = time.monotonic()
+
+    def update(self, reg: int, n: int) -> None:
+        integration = (256 - self.regs[0x01]) * 0.0024
+        valid = time.monotonic() - self._enabled_at >= integration
+        self.regs[0x13] = 0x11 if valid else 0x10
+        scale = (256 - self.regs[0x01]) * 4
+        for i, level in enumerate((1.0, 0.45, 0.35, 0.25)):  # C, R, G, B
+            value = int(min(65_535, scale * level * random.gauss(1.0, 0.01)))
+            self.regs[0x14 + 2 * i:0x16 + 2 * i] = value.to_bytes(2, "little")
+
+
+class SimSSD1306(SimDevice):
+    """SSD1306 OLED, counts command and GDDRAM data bytes"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.commands   = 0
+        self.data_bytes = 0
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        if data[0] & 0x40:
+            self.data_bytes += len(data) - 1
+        else:
+            self.commands += len(data) - 1
+
+
+class SimPCF8574(SimDevice):
+    """PCF8574 i/o expander, HD44780 LCD backpack: port writes"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.port   = 0
+        self.writes = 0
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.port    = data[-1]
+            self.writes += len(data)
+
+    def read(self, n: int) -> bytes:
+        return bytes((self.port,)) * n
+
+
+def get_sim_devices() -> Dict[int, SimDevice]:
+    '''Default simulated i²c devices, by address'''
+    return {
+        0x76: SimBMP388(),
+        0x48: SimADS1115(),
+        0x29: SimTCS34725(),
+        0x3C: SimSSD1306(),
+        0x27: SimPCF8574(),
+    }
+
+
+# -------
+# Sim i²c
+# -----------------------------------------------------------------------------
+class SimI2CMsg:
+    """smbus2.i2c_msg stand-in"""
+    READ = 0x0001
+
+    def __init__(self, addr: int, flags: int, buf: bytearray) -> None:
+        self.addr   = addr
+        self.flags  = flags
+        self.buf    = buf
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.buf)
+
+    def __iter__(self):
+        return iter(self.buf)
+
+    def __len__(self) -> int:
+        return len(self.buf)
+
+    @classmethod
+    def read(cls, address: int, length: int) -> "SimI2CMsg":
+        return cls(address, cls.READ, bytearray(length))
+
+    @classmethod
+    def write(cls, address: int, buf) -> "SimI2CMsg":
+        if isinstance(buf, str):
+            buf = buf.encode()
+        return cls(address, 0, bytearray(buf))
+
+
+class SimI2C:
+    """
+    Simulated i²c bus, smbus2.SMBus and busio.I2C methods
+
+    Transactions are serialised and take their transfer time at `hz`: 9
+    clocks per byte, address bytes included. Missing devices raise
+    OSError 121, as a NACK does.
+
+    Params
+    - devices: Dict[int, SimDevice]
+    - hz: int = SIM_I2C_HZ
+    """
+
+    def __init__(
+        self,
+        devices: Dict[int, SimDevice],
+        hz: int = SIM_I2C_HZ,
+    ) -> None:
+        self.devices        = devices
+        self.hz             = hz
+        self.transactions   = 0
+        self._lock          = threading.RLock()
+
+    def __repr__(self) -> str:
+        return f"SimI2C[{[f'{a:#04x}' for a in self.devices]}]"
+
+    def _device(self, address: int, n_bytes: int, n_starts: int = 1):
+        time.sleep((n_bytes + n_starts) * 9 / self.hz)
+        self.transactions += 1
+        device = self.devices.get(address)
+        if device is None:
+            raise OSError(121, "Remote I/O error")
+        return device
+
+    # smbus2
+    def read_byte(self, address: int) -> int:
+        with self._lock:
+            return self._device(address, 1).read(1)[0]
+
+    def write_byte(self, address: int, value: int) -> None:
+        with self._lock:
+            self._device(address, 1).write(bytes((value,)))
+
+    def read_byte_data(self, address: int, register: int) -> int:
+        return self.read_i2c_block_data(address, register, 1)[0]
+
+    def write_byte_data(self, address: int, register: int, value: int):
+        self.write_i2c_block_data(address, register, [value])
+
+    def read_word_data(self, address: int, register: int) -> int:
+        d = self.read_i2c_block_data(address, register, 2)
+        return d[0] | d[1] << 8
+
+    def write_word_data(self, address: int, register: int, value: int):
+        self.write_i2c_block_data(address, register,
+                                  [value & 0xFF, value >> 8])
+
+    def read_i2c_block_data(
+        self,
+        address: int,
+        register: int,
+        length: int,
+    ) -> List[int]:
+        with self._lock:
+            device = self._device(address, 1 + length, 2)
+            device.write(bytes((register,)))
+            return list(device.read(length))
+
+    def write_i2c_block_data(
+        self,
+        address: int,
+        register: int,
+        data: List[int],
+    ) -> None:
+        with self._lock:
+            self._device(address, 1 + len(data)).write(
+                bytes((register, *data))
+            )
+
+    def write_block_data(self, address: int, register: int, data: List[int]):
+        self.write_i2c_block_data(address, register, [len(data), *data])
+
+    def read_block_data(self, address: int, register: int) -> List[int]:
+        with self._lock:
+            device = self._device(address, 2, 2)
+            device.write(bytes((register,)))
+            n = device.read(1)[0]
+            return list(device.read(1 + n)[1:])
+
+    def i2c_rdwr(self, *msgs: SimI2CMsg) -> None:
+        with self._lock:
+            for m in msgs:
+                device = self._device(m.addr, len(m.buf))
+                if m.flags & SimI2CMsg.READ:
+                    m.buf[:] = device.read(len(m.buf))
+                else:
+                    device.write(bytes(m.buf))
+
+    def close(self) -> None:
+        pass
+
+    # busio
+    def try_lock(self) -> bool:
+        return True
+
+    def unlock(self) -> None:
+        pass
+
+    def deinit(self) -> None:
+        pass
+
+    def scan(self) -> List[int]:
+        return sorted(self.devices)
+
+    def writeto(
+        self,
+        address: int,
+        buffer: bytes,
+        *,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> None:
+        data = bytes(buffer[start:end])
+        with self._lock:
+            self._device(address, len(data)).write(data)
+
+    def readfrom_into(
+        self,
+        address: int,
+        buffer: bytearray,
+        *,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> None:
+        end = len(buffer) if end is None else end
+        with self._lock:
+            buffer[start:end] = self._device(address, end - start).read(
+                end - start
+            )
+
+    def writeto_then_readfrom(
+        self,
+        address: int,
+        buffer_out: bytes,
+        buffer_in: bytearray,
+        *,
+        out_start: int = 0,
+        out_end: Optional[int] = None,
+        in_start: int = 0,
+        in_end: Optional[int] = None,
+    ) -> None:
+        data   = bytes(buffer_out[out_start:out_end])
+        in_end = len(buffer_in) if in_end is None else in_end
+        with self._lock:
+            device = self._device(address, len(data) + in_end - in_start, 2)
+            device.write(data)
+            buffer_in[in_start:in_end] = device.read(in_end - in_start)
+
+
+_sim_i2c: Dict[int, SimI2C] = {}
+
+
+def get_sim_i2c(bus_id: int = 1) -> SimI2C:
+    '''Simulated i²c bus `bus_id`, shared by its SMBus / busio users'''
+    if bus_id not in _sim_i2c:
+        _sim_i2c[bus_id] = SimI2C(get_sim_devices())
+    return _sim_i2c[bus_id]
+
+
+# ------------------------
+# Sim GPIO, 1-Wire, pigpio
+# -----------------------------------------------------------------------------
+class SimGPIO:
+    """RPi.GPIO stand-in: pins levels, pulled-up inputs read high"""
+    BCM, BOARD                  = 11, 10
+    OUT, IN                     = 0, 1
+    LOW, HIGH                   = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP   = 20, 21, 22
+    RISING, FALLING, BOTH       = 31, 32, 33
+
+    def __init__(self) -> None:
+        self.mode: Optional[int]        = None
+        self.levels: Dict[int, int]     = {}
+        self.directions: Dict[int, int] = {}
+
+    @staticmethod
+    def _channels(channel) -> List[int]:
+        return list(channel) if isinstance(channel, (list, tuple)) \
+            else [channel]
+
+    def setmode(self, mode: int) -> None:
+        self.mode = mode
+
+    def getmode(self) -> Optional[int]:
+        return self.mode
+
+    def setwarnings(self, flag: bool) -> None:
+        pass
+
+    def setup(
+        self,
+        channel,
+        direction: int,
+        pull_up_down: int = PUD_OFF,
+        initial: int = -1,
+    ) -> None:
+        for c in self._channels(channel):
+            self.directions[c] = direction
+            if direction == self.OUT:
+                self.levels[c] = max(initial, 0)
+            else:
+                self.levels[c] = int(pull_up_down == self.PUD_UP)
+
+    def input(self, channel: int) -> int:
+        return self.levels.get(channel, 0)
+
+    def output(self, channel, value) -> None:
+        channels = self._channels(channel)
+        values   = self._channels(value) * (1 if isinstance(
+            value, (list, tuple)
+        ) else len(channels))
+        for c, v in zip(channels, values):
+            self.levels[c] = int(bool(v))
+
+    def cleanup(self, channel=None) -> None:
+        for c in self._channels(channel) if channel is not None \
+                else list(self.levels):
+            self.levels.pop(c, None)
+            self.directions.pop(c, None)
+
+    def set_input(self, channel: int, level: int) -> None:
+        '''Drive an input pin level, tests'''
+        self.levels[channel] = level
+
+
+class SimW1:
+    """1-Wire DS18B20 at ~21°C, a read takes its conversion time"""
+
+    def read(self, pattern: str, name: str) -> str:
+        time.sleep(SIM_W1_CONVERSION)
+        return f"{round(random.gauss(21_000, 50))}\n"
+
+
+def dht_phases(
+    temperature: float,
+    relative_humidity: float,
+) -> List[Tuple[int, int]]:
+    '''DHTXX reading (level, µs held): start pulse, response, 40 bits, end'''
+    t = round(abs(temperature) * 10) | (0x8000 if temperature < 0 else 0)
+    h = round(relative_humidity * 10)
+    b = [t & 0xFF, t >> 8, h & 0xFF, h >> 8]
+    data = (sum(b) & 0xFF) + (b[0] << 8) + (b[1] << 16) + (b[2] << 24) \
+        + (b[3] << 32)
+    phases = [(0, 18_000), (1, 30), (0, 80), (1, 80)]
+    for i in range(39, -1, -1):
+        phases += [(0, 50), (1, 70 if (data >> i) & 1 else 26)]
+    return phases + [(0, 50), (1, 0)]
+
+
+def tick_diff(t1: int, t2: int) -> int:
+    return (t2 - t1) & 0xFFFF_FFFF
+
+
+class SimPi:
+    """
+    pigpio.pi stand-in: levels, edges callbacks and notification pipes
+
+    DHT22 sensors answer on SIM_DHT_GPIOS: once their start pulse released,
+    the frame edges are delivered SIM_DHT_RESPONSE later, in one batch as the
+    pigpio thread does, with their sensor ticks.
+    """
+    connected = True
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._t0        = time.perf_counter()
+        self._levels    = 0xFFFF_FFFF
+        self._modes: Dict[int, int]     = {}
+        self._pulled: Dict[int, bool]   = {}
+        self._callbacks: List[list]     = []
+        self._notify: Dict[int, list]   = {}
+        self._notify_dir                = tempfile.mkdtemp(prefix="pigpio")
+        self._seqno                     = 0
+        self._lock                      = threading.Lock()
+
+    def stop(self) -> None:
+        for handle in list(self._notify):
+            self.notify_close(handle)
+
+    def get_current_tick(self) -> int:
+        return int((time.perf_counter() - self._t0) * 1e6) & 0xFFFF_FFFF
+
+    def set_mode(self, gpio: int, mode: int) -> None:
+        released = mode == 0 and self._modes.get(gpio) == 1 \
+            and not (self._levels >> gpio) & 1
+        self._modes[gpio] = mode
+        if released:
+            self._set_level(gpio, 1, self.get_current_tick())
+            if gpio in SIM_DHT_GPIOS:
+                threading.Timer(SIM_DHT_RESPONSE, self._dht_frame,
+                                (gpio, self.get_current_tick())).start()
+
+    def get_mode(self, gpio: int) -> int:
+        return self._modes.get(gpio, 0)
+
+    def set_pull_up_down(self, gpio: int, pud: int) -> None:
+        self._pulled[gpio] = pud == 2
+
+    def read(self, gpio: int) -> int:
+        return (self._levels >> gpio) & 1
+
+    def write(self, gpio: int, level: int) -> None:
+        self._modes[gpio] = 1
+        self._set_level(gpio, level, self.get_current_tick())
+
+    def callback(self, gpio: int, edge: int = 0, func=None):
+        cb = [gpio, edge, func]
+        self._callbacks.append(cb)
+        return SimpleNamespace(
+            cancel=lambda: cb in self._callbacks and self._callbacks.remove(cb)
+        )
+
+    def _set_level(self, gpio: int, level: int, tick: int) -> None:
+        with self._lock:
+            if (self._levels >> gpio) & 1 == level:
+                return
+            self._levels ^= 1 << gpio
+            self._seqno   = (self._seqno + 1) & 0xFFFF
+            report = struct.pack("<HHII", self._seqno, 0, tick, self._levels)
+            for bits, fd in self._notify.values():
+                if fd is not None and bits >> gpio & 1:
+                    os.write(fd, report)
+        for g, edge, func in list(self._callbacks):
+            if g == gpio and func is not None and edge in (1 - level, 2):
+                func(gpio, level, tick)
+
+    def _dht_frame(self, gpio: int, tick: int) -> None:
+        phases = dht_phases(random.gauss(21.0, 0.2), random.gauss(45.0, 1))
+        for level, held in phases[1:]:
+            self._set_level(gpio, level, tick & 0xFFFF_FFFF)
+            tick += held
+
+    # Notification pipes
+    def pipe_path(self, handle: int) -> str:
+        return os.path.join(self._notify_dir, f"pigpio{handle}")
+
+    def notify_open(self) -> int:
+        handle = len(self._notify)
+        os.mkfifo(self.pipe_path(handle))
+        self._notify[handle] = [0, None]
+        return handle
+
+    def notify_begin(self, handle: int, bits: int) -> None:
+        fd = self._notify[handle][1]
+        if fd is None:  # the reader opened the pipe first
+            fd = os.open(self.pipe_path(handle), os.O_WRONLY | os.O_NONBLOCK)
+        self._notify[handle] = [bits, fd]
+
+    def notify_pause(self, handle: int) -> None:
+        self._notify[handle][0] = 0
+
+    def notify_close(self, handle: int) -> None:
+        bits, fd = self._notify.pop(handle)
+        if fd is not None:
+            os.close(fd)
+        os.unlink(self.pipe_path(handle))
+
+
+_sim_pigpio: Optional[SimpleNamespace] = None
+
+
+def _sim_bus(name: str) -> Any:
+    global _sim_pigpio
+
+    if name == "smbus":
+        return SimpleNamespace(SMBus=get_sim_i2c, i2c_msg=SimI2CMsg)
+    if name == "board_i2c":
+        return get_sim_i2c(1)
+    if name == "GPIO":
+        return SimGPIO()
+    if name == "w1":
+        return SimW1()
+    if name == "pigpio":
+        if _sim_pigpio is None:
+            pi = SimPi()
+            _sim_pigpio = SimpleNamespace(
+                pi=lambda *args, **kwargs: pi,
+                pipe_path=pi.pipe_path,
+                tickDiff=tick_diff,
+                INPUT=0, OUTPUT=1,
+                RISING_EDGE=0, FALLING_EDGE=1, EITHER_EDGE=2,
+                PUD_OFF=0, PUD_DOWN=1, PUD_UP=2,
+            )
+        return _sim_pigpio
+    raise KeyError(name)
+
+
+# ---------
+# Benchmark
+# -----------------------------------------------------------------------------
+def benchmark(seconds: float = 3.0) -> None:
+    '''Drivers throughput, scheduler and replay on simulated buses'''
+    import asyncio
+    from rpi_acquisition import Scheduler, get_sources, load_driver
+
+    def timeit(f, n: int) -> float:
+        t_init = time.perf_counter()
+        for _ in range(n):
+            f()
+        return (time.perf_counter() - t_init) / n * 1_000
+
+    set_backend("sim")
+    print(f"Drivers, simulated buses, i²c at {SIM_I2C_HZ // 1_000} kHz:")
+    bmp_mod = load_driver("rpi_sen-bmp388.py")
+    bmp388  = bmp_mod.BMP388()
+    print(f"- bmp388.get_data:      {timeit(bmp388.get_data, 200):7.2f} ms")
+    bmp388.configure_fifo(odr=200, osr_p=1, osr_t=1)
+    time.sleep(0.2)
+    n = len(bmp388.get_fifo_samples())
+    print(f"- bmp388 fifo drain:    {timeit(bmp388.get_fifo_samples, 1):7.2f} "
+          f"ms, {n} samples after 0.2 s at 200 Hz")
+    lcd = load_driver("rpi_screen-lcd.py").LCD()
+    print(f"- lcd 20 chars line:    "
+          f"{timeit(lambda: lcd.lcd_display_string('x' * 20, 1), 10):7.2f} ms")
+    dht_mod = load_driver("rpi_sen-dht.py")
+    dht     = dht_mod.DHT(_resolve("pigpio").pi(), 17)
+    print(f"- dht.read:             {timeit(dht.read, 5):7.2f} ms, "
+          f"{dht.read()}")
+    dht.stop()
+
+    print(f"\nScheduler, {seconds} s:")
+
+    async def schedule() -> Dict[str, dict]:
+        s = Scheduler(get_sources())
+        s.start()
+        await asyncio.sleep(seconds)
+        await s.stop()
+        return s.stats()
+
+    for name, stats in asyncio.run(schedule()).items():
+        print(f"- {name:<9} {stats}")
+
+    print("\nRecord / replay, 200 bmp388.get_data:")
+    path = Path(tempfile.mkdtemp()) / "recording.jsonl"
+    set_backend("sim", path)
+    bmp388   = load_driver("rpi_sen-bmp388.py").BMP388()
+    recorded = [bmp388.get_data() for _ in range(200)]
+    set_backend("replay", path)
+    bmp388   = load_driver("rpi_sen-bmp388.py").BMP388()
+    t_init   = time.perf_counter()
+    replayed = [bmp388.get_data() for _ in range(200)]
+    ms       = (time.perf_counter() - t_init) * 1_000
+    print(f"- {path.stat().st_size} bytes recorded, replayed in {ms:.2f} ms, "
+          f"same values: {recorded == replayed}")
+    set_backend("sim")
+
+
+set_backend(
+    os.environ.get("RPI_HAL", "hw"),
+    os.environ.get("RPI_HAL_RECORDING") or None,
+    os.environ.get("RPI_HAL_REALTIME", "") == "1",
+)
+
+
+if __name__ == "__main__":
+    assert sys.argv[-1] in ("benchmark",), "arg: [benchmark]"
+    import rpi_hal  # the drivers' module, not __main__
+    rpi_hal.benchmark()
@@ -1,4 +1,9 @@
-import smbus2 as smbus
+import sys
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from typing import Dict, Iterator, List
+
+import rpi_hal
 
 
 LCD_ADDR = 0x27
@@ -35,12 +40,16 @@ LCD_NOBACKLIGHT         = 0x00
 En = 0b00000100  # Enable bit
 Rw = 0b00000010  # Read/Write bit
 Rs = 0b00000001  # Register select bit
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)  # DDRAM address of each line
+LCD_MAX_WRITE   = 4_096     # Bytes per i²c write transaction
+LCD_EXEC_SLOW   = 0.002     # s, clear display and return home execution time
 
 
 class I2CDevice:
     def __init__(self, i2c_addr: int, port: int=1) -> None:
         self.i2c_addr = i2c_addr
-        self.bus = smbus.SMBus(port)
+        self.bus = rpi_hal.smbus.SMBus(port)
+        self._i2c_msg = rpi_hal.smbus.i2c_msg
 
     def write_cmd(self, cmd: int) -> None:
         self.bus.write_byte(self.i2c_addr, cmd)
@@ -51,6 +60,10 @@ class I2CDevice:
     def write_block_data(self, cmd: int, data: list) -> None:
         self.bus.write_block_data(self.i2c_addr, cmd, data)
 
+    def write_bytes(self, data: bytes) -> None:
+        '''One i²c write transaction, a PCF8574 latches each byte in turn'''
+        self.bus.i2c_rdwr(self._i2c_msg.write(self.i2c_addr, data))
+
     def read(self):
         return self.bus.read_byte(self.i2c_addr)
 
@@ -62,8 +75,32 @@ class I2CDevice:
 
 
 class LCD:
-    def __init__(self) -> None:
+    """
+    HD44780 character LCD on a PCF8574 i²c backpack, 4-bit mode
+
+    Each nibble is strobed with 2 port bytes (E high, E low), plus a setup
+    byte when RS changes. Port bytes are queued and sent as one i²c write
+    per command, or per `batch()` block. A shadow of the DDRAM limits
+    string writes to the cells that changed.
+
+    Params
+    - rows: int = 4
+    - cols: int = 20
+    """
+
+    def __init__(self, rows: int = 4, cols: int = 20) -> None:
         self.lcd_device = I2CDevice(LCD_ADDR)
+        self.rows       = rows
+        self.cols       = cols
+        self.bytes_sent = 0
+
+        self._buffer    = bytearray()
+        self._batching  = 0
+        self._rs        = None
+        self._addrs     = [[LCD_ROW_OFFSETS[r] + c for c in range(cols)]
+                           for r in range(rows)]
+        self._ddram: Dict[int, int] = {}
+
         self.lcd_write(0x03)
         self.lcd_write(0x03)
         self.lcd_write(0x03)
@@ -73,65 +110,159 @@ class LCD:
         self.lcd_write(LCD_CLEARDISPLAY)
         self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
 
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        '''Queue the port bytes of the block, sent in one write on exit'''
+        self._batching += 1
+        try:
+            yield
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self.flush()
+
+    def flush(self) -> int:
+        '''Send the queued port bytes, returns the number of bytes'''
+        data, self._buffer = bytes(self._buffer), bytearray()
+        for i in range(0, len(data), LCD_MAX_WRITE):
+            self.lcd_device.write_bytes(data[i:i + LCD_MAX_WRITE])
+        self.bytes_sent += len(data)
+        return len(data)
+
     def lcd_strobe(self, data: int) -> None:
-        self.lcd_device.write_cmd(data | En | LCD_BACKLIGHT)
-        self.lcd_device.write_cmd(((data & ~En) | LCD_BACKLIGHT))
+        self._buffer.append(data | En | LCD_BACKLIGHT)
+        self._buffer.append((data & ~En) | LCD_BACKLIGHT)
+        if not self._batching:
+            self.flush()
 
     def lcd_write_four_bits(self, data: int) -> None:
-        self.lcd_device.write_cmd(data | LCD_BACKLIGHT)
+        if data & Rs != self._rs:  # RS set up before E rises
+            self._buffer.append(data | LCD_BACKLIGHT)
+            self._rs = data & Rs
         self.lcd_strobe(data)
 
     def lcd_write(self, cmd: int, mode: int=0) -> None:
-        self.lcd_write_four_bits(mode | (cmd & 0xF0))
-        self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+        with self.batch():
+            self.lcd_write_four_bits(mode | (cmd & 0xF0))
+            self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+        if not mode and cmd in (LCD_CLEARDISPLAY, LCD_RETURNHOME):
+            self.flush()
+            sleep(LCD_EXEC_SLOW)
+            if cmd == LCD_CLEARDISPLAY:
+                self._ddram = {a: 0x20 for row in self._addrs for a in row}
 
     def lcd_write_char(self, charvalue: str, mode: int=1) -> None:
-        self.lcd_write_four_bits(mode | (charvalue & 0xF0))
-        self.lcd_write_four_bits(mode | ((charvalue << 4) & 0xF0))
+        with self.batch():
+            self.lcd_write_four_bits(mode | (charvalue & 0xF0))
+            self.lcd_write_four_bits(mode | ((charvalue << 4) & 0xF0))
+
+    def _write_ddram(self, cells: Dict[int, int]) -> None:
+        '''Write the changed `cells`: {DDRAM address: char code}
+
+        Runs of changed cells are merged over single unchanged cells, setting
+        the address costs as much as rewriting one cell.
+        '''
+        changed = sorted(
+            a for a, c in cells.items() if self._ddram.get(a) != c
+        )
+        self._ddram.update(cells)
+        with self.batch():
+            i = 0
+            while i < len(changed):
+                j = i
+                while j + 1 < len(changed) \
+                        and changed[j + 1] - changed[j] <= 2 \
+                        and changed[j] + 1 in self._ddram:
+                    j += 1
+                self.lcd_write(LCD_SETDDRAMADDR | changed[i])
+                for addr in range(changed[i], changed[j] + 1):
+                    self.lcd_write(self._ddram[addr], Rs)
+                i = j + 1
 
     def lcd_display_string(self, string: str, line: int) -> None:
-        if line == 1:
-            self.lcd_write(0x80)
-        elif line == 2:
-            self.lcd_write(0xC0)
-        elif line == 3:
-            self.lcd_write(0x94)
-        elif line == 4:
-            self.lcd_write(0xD4)
-
-        for char in string:
-            self.lcd_write(ord(char), Rs)
+        self.lcd_display_string_pos(string, line, 0)
+
+    def lcd_display_screen(self, lines: List[str], force: bool=False) -> None:
+        '''Display `lines` padded to the width, changed cells in one write
+
+        force: rewrite every cell, e.g. after the LCD was power cycled
+        '''
+        if force:
+            self._ddram.clear()
+        cells = {}
+        for addrs, line in zip(self._addrs, lines):
+            line = line.ljust(self.cols)
+            cells.update((a, ord(c) & 0xFF) for a, c in zip(addrs, line))
+        self._write_ddram(cells)
 
     def lcd_clear(self) -> None:
         self.lcd_write(LCD_CLEARDISPLAY)
         self.lcd_write(LCD_RETURNHOME)
 
     def backlight(self, state: int) -> None:
+        self.flush()
+        self._rs = 0
         if state == 0:
             self.lcd_device.write_cmd(LCD_NOBACKLIGHT)
         elif state == 1:
             self.lcd_device.write_cmd(LCD_BACKLIGHT)
 
     def lcd_load_custom_chars(self, fontdata) -> None:
-        self.lcd_write(0x40)
-        for char in fontdata:
-            for line in char:
-                self.lcd_write_char(line)
+        with self.batch():
+            self.lcd_write(0x40)
+            for char in fontdata:
+                for line in char:
+                    self.lcd_write_char(line)
 
     def lcd_display_string_pos(self, string: str, line: int, pos: int) -> None:
-        if line == 1:
-            pos_new = pos
-        elif line == 2:
-            pos_new = 0x40 + pos
-        elif line == 3:
-            pos_new = 0x14 + pos
-        elif line == 4:
-            pos_new = 0x54 + pos
+        '''Display `string` from `pos` of `line`, clipped to the line'''
+        addrs = self._addrs[line - 1][pos:]
+        self._write_ddram({a: ord(c) & 0xFF for a, c in zip(addrs, string)})
+
+
+def benchmark(n: int = 50) -> None:
+    '''Time 20x4 refreshes: per-byte writes vs batched writes, full and partial
+
+    Per-byte writes: 3 write_byte per nibble, the previous write path.
+    '''
+    from random import uniform
+
+    lcd = LCD(4, 20)
+    bus = lcd.lcd_device.bus
+
+    def per_byte(lines: List[str]) -> None:
+        def write(cmd: int, mode: int = 0) -> None:
+            for d in (mode | (cmd & 0xF0), mode | ((cmd << 4) & 0xF0)):
+                lcd.lcd_device.write_cmd(d | LCD_BACKLIGHT)
+                lcd.lcd_device.write_cmd(d | En | LCD_BACKLIGHT)
+                lcd.lcd_device.write_cmd((d & ~En) | LCD_BACKLIGHT)
+        for offset, line in zip(LCD_ROW_OFFSETS, lines):
+            write(LCD_SETDDRAMADDR | offset)
+            for char in line:
+                write(ord(char), Rs)
+
+    def screen() -> List[str]:
+        return [f"{k}: {uniform(0, 1_000):>17.2f}" for k in "wxyz"]
 
-        self.lcd_write(0x80 + pos_new)
+    def run(name: str, refresh, screens: List[List[str]]) -> None:
+        tr_init = getattr(bus, "transactions", 0)
+        t_init  = perf_counter()
+        for lines in screens:
+            refresh(lines)
+        ms = (perf_counter() - t_init) / len(screens) * 1_000
+        tr = (getattr(bus, "transactions", 0) - tr_init) / len(screens)
+        print(f"{name:<18}: {ms:>6.2f} ms, {tr:>4.0f} transactions/refresh")
 
-        for char in string:
-            self.lcd_write(ord(char), Rs)
+    for hz in ((100_000, 400_000) if hasattr(bus, "hz") else (None,)):
+        if hz:
+            bus.hz = hz
+            print(f"Simulated i²c @ {hz // 1_000} kHz")
+        run("per byte, full", per_byte, [screen() for _ in range(n)])
+        run("batched, full", lambda lines: lcd.lcd_display_screen(lines, True),
+            [screen() for _ in range(n)])
+        base = screen()
+        run("batched, 1 value", lcd.lcd_display_screen,
+            [base[:3] + screen()[3:] for _ in range(n)])
 
 
 if __name__ == "__main__":
@@ -180,4 +311,7 @@ if __name__ == "__main__":
         finally:
             lcd.backlight(0)
 
-    test(4, 20)
+    if sys.argv[-1] == "benchmark":
+        benchmark()
+    else:
+        test(4, 20)
@@ -1,32 +1,142 @@
-import board
+import sys
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Optional
+
 import adafruit_ssd1306
-from PIL import Image, ImageDraw, ImageFont, ImageChops
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import rpi_hal
 
 
-I2C                   = board.I2C()
 SSD1306_DFLT_I2C_ADDR = 0x3C
+SSD1306_CMD           = 0x00  # Control byte: commands stream
+SSD1306_DATA          = 0x40  # Control byte: GDDRAM data stream
+SSD1306_COLUMNADDR    = 0x21
+SSD1306_PAGEADDR      = 0x22
+SSD1306_COL_OFFSETS   = {64: 32, 72: 28}  # Narrow panels GDDRAM columns
+PATH_ATLAS            = Path().cwd() / "bin"  # ssd1306_atlas-*.npz
+FONT_PATH             = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+ATLAS_CHARS           = "".join(map(chr, range(32, 127))) + "°µ"
+
+
+# -----------
+# Glyph atlas
+# -----------------------------------------------------------------------------
+class GlyphAtlas:
+    """
+    Monospace font rasterised once into page-ordered 1-bit glyphs
+
+    `glyphs[i, page, x]` bit n is pixel (x, 8 * page + n) of `chars[i]`, as
+    in the SSD1306 frame: strings are blitted into the frame with no PIL
+    round-trip. Glyph heights are rounded up to whole pages. Atlases are
+    cached in .npz files of `path`, rasterised when missing.
+
+    Params
+    - font_path: str        = FONT_PATH
+    - font_size: int        = 12
+    - chars: str            = ATLAS_CHARS, others are drawn as "?"
+    - path: Optional[Path]  = PATH_ATLAS, None: no cache
+    """
+
+    def __init__(
+        self,
+        font_path: str          = FONT_PATH,
+        font_size: int          = 12,
+        chars: str              = ATLAS_CHARS,
+        path: Optional[Path]    = PATH_ATLAS,
+    ) -> None:
+        self.chars  = chars
+        self.file   = None
+        if path:
+            name = f"ssd1306_atlas-{Path(font_path).stem}-{font_size}.npz"
+            self.file = path / name
+
+        self.glyphs = None
+        if self.file and self.file.exists():
+            data = np.load(self.file)
+            if str(data["chars"]) == chars:
+                self.glyphs = data["glyphs"]
+        if self.glyphs is None:
+            self.glyphs = self.rasterise(font_path, font_size, chars)
+            if self.file:
+                self.file.parent.mkdir(parents=True, exist_ok=True)
+                np.savez(self.file, glyphs=self.glyphs, chars=np.array(chars))
+
+        _, self.pages, self.width = self.glyphs.shape
+        self.index      = {c: i for i, c in enumerate(chars)}
+        self._missing   = self.index.get("?", 0)
+
+    def __repr__(self) -> str:
+        return f"GlyphAtlas[{len(self.chars)} chars, " \
+            f"{self.width}x{self.pages * 8}]"
+
+    @staticmethod
+    def rasterise(font_path: str, font_size: int, chars: str) -> np.ndarray:
+        '''Glyphs of `chars`: (len(chars), pages, width) np.uint8'''
+        font = ImageFont.truetype(font_path, font_size)
+        ascent, descent = font.getmetrics()
+        width = int(np.ceil(font.getlength("M")))
+        pages = -(-(ascent + descent) // 8)
+        glyphs = np.zeros((len(chars), pages, width), np.uint8)
+        for i, c in enumerate(chars):
+            img = Image.new("1", (width, pages * 8))
+            ImageDraw.Draw(img).text((0, 0), c, 1, font)
+            pixels = np.asarray(img, bool).reshape(pages, 8, width)
+            glyphs[i] = np.packbits(pixels, axis=1, bitorder="little")[:, 0]
+        return glyphs
 
+    def render(self, text: str) -> np.ndarray:
+        '''Page-ordered columns of `text`: (pages, len(text) * width)'''
+        idx = [self.index.get(c, self._missing) for c in text]
+        return self.glyphs[idx].transpose(1, 0, 2).reshape(
+            self.pages, len(idx) * self.width
+        )
 
+
+# -------
+# SSD1306
+# -----------------------------------------------------------------------------
 class SSD1306_I2C:
     """
     SSD1306 i²c OLED Screen
+
+    Params
+    - width: int    = 128
+    - height: int   = 64
+    - i2c_addr: int = SSD1306_DFLT_I2C_ADDR
+    - i2c: Any      = None, rpi_hal.board_i2c()
+
+    Frames are kept page-ordered, as in the GDDRAM: `frame[page, x]` bit n is
+    pixel (x, 8 * page + n). Updates only send the columns of the pages that
+    changed since the last frame sent, in column / page address windows.
     """
 
     def __init__(
         self,
         width: int      = 128,
         height: int     = 64,
-        i2c_addr: int   = SSD1306_DFLT_I2C_ADDR
+        i2c_addr: int   = SSD1306_DFLT_I2C_ADDR,
+        i2c: Any        = None,
     ) -> None:
         self.width      = width
         self.height     = height
         self.i2c_addr   = i2c_addr
+        self.bytes_sent = 0
+
+        # Frames: to send, last sent
+        self._pages         = height // 8
+        self._col_offset    = SSD1306_COL_OFFSETS.get(width, 0)
+        self.frame          = np.zeros((self._pages, width), np.uint8)
+        self._sent          = np.zeros_like(self.frame)
+        self.atlas: Optional[GlyphAtlas] = None
 
         # Reset display
         self.screen = adafruit_ssd1306.SSD1306_I2C(
             width,
             height,
-            I2C,
+            i2c or rpi_hal.board_i2c(),
             addr=i2c_addr
         )
         self.reset_screen()
@@ -49,22 +159,125 @@ class SSD1306_I2C:
     def reset_screen(self) -> None:
         self.screen.fill(0)
         self.screen.show()
+        self.frame[:] = 0
+        self._sent[:] = 0
 
-    def display_image(self) -> None:
-        self.screen.image(self.image)
-        self.screen.show()
+    def _write(self, data: bytes) -> None:
+        with self.screen.i2c_device as i2c:
+            i2c.write(data)
+        self.bytes_sent += len(data)
+
+    def _write_window(self, page0: int, page1: int, col0: int, col1: int):
+        """Send frame[page0..page1, col0..col1], horizontal addressing"""
+        self._write(bytes((
+            SSD1306_CMD,
+            SSD1306_COLUMNADDR, col0 + self._col_offset,
+            col1 + self._col_offset,
+            SSD1306_PAGEADDR, page0, page1,
+        )))
+        window = self.frame[page0:page1 + 1, col0:col1 + 1]
+        self._write(bytes((SSD1306_DATA,)) + window.tobytes())
+        self._sent[page0:page1 + 1, col0:col1 + 1] = window
+
+    def flush(self, full: bool = False) -> int:
+        """Send the frame changes, returns the bytes written"""
+        n_init = self.bytes_sent
+        if full:
+            self._write_window(0, self._pages - 1, 0, self.width - 1)
+            return self.bytes_sent - n_init
+
+        changed = self.frame != self._sent
+        for page in np.flatnonzero(changed.any(axis=1)):
+            cols = np.flatnonzero(changed[page])
+            self._write_window(page, page, int(cols[0]), int(cols[-1]))
+        return self.bytes_sent - n_init
+
+    def pack_image(self) -> None:
+        """Pack the image pixels into the frame"""
+        pixels = np.asarray(self.image).reshape(self._pages, 8, self.width)
+        self.frame[:] = np.packbits(pixels, axis=1, bitorder="little")[:, 0]
+
+    def display_image(self, full: bool = False) -> int:
+        """Send the image changes, returns the bytes written"""
+        self.pack_image()
+        return self.flush(full)
+
+    def load_font(
+        self,
+        font_path: str  = FONT_PATH,
+        font_size: int  = 12,
+    ) -> GlyphAtlas:
+        """Set the glyph atlas of `draw_text`"""
+        self.atlas = GlyphAtlas(font_path, font_size)
+        return self.atlas
+
+    def draw_text(self, x: int, page: int, text: str) -> int:
+        """Blit `text` into the frame from column `x` of page `page`
+
+        Texts are clipped to the frame, returns the text width in pixels.
+        """
+        atlas = self.atlas or self.load_font()
+        cols = atlas.render(text)
+        block = self.frame[page:page + atlas.pages, x:x + cols.shape[1]]
+        block[:] = cols[:block.shape[0], :block.shape[1]]
+        return cols.shape[1]
 
     def invert_image(self) -> None:
-        self.image = ImageChops.invert(self.image)
-        self._draw = ImageDraw.Draw(self.image)
+        """Invert the image in place, `draw` stays bound to it"""
+        pixels = np.frombuffer(self.image.tobytes(), np.uint8)
+        self.image.frombytes(np.invert(pixels).tobytes())
         self.display_image()
 
 
+def benchmark(n: int = 200) -> None:
+    '''4 text lines per frame: PIL text and image packing vs atlas blits'''
+    from random import uniform
+
+    ssd1306 = SSD1306_I2C()
+    font    = ImageFont.truetype(FONT_PATH, 12)
+    atlas   = ssd1306.load_font(FONT_PATH, 12)
+    w, h    = ssd1306.width, ssd1306.height
+    print(f"{ssd1306}, {atlas}")
+
+    def pil(lines) -> None:
+        ssd1306.draw.rectangle((0, 0, w, h), 0, 0)
+        ssd1306.draw.multiline_text((0, 0), "\n".join(lines), 255, font,
+                                    spacing=3)
+        ssd1306.pack_image()
+
+    def blit(lines) -> None:
+        ssd1306.frame[:] = 0
+        for i, line in enumerate(lines):
+            ssd1306.draw_text(0, i * atlas.pages, line)
+
+    frames = [
+        [f"{k}: {uniform(-1_000, 1_000):>11.2f}" for k in "wxyz"]
+        for _ in range(n)
+    ]
+    for name, render in (("PIL", pil), ("atlas", blit)):
+        t_render = t_flush = 0.0
+        n_bytes = ssd1306.bytes_sent
+        for lines in frames:
+            t_init = perf_counter()
+            render(lines)
+            t_render += perf_counter() - t_init
+            t_init = perf_counter()
+            ssd1306.flush()
+            t_flush += perf_counter() - t_init
+        print(f"{name:<6}: render {t_render / n * 1e6:>7.1f} µs, "
+              f"flush {t_flush / n * 1e3:>6.2f} ms, "
+              f"{(ssd1306.bytes_sent - n_bytes) / n:>4.0f} bytes per frame")
+
+
 if __name__ == "__main__":
     from time import sleep
     from datetime import datetime as dt
     from random import random, randint
 
+    if sys.argv[-1] == "benchmark":
+        benchmark()
+        sys.exit()
+
     print("Init tests...")
     try:
         w           = 128
@@ -1,7 +1,10 @@
-from time import sleep
-from typing import Tuple
+import struct
+from time import perf_counter, sleep, time
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
 
-import smbus2 as smbus
+import numpy as np
+
+import rpi_hal
 
 
 # BMP388 I2C address
@@ -61,14 +64,202 @@ BMP388_REG_ADD_P9_MSB       = 0x43
 BMP388_REG_ADD_P10          = 0x44
 BMP388_REG_ADD_P11          = 0x45
 
+# Block reads: press xlsb..msb, temp xlsb..msb | T1_LSB..P11
+BMP388_REG_ADD_DATA         = BMP388_REG_ADD_PRESS_XLSB
+BMP388_DATA_LEN             = 6
+BMP388_REG_ADD_CALIB        = BMP388_REG_ADD_T1_LSB
+BMP388_CALIB_FORMAT         = "<HHbhhbbHHbbhbb"
+BMP388_CALIB_LEN            = struct.calcsize(BMP388_CALIB_FORMAT)  # 21
+
+# FIFO, 512 bytes
+BMP388_REG_ADD_FIFO_LENGTH  = 0x12  # 0x12 LSB, 0x13 bit 0 MSB
+BMP388_REG_ADD_FIFO_DATA    = 0x14
+BMP388_REG_ADD_FIFO_CONFIG_1 = 0x17
+BMP388_REG_VAL_FIFO_MODE    = 0x01
+BMP388_REG_VAL_FIFO_STOP_ON_FULL = 0x02
+BMP388_REG_VAL_FIFO_TIME_EN = 0x04
+BMP388_REG_VAL_FIFO_PRESS_EN = 0x08
+BMP388_REG_VAL_FIFO_TEMP_EN = 0x10
+BMP388_REG_ADD_FIFO_CONFIG_2 = 0x18  # bits 0-2 subsampling, 3-4 data select
+BMP388_REG_VAL_FIFO_FILTERED = 0x08
+BMP388_REG_ADD_OSR          = 0x1C  # bits 0-2 osr_p, 3-5 osr_t
+BMP388_REG_ADD_ODR          = 0x1D  # bits 0-4, 200 Hz / 2^odr_sel
+BMP388_REG_ADD_CONFIG       = 0x1F  # bits 1-3 iir_filter
+BMP388_FIFO_SIZE            = 512
+
+# FIFO frames headers: payload length
+BMP388_FIFO_TEMP_PRESS      = 0x94  # temp xlsb..msb, press xlsb..msb
+BMP388_FIFO_TEMP            = 0x90
+BMP388_FIFO_PRESS           = 0x84
+BMP388_FIFO_TIME            = 0xA0  # sensortime, 24 bits
+BMP388_FIFO_EMPTY           = 0x80
+BMP388_FIFO_CONFIG_ERR      = 0x44
+BMP388_FIFO_CONFIG_CHANGE   = 0x48
+BMP388_FIFO_FRAMES          = {
+    BMP388_FIFO_TEMP_PRESS: 6,
+    BMP388_FIFO_TEMP: 3,
+    BMP388_FIFO_PRESS: 3,
+    BMP388_FIFO_TIME: 3,
+    BMP388_FIFO_EMPTY: 1,
+    BMP388_FIFO_CONFIG_ERR: 1,
+    BMP388_FIFO_CONFIG_CHANGE: 1,
+}
+
+# Oversampling (osr_p, osr_t), ODR (odr_sel) and IIR filter register values
+BMP388_OSR                  = {1: 0, 2: 1, 4: 2, 8: 3, 16: 4, 32: 5}
+BMP388_ODR                  = {200 / 2 ** i: i for i in range(18)}
+BMP388_IIR                  = {0: 0, 1: 1, 3: 2, 7: 3, 15: 4, 31: 5, 63: 6,
+                               127: 7}
+
+
+class Calibration(NamedTuple):
+    """Trimming coefficients, NVM 0x31..0x45"""
+    T1: int
+    T2: int
+    T3: int
+    P1: int
+    P2: int
+    P3: int
+    P4: int
+    P5: int
+    P6: int
+    P7: int
+    P8: int
+    P9: int
+    P10: int
+    P11: int
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Calibration":
+        return cls(*struct.unpack(BMP388_CALIB_FORMAT, data))
+
+
+def get_altitude(
+    pressure: Union[float, np.ndarray],
+) -> Union[float, np.ndarray]:
+    """Altitude from get_data pressure, scalar or array
+
+    numpy power for both: libm pow differs from it in the last bit.
+    """
+    return 4_433_000 * (1 - np.power(((pressure / 100) / 101_325), 0.1903))
+
+
+def compensate(
+    calibration: Calibration,
+    adc_T: np.ndarray,
+    adc_P: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compensate raw samples arrays to temperature, pressure and altitude
+
+    Vectorised BMP388._get_compensated_*, bit-identical results: integer
+    partial products are exact in int64 as in python ints, float operations
+    are done in the same order.
+    """
+    c     = calibration
+    adc_t = np.asarray(adc_T, np.int64)
+    adc_p = np.asarray(adc_P, np.int64)
+
+    # Temperature
+    partial_data1 = adc_t - (256 * c.T1)
+    partial_data2 = c.T2 * partial_data1
+    partial_data3 = partial_data1 * partial_data1
+    partial_data4 = partial_data3 * c.T3
+    partial_data5 = partial_data2 * 262_144 + partial_data4
+    t_fine = partial_data5 / 4_294_967_296
+    temp   = t_fine * 25 / 16_384
+
+    # Pressure
+    partial_data1 = t_fine * t_fine
+    partial_data2 = partial_data1 / 64
+    partial_data3 = partial_data2 * t_fine / 256
+    partial_data4 = c.P8 * partial_data3 / 32
+    partial_data5 = c.P7 * partial_data1 * 16
+    partial_data6 = c.P6 * t_fine * 4_194_304
+    offset = float(c.P5 * 140_737_488_355_328) \
+        + partial_data4 + partial_data5 + partial_data6
+
+    partial_data2 = c.P4 * partial_data3 / 32
+    partial_data4 = c.P3 * partial_data1 * 4
+    partial_data5 = c.P2 - 16_384 * t_fine * 2_097_152
+    sensitivity = float((c.P1 - 16_384) * 70_368_744_177_664) \
+        + partial_data2 + partial_data4 + partial_data5
+
+    partial_data1 = sensitivity / 16_777_216 * adc_p
+    partial_data2 = c.P10 * t_fine
+    partial_data3 = partial_data2 + 65_536 * c.P9
+    partial_data4 = partial_data3 * adc_p / 8_192
+    partial_data5 = partial_data4 * adc_p / 512
+    partial_data6 = adc_p * adc_p
+    partial_data2 = c.P11 * partial_data6 / 65_536
+    partial_data3 = partial_data2 * adc_p / 128
+    partial_data4 = offset / 4 \
+        + partial_data1 + partial_data5 + partial_data3
+    pressure = partial_data4 * 25 / 1_099_511_627_776
+    return temp, pressure, get_altitude(pressure)
+
+
+class FIFOSample(NamedTuple):
+    """Compensated FIFO sample, get_data units"""
+    ts: float           # epoch seconds, reconstructed from the ODR
+    temperature: float
+    pressure: float
+
+
+def parse_fifo(data: bytes) -> Tuple[List[Tuple[int, int]], Optional[int]]:
+    """Parse FIFO frames to (adc_T, adc_P) samples and the sensortime
+
+    adc_T | adc_P is None for pressure | temperature only frames, parsing
+    stops at the first empty or truncated frame.
+    """
+    samples, sensortime = [], None
+    i = 0
+    while i < len(data):
+        header = data[i]
+        length = BMP388_FIFO_FRAMES.get(header)
+        if length is None:
+            raise ValueError(f"BMP388 FIFO bad frame header: {header:#04x}")
+        if header == BMP388_FIFO_EMPTY or i + 1 + length > len(data):
+            break
+        d = data[i + 1:i + 1 + length]
+        if header == BMP388_FIFO_TEMP_PRESS:
+            samples.append((
+                (d[2] << 16) + (d[1] << 8) + d[0],
+                (d[5] << 16) + (d[4] << 8) + d[3],
+            ))
+        elif header == BMP388_FIFO_TEMP:
+            samples.append(((d[2] << 16) + (d[1] << 8) + d[0], None))
+        elif header == BMP388_FIFO_PRESS:
+            samples.append((None, (d[2] << 16) + (d[1] << 8) + d[0]))
+        elif header == BMP388_FIFO_TIME:
+            sensortime = (d[2] << 16) + (d[1] << 8) + d[0]
+        i += 1 + length
+    return samples, sensortime
+
 
 class BMP388:
+    """
+    BMP388 pressure / temperature sensor, i²c
+
+    Params
+    - address: int  = I2C_ADD_BMP388
+    - bus: int      = 1
+
+    Samples are read in one 6 bytes block read, the calibration in one 21
+    bytes block read on init: not cached, every BMP388 has the same chip id
+    and a swapped sensor could not be told apart.
+    """
+
     def _read_byte(self, reg: int) -> int:
         return self._bus.read_byte_data(self._address, reg)
 
+    def _read_block(self, reg: int, length: int) -> bytes:
+        return bytes(
+            self._bus.read_i2c_block_data(self._address, reg, length)
+        )
+
     def _read_s8(self, reg: int) -> int:
         result = self._read_byte(reg)
-        if result > 128:
+        if result > 127:
             result -= 256
         return result
 
@@ -86,12 +277,18 @@ class BMP388:
     def _write_byte(self, reg: int, val: int) -> None:
         self._bus.write_byte_data(self._address, reg, val)
 
-    def __init__(self, address: int=I2C_ADD_BMP388) -> None:
+    def __init__(
+        self,
+        address: int    = I2C_ADD_BMP388,
+        bus: int        = 1,
+    ) -> None:
         self._address = address
-        self._bus = smbus.SMBus(1)
+        self._bus_id  = bus
+        self._bus     = rpi_hal.smbus.SMBus(bus)
+        self._chip_id = self._read_byte(BMP388_REG_ADD_WIA)
 
         # Load calibration values
-        if self._read_byte(BMP388_REG_ADD_WIA) == BMP388_REG_VAL_WIA:
+        if self._chip_id == BMP388_REG_VAL_WIA:
             print("Calibrating BMP388\r\n")
             u8RegData = self._read_byte(BMP388_REG_ADD_STATUS)
             if (u8RegData & BMP388_REG_VAL_CMD_RDY):
@@ -107,23 +304,26 @@ class BMP388:
             | BMP388_REG_VAL_NORMAL_MODE
         )
 
-        # Read the temperature calibration parameters
-        self.T1   = self._read_u16(BMP388_REG_ADD_T1_LSB)
-        self.T2   = self._read_u16(BMP388_REG_ADD_T2_LSB)
-        self.T3   = self._read_s8(BMP388_REG_ADD_T3)
-
-        # Read the pressure calibration parameters
-        self.P1   = self._read_s16(BMP388_REG_ADD_P1_LSB)
-        self.P2   = self._read_s16(BMP388_REG_ADD_P2_LSB)
-        self.P3   = self._read_s8(BMP388_REG_ADD_P3)
-        self.P4   = self._read_s8(BMP388_REG_ADD_P4)
-        self.P5   = self._read_u16(BMP388_REG_ADD_P5_LSB)
-        self.P6   = self._read_u16(BMP388_REG_ADD_P6_LSB)
-        self.P7   = self._read_s8(BMP388_REG_ADD_P7)
-        self.P8   = self._read_s8(BMP388_REG_ADD_P8)
-        self.P9   = self._read_s16(BMP388_REG_ADD_P9_LSB)
-        self.P10  = self._read_s8(BMP388_REG_ADD_P10)
-        self.P11  = self._read_s8(BMP388_REG_ADD_P11)
+        self.calibration = self.read_calibration()
+
+        # FIFO, configure_fifo
+        self.fifo_period: Optional[float]   = None
+        self._fifo_last_ts: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"BMP388[{self._bus_id}:{self._address:#04x}]"
+
+    def _set_calibration(self, calibration: Calibration) -> Calibration:
+        # T1..P11 attributes, used by the compensation
+        for k, v in calibration._asdict().items():
+            setattr(self, k, v)
+        return calibration
+
+    def read_calibration(self) -> Calibration:
+        """Read the calibration block from the chip"""
+        return self._set_calibration(Calibration.from_bytes(
+            self._read_block(BMP388_REG_ADD_CALIB, BMP388_CALIB_LEN)
+        ))
 
     def _get_compensated_temperature(self, adc_t: float) -> float:
         partial_data1 = adc_t - (256 * self.T1)
@@ -169,23 +369,205 @@ class BMP388:
         Output: (float, float, float)
         - 96_386.2 Pa = 963.862 hPa = 0.963862 bar
         """
-        xlsb  = self._read_byte(BMP388_REG_ADD_TEMP_XLSB)
-        lsb   = self._read_byte(BMP388_REG_ADD_TEMP_LSB)
-        msb   = self._read_byte(BMP388_REG_ADD_TEMP_MSB)
-        adc_T = (msb << 16) + (lsb << 8) + (xlsb)
+        d     = self._read_block(BMP388_REG_ADD_DATA, BMP388_DATA_LEN)
+        adc_T = (d[5] << 16) + (d[4] << 8) + (d[3])
         temp  = self._get_compensated_temperature(adc_T)
-        xlsb  = self._read_byte(BMP388_REG_ADD_PRESS_XLSB)
-        lsb   = self._read_byte(BMP388_REG_ADD_PRESS_LSB)
-        msb   = self._read_byte(BMP388_REG_ADD_PRESS_MSB)
 
-        adc_P = (msb << 16) + (lsb << 8) + (xlsb)
+        adc_P = (d[2] << 16) + (d[1] << 8) + (d[0])
         pressure = self._get_compensated_pressure(adc_P)
-        altitude = 4_433_000 * (1 - pow(((pressure / 100) / 101_325), 0.1903))
+        altitude = float(get_altitude(pressure))
         return temp, pressure, altitude
 
+    def compensate(
+        self,
+        adc_T: np.ndarray,
+        adc_P: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """get_data for arrays of raw samples, FIFO dumps or ADC logs"""
+        return compensate(self.calibration, adc_T, adc_P)
+
+    # ----
+    # FIFO
+    # -------------------------------------------------------------------------
+    def configure_fifo(
+        self,
+        odr: float          = 50,
+        osr_p: int          = 4,
+        osr_t: int          = 1,
+        iir: int            = 3,
+        subsampling: int    = 0,
+        filtered: bool      = True,
+    ) -> None:
+        """Stream temperature + pressure frames into the FIFO, normal mode
+
+        Params
+        - odr: float        = 50, Hz: 200 / 2^n
+        - osr_p: int        = 4, 1 | 2 | 4 | 8 | 16 | 32
+        - osr_t: int        = 1
+        - iir: int          = 3, filter coefficient: 0 | 1 | 3 | ... | 127
+        - subsampling: int  = 0, FIFO keeps 1 sample every 2^subsampling
+        - filtered: bool    = True, FIFO gets IIR filtered data
+        """
+        if odr not in BMP388_ODR:
+            raise ValueError(f"odr: {sorted(BMP388_ODR, reverse=True)} Hz")
+        for name, osr in (("osr_p", osr_p), ("osr_t", osr_t)):
+            if osr not in BMP388_OSR:
+                raise ValueError(f"{name}: {list(BMP388_OSR)}")
+        if iir not in BMP388_IIR:
+            raise ValueError(f"iir: {list(BMP388_IIR)}")
+        self._write_byte(
+            BMP388_REG_ADD_OSR, BMP388_OSR[osr_p] | BMP388_OSR[osr_t] << 3
+        )
+        self._write_byte(BMP388_REG_ADD_ODR, BMP388_ODR[odr])
+        self._write_byte(BMP388_REG_ADD_CONFIG, BMP388_IIR[iir] << 1)
+        self._write_byte(
+            BMP388_REG_ADD_FIFO_CONFIG_2,
+            (subsampling & 0x07)
+            | (BMP388_REG_VAL_FIFO_FILTERED if filtered else 0)
+        )
+        self._write_byte(
+            BMP388_REG_ADD_FIFO_CONFIG_1,
+            BMP388_REG_VAL_FIFO_MODE
+            | BMP388_REG_VAL_FIFO_PRESS_EN
+            | BMP388_REG_VAL_FIFO_TEMP_EN
+        )
+        self._write_byte(
+            BMP388_REG_ADD_PWR_CTRL,
+            BMP388_REG_VAL_PRESS_EN
+            | BMP388_REG_VAL_TEMP_EN
+            | BMP388_REG_VAL_NORMAL_MODE
+        )
+        sleep(0.01)
+        if self._read_byte(BMP388_REG_ADD_ERR) & BMP388_REG_VAL_CONF_ERR:
+            raise ValueError(f"{self} config error, odr too high for osr?")
+
+        self.fifo_period = 2 ** (subsampling & 0x07) / odr
+        self.flush_fifo()
+
+    def _check_fifo(self) -> None:
+        if self.fifo_period is None:
+            raise RuntimeError(f"{self} FIFO not configured: configure_fifo")
+
+    def flush_fifo(self) -> None:
+        self._write_byte(BMP388_REG_ADD_CMD, BMP388_REG_VAL_FIFI_FLUSH)
+        self._fifo_last_ts = None
+
+    def read_fifo(self) -> bytes:
+        """Drain the FIFO: its length, then one bulk i²c read"""
+        d = self._read_block(BMP388_REG_ADD_FIFO_LENGTH, 2)
+        length = ((d[1] & 0x01) << 8) + d[0]
+        if not length:
+            return b""
+        i2c_msg = rpi_hal.smbus.i2c_msg
+        w = i2c_msg.write(self._address, [BMP388_REG_ADD_FIFO_DATA])
+        r = i2c_msg.read(self._address, length)
+        self._bus.i2c_rdwr(w, r)
+        return bytes(r)
+
+    def get_fifo_samples(self) -> List[FIFOSample]:
+        """Drain and compensate the FIFO samples
+
+        The last sample is stamped with the drain time and the others every
+        `fifo_period` before it, following on from the previous drain while
+        within one period.
+        """
+        self._check_fifo()
+        t_read = time()
+        samples, _ = parse_fifo(self.read_fifo())
+        n = len(samples)
+        if not n:
+            return []
+
+        ts = t_read - (n - 1) * self.fifo_period
+        if self._fifo_last_ts is not None:
+            ts_next = self._fifo_last_ts + self.fifo_period
+            if abs(ts_next - ts) < self.fifo_period:
+                ts = ts_next
+        self._fifo_last_ts = ts + (n - 1) * self.fifo_period
+
+        # Pressure frames with the last temperature, compensated at once
+        idx, adc_T, adc_P, t = [], [], [], None
+        for i, (s_T, s_P) in enumerate(samples):
+            if s_T is not None:
+                t = s_T
+            if s_P is not None and t is not None:
+                idx.append(i)
+                adc_T.append(t)
+                adc_P.append(s_P)
+        if not idx:
+            return []
+        temp, pressure, _ = self.compensate(adc_T, adc_P)
+        return [
+            FIFOSample(ts + i * self.fifo_period, t, p)
+            for i, t, p in zip(idx, temp.tolist(), pressure.tolist())
+        ]
+
+    def stream_fifo(
+        self,
+        drain_period: float = 0.5,
+    ) -> Iterator[List[FIFOSample]]:
+        """Yield batches of FIFO samples every `drain_period` seconds
+
+        The FIFO holds 73 temperature + pressure frames: `drain_period` must
+        be shorter than 73 * fifo_period.
+        """
+        self._check_fifo()
+        capacity = BMP388_FIFO_SIZE // (1 + 6) * self.fifo_period
+        if drain_period >= capacity:
+            raise ValueError(f"drain_period: < {capacity:.3f}s")
+        t_next = time()
+        while True:
+            t_next += drain_period
+            sleep(max(0.0, t_next - time()))
+            yield self.get_fifo_samples()
+
+
+def benchmark(n: int = 100_000) -> None:
+    """Compare the scalar and vectorised compensations, no hardware"""
+    calibration = Calibration(27_846, 19_290, -7, -1_212, -3_326, 35, 0,
+                              25_340, 30_440, 3, -6, 16_235, -5, 21)
+    rng   = np.random.default_rng(0)
+    adc_T = rng.integers(7_800_000, 8_800_000, n)
+    adc_P = rng.integers(5_800_000, 7_200_000, n)
+
+    # Scalar path without a bus: calibration attributes only
+    bmp388 = BMP388.__new__(BMP388)
+    bmp388._set_calibration(calibration)
+
+    t_init = perf_counter()
+    scalar = []
+    for t, p in zip(adc_T.tolist(), adc_P.tolist()):
+        temp     = bmp388._get_compensated_temperature(t)
+        pressure = bmp388._get_compensated_pressure(p)
+        scalar.append((temp, pressure, float(get_altitude(pressure))))
+    ms_scalar = (perf_counter() - t_init) * 1_000
+
+    t_init = perf_counter()
+    vectorised = compensate(calibration, adc_T, adc_P)
+    ms_vectorised = (perf_counter() - t_init) * 1_000
+
+    identical = all(
+        np.array_equal(np.array(s), v)
+        for s, v in zip(zip(*scalar), vectorised)
+    )
+    print(f"{n} samples, bit-identical: {identical}")
+    print(f"- scalar:     {ms_scalar:8.2f} ms")
+    print(f"- vectorised: {ms_vectorised:8.2f} ms "
+          f"(x{ms_scalar / ms_vectorised:.0f})")
+
 
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[-1] == "benchmark":
+        benchmark()
+        sys.exit()
+
     bmp388 = BMP388()
+    if sys.argv[-1] == "fifo":
+        bmp388.configure_fifo(odr=100, osr_p=2, osr_t=1)
+        for batch in bmp388.stream_fifo():
+            print(f"{len(batch)} samples, last: {batch[-1:]}")
     while True:
         t, p, a = bmp388.get_data()
         print(f"{t / 100:.1f}°C\t{p / 100:.2f}hPa\t{(a / 100):.2f}m")
@@ -1,19 +1,24 @@
 from time import sleep
 
-import RPi.GPIO as GPIO
+import rpi_hal
 
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
 SEN = 16  # GPIO 23
-GPIO.setup(SEN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+
+def setup_gpio() -> None:
+    GPIO = rpi_hal.GPIO
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setwarnings(False)
+    GPIO.setup(SEN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
 
 if __name__ == "__main__":
+    setup_gpio()
     try:
         while True:
-            print(f"State: {GPIO.input(SEN)}")
+            print(f"State: {rpi_hal.GPIO.input(SEN)}")
             sleep(1)
     finally:
-        GPIO.cleanup()
+        rpi_hal.GPIO.cleanup()
         print("GPIO cleaned up.")
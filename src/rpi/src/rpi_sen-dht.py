@@ -1,8 +1,28 @@
-from dataclasses import dataclass
-from time import sleep, time
-from typing import Tuple
+import asyncio
+import os
+import struct
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic, perf_counter, sleep, time
+from types import SimpleNamespace
+from typing import Deque, List, Optional, Tuple
 
-import pigpio
+import numpy as np
+
+import rpi_hal
+
+
+READ_TIMEOUT    = 0.25  # s, after the start pulse
+HISTORY         = 100   # background sampling readings kept
+
+# Capture mode: pigpio notification pipe reports, /dev/pigpio<handle>
+NOTIFY_REPORT   = np.dtype([
+    ("seqno", "<u2"), ("flags", "<u2"), ("tick", "<u4"), ("level", "<u4")
+])
+CAPTURE_SECONDS = 0.01  # s after the start pulse, 43 edges <= 150 µs apart
+PATH_CAPTURE    = Path().cwd() / "bin" / "dht_capture.npz"
 
 
 @dataclass
@@ -20,9 +40,9 @@ class Status:
     timeout: int      = 3  # No response from sensor
 
 
-@dataclass
+@dataclass(frozen=True)
 class Reading:
-    timestamp: float         = time()
+    timestamp: float         = field(default_factory=time)
     status: Status           = Status.timeout
     temperature: float       = 0.0  # Celsius
     relative_humidity: float = 0.0  # %
@@ -32,6 +52,75 @@ class Reading:
             f"{self.temperature}°C, Rh: {self.relative_humidity} %"
 
 
+# -------
+# Capture
+# -----------------------------------------------------------------------------
+def get_rising_edges(reports: np.ndarray, gpio: int) -> np.ndarray:
+    """Ticks of the `gpio` rising edges in NOTIFY_REPORT reports"""
+    reports = reports[reports["flags"] == 0]  # no watchdog / keep alive
+    level   = (reports["level"] >> gpio) & 1
+    rising  = np.diff(level, prepend=level[:1]) == 1
+    return reports["tick"][rising]
+
+
+def decode_ticks(ticks: np.ndarray) -> Optional[int]:
+    """Decode the 40 bits frame of rising edges ticks, _on_rising_edge rules
+
+    The frame starts at the first edge after a > 10 ms gap (the start pulse
+    release, or the first edge), then the response and 40 bits edges: one
+    bit per rising edges delta, 60..150 µs, 1 if > 100 µs.
+    """
+    deltas = np.diff(ticks.astype(np.int64)) & 0xFFFF_FFFF
+    gaps   = np.flatnonzero(deltas > 10_000)
+    start  = gaps[-1] + 1 if len(gaps) else 0
+    bits   = deltas[start + 2:start + 42]
+    if len(bits) < 40 or ((bits < 60) | (bits > 150)).any():
+        return None
+    return int(np.dot(bits > 100, 1 << np.arange(39, -1, -1, dtype=np.int64)))
+
+
+def synthesize_reports(
+    gpio: int,
+    temperature: float,
+    relative_humidity: float,
+    jitter: int = 5,
+    tick: int = 0,
+) -> np.ndarray:
+    """DHTXX reading NOTIFY_REPORT reports: start pulse, response, frame
+
+    `jitter`: µs, pigpio samples the levels every 5 µs by default.
+    """
+    phases  = rpi_hal.dht_phases(temperature, relative_humidity)
+    rng     = np.random.default_rng(tick)
+    held    = np.array([d for _, d in phases], np.int64)
+    held[1:] += rng.integers(-jitter, jitter + 1, len(held) - 1)
+    reports = np.zeros(len(phases), NOTIFY_REPORT)
+    reports["seqno"] = np.arange(len(phases))
+    reports["tick"]  = (tick + np.cumsum(held) - held) & 0xFFFF_FFFF
+    reports["level"] = np.array([lvl for lvl, _ in phases]) << gpio
+    return reports
+
+
+class ReplayPi:
+    """pigpio.pi stand-in for the decoders replay, no pigpio daemon"""
+    connected = True
+
+    def set_mode(self, gpio: int, mode: int) -> None:
+        pass
+
+    def write(self, gpio: int, level: int) -> None:
+        pass
+
+    def get_current_tick(self) -> int:
+        return 0
+
+    def callback(self, gpio: int, edge: int, func) -> SimpleNamespace:
+        return SimpleNamespace(cancel=lambda: None)
+
+
+# ---
+# DHT
+# -----------------------------------------------------------------------------
 class DHT:
     """
     Utility class to read DHTXX temperature/humidity sensors
@@ -40,6 +129,17 @@ class DHT:
     - pi: pigpio.pi
     - gpio: int
     - model: int = Model.auto
+    - history: int = HISTORY, background sampling ring buffer size
+    - capture: bool = False, capture mode
+
+    Readings are immutable snapshots. `read` blocks until the decoded
+    reading or READ_TIMEOUT, `read_async` awaits a future completed from the
+    pigpio callback thread: several sensors can be read concurrently, see
+    `read_all`. `start_sampling` reads in the background into `readings`.
+
+    Capture mode collects a reading edges from a pigpio notification pipe,
+    in bulk, instead of one python callback per edge on the pigpio thread:
+    the frame is decoded in one vectorised pass, see `decode_ticks`.
 
     ```md
     Ranges
@@ -62,9 +162,11 @@ class DHT:
 
     def __init__(
         self,
-        pi: pigpio.pi,
+        pi: "pigpio.pi",
         gpio: int,
-        model: int = Model.auto
+        model: int = Model.auto,
+        history: int = HISTORY,
+        capture: bool = False,
     ) -> None:
         self._pi       = pi
         self._gpio     = gpio
@@ -75,16 +177,31 @@ class DHT:
         self._bits          = 0
         self._data          = 0
         self._reading       = Reading()
-        self._has_new_data_been_processed = False
+        self._has_new_data_been_processed = threading.Event()
+        self._future: Optional[asyncio.Future] = None
+
+        # Background sampling
+        self.readings: Deque[Reading] = deque(maxlen=history)
+        self._sampling: Optional[asyncio.Task] = None
 
         # pigpio (tick: microseconds since system boot)
-        pi.set_mode(gpio, pigpio.INPUT)
+        self._pigpio = rpi_hal.pigpio
+        pi.set_mode(gpio, self._pigpio.INPUT)
         self._prev_tick = pi.get_current_tick() - 10_000
-        self._callback_id = pi.callback(
-            gpio,
-            pigpio.RISING_EDGE,
-            self._on_rising_edge
-        )
+        self._callback_id = None
+        self._notify: Optional[int] = None
+        self.last_capture: Optional[np.ndarray] = None
+        if capture:
+            self._notify = pi.notify_open()
+            self._pipe   = os.open(rpi_hal.notify_pipe(self._notify),
+                                   os.O_RDONLY | os.O_NONBLOCK)
+            pi.notify_begin(self._notify, 1 << gpio)
+        else:
+            self._callback_id = pi.callback(
+                gpio,
+                self._pigpio.RISING_EDGE,
+                self._on_rising_edge
+            )
 
     def __repr__(self) -> str:
         return f"DHT.{self._model} GPIO[{self._gpio}]"
@@ -111,6 +228,11 @@ class DHT:
             is_valid = True
         return (is_valid, t, h)
 
+    @property
+    def latest(self) -> Optional[Reading]:
+        """Last background sampling reading"""
+        return self.readings[-1] if self.readings else None
+
     def _decode_dhtxx(self):
         b0 =  self._data        & 0xFF
         b1 = (self._data >>  8) & 0xFF
@@ -132,20 +254,30 @@ class DHT:
                     is_valid, t, h = self.get_DHT11_data(b1, b2, b3, b4)
 
             if is_valid:
-                self._reading.temperature       = t
-                self._reading.relative_humidity = h
-                self._reading.status            = Status.ok
+                reading = Reading(time(), Status.ok, t, h)
             else:
-                self._reading.status = Status.bad_data
+                reading = Reading(time(), Status.bad_data)
         else:
-            self._reading.status = Status.bad_checksum
-        self._reading.timestamp = time()
-        self._has_new_data_been_processed = True
+            reading = Reading(time(), Status.bad_checksum)
+        self._reading = reading
+        self._has_new_data_been_processed.set()
+
+        # Called from the pigpio thread: complete the future in its loop
+        future = self._future
+        if future is not None:
+            future.get_loop().call_soon_threadsafe(
+                self._set_result, future, reading
+            )
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, reading: Reading) -> None:
+        if not future.done():
+            future.set_result(reading)
 
     def _on_rising_edge(self, gpio, level, tick):
         """pigpio callback"""
         # Get delta between the current and previous ticks
-        t_since_last_cb = pigpio.tickDiff(self._prev_tick, tick)
+        t_since_last_cb = self._pigpio.tickDiff(self._prev_tick, tick)
         self._prev_tick = tick
 
         if t_since_last_cb > 10_000:
@@ -166,39 +298,230 @@ class DHT:
                     self._decode_dhtxx()
                     self._is_processing = False
 
+    def _read_pipe(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self._pipe, 65_536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _decode_capture(self, data: bytes) -> Reading:
+        """Decode the notification reports of one reading"""
+        size    = NOTIFY_REPORT.itemsize
+        reports = np.frombuffer(data, NOTIFY_REPORT, len(data) // size)
+        self.last_capture = reports
+        frame = decode_ticks(get_rising_edges(reports, self._gpio))
+        if frame is None:
+            return Reading(status=Status.timeout)
+        self._data = frame
+        self._decode_dhtxx()
+        return self._reading
+
     def stop(self) -> None:
         """Remove _on_rising_edge callback from pigpio notification thread"""
+        if self._sampling is not None:
+            self._sampling.cancel()
+            self._sampling = None
         if self._callback_id is not None:
             self._callback_id.cancel()
             self._callback_id = None
+        if self._notify is not None:
+            self._pi.notify_close(self._notify)
+            os.close(self._pipe)
+            self._notify = None
+
+    @property
+    def _start_pulse(self) -> float:
+        return 0.001 if self._model == Model.DHTXX else 0.018
 
     def read(self) -> Reading:
-        self._reading.status = Status.timeout
-        self._has_new_data_been_processed = False
+        self._has_new_data_been_processed.clear()
+        if self._notify is not None:
+            self._read_pipe()  # stale reports
 
         # Trigger reading
         self._pi.write(self._gpio, 0)
-        if self._model != Model.DHTXX:
-            sleep(0.018)
-        else:
-            sleep(0.001)
-        self._pi.set_mode(self._gpio, pigpio.INPUT)
+        sleep(self._start_pulse)
+        self._pi.set_mode(self._gpio, self._pigpio.INPUT)
 
         # Wait for reading
-        for _ in range(5):
-            sleep(0.05)
-            if self._has_new_data_been_processed:
-                break
-        return self._reading
+        if self._notify is not None:
+            sleep(CAPTURE_SECONDS)
+            return self._decode_capture(self._read_pipe())
+        if self._has_new_data_been_processed.wait(READ_TIMEOUT):
+            return self._reading
+        return Reading(status=Status.timeout)
+
+    async def read_async(self) -> Reading:
+        """Trigger a reading, await its decoding by the pigpio callback"""
+        if self._future is not None:
+            raise RuntimeError(f"{self} read already in progress")
+        self._future = asyncio.get_running_loop().create_future()
+        try:
+            if self._notify is not None:
+                self._read_pipe()  # stale reports
+
+            # Trigger reading
+            self._pi.write(self._gpio, 0)
+            await asyncio.sleep(self._start_pulse)
+            self._pi.set_mode(self._gpio, self._pigpio.INPUT)
+
+            # Wait for reading
+            if self._notify is not None:
+                await asyncio.sleep(CAPTURE_SECONDS)
+                return self._decode_capture(self._read_pipe())
+            return await asyncio.wait_for(self._future, READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            return Reading(status=Status.timeout)
+        finally:
+            self._future = None
+
+    def start_sampling(self, period: float = 2.0) -> asyncio.Task:
+        """Read every `period` seconds in the background, into `readings`
+
+        DHT11 needs >= 1 s between readings, DHT22 >= 2 s.
+        """
+        if self._sampling is None or self._sampling.done():
+            self._sampling = asyncio.create_task(self._sample(period))
+        return self._sampling
+
+    async def _sample(self, period: float) -> None:
+        deadline = monotonic()
+        while True:
+            self.readings.append(await self.read_async())
+            deadline += period
+            now = monotonic()
+            if now > deadline:
+                deadline += ((now - deadline) // period + 1) * period
+            await asyncio.sleep(deadline - now)
+
+
+async def read_all(sensors: List[DHT]) -> List[Reading]:
+    """Read several DHTs (different GPIOs) concurrently"""
+    return await asyncio.gather(*(s.read_async() for s in sensors))
+
+
+# ------
+# Replay
+# -----------------------------------------------------------------------------
+def replay(captures: List[np.ndarray], gpio: int) -> None:
+    """Decode captures with both decoders, compare and time them"""
+    sen = DHT(ReplayPi(), gpio)
+
+    # Callback mode: the pigpio thread unpacks every report and dispatches
+    # the rising edges to _on_rising_edge
+    t_init = perf_counter()
+    by_callback = []
+    bit = 1 << gpio
+    for reports in captures:
+        data = reports.tobytes()
+        sen._has_new_data_been_processed.clear()
+        sen._prev_tick = int(reports["tick"][0]) - 20_000
+        last_level = 0
+        for _, flags, tick, level in struct.iter_unpack("<HHII", data):
+            if flags == 0:
+                if (level ^ last_level) & bit and level & bit:
+                    sen._on_rising_edge(gpio, 1, tick)
+                last_level = level
+        ok = sen._has_new_data_been_processed.is_set()
+        by_callback.append(sen._reading if ok else None)
+    ms_callback = (perf_counter() - t_init) * 1_000
+
+    t_init = perf_counter()
+    by_capture = []
+    for reports in captures:
+        r = sen._decode_capture(reports.tobytes())
+        by_capture.append(r if r.status != Status.timeout else None)
+    ms_capture = (perf_counter() - t_init) * 1_000
+
+    def values(r: Optional[Reading]) -> tuple:
+        return r and (r.status, r.temperature, r.relative_humidity)
+
+    same = all(
+        values(a) == values(b) for a, b in zip(by_callback, by_capture)
+    )
+    decoded = sum(r is not None for r in by_capture)
+    print(f"{len(captures)} captures, {decoded} decoded, "
+          f"same readings: {same}")
+    print(f"- per edge callback: {ms_callback:8.2f} ms")
+    print(f"- capture decode:    {ms_capture:8.2f} ms")
+
+
+async def run_sampling(pi: "pigpio.pi", gpios: List[int]) -> None:
+    sensors = [DHT(pi, gpio) for gpio in gpios]
+    try:
+        t_init = monotonic()
+        readings = await read_all(sensors)
+        print(f"{len(sensors)} sensors read in {monotonic() - t_init:.3f}s: "
+              f"{readings}")
+
+        for sen in sensors:
+            sen.start_sampling()
+        while True:
+            await asyncio.sleep(2)
+            for sen in sensors:
+                print(f"{sen} - {sen.latest}")
+    finally:
+        for sen in sensors:
+            sen.stop()
 
 
 if __name__ == "__main__":
+    import sys
     from datetime import datetime
 
-    pi = pigpio.pi()
+    # python rpi_sen-dht.py replay [<gpio>]: bin/dht_capture.npz | synthetic
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        rpi_hal.set_backend("sim")  # pigpio constants, ReplayPi reads
+        gpio = int(sys.argv[2]) if len(sys.argv) > 2 else 17
+        if PATH_CAPTURE.exists():
+            captures = list(np.load(PATH_CAPTURE).values())
+        else:
+            rng = np.random.default_rng(0)
+            captures = [
+                synthesize_reports(gpio, rng.uniform(-20, 40),
+                                   rng.uniform(10, 90), tick=i * 2_000_000)
+                for i in range(1_000)
+            ]
+        replay(captures, gpio)
+        exit()
+
+    pi = rpi_hal.pigpio.pi()
     if not pi.connected:
         exit()
 
+    # python rpi_sen-dht.py record <gpio>: captures to bin/dht_capture.npz
+    if len(sys.argv) > 2 and sys.argv[1] == "record":
+        sen = DHT(pi, int(sys.argv[2]), capture=True)
+        captures = {}
+        try:
+            for i in range(20):
+                print(sen.read())
+                captures[f"r{i}"] = sen.last_capture
+                sleep(2)
+        finally:
+            sen.stop()
+            pi.stop()
+            PATH_CAPTURE.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(PATH_CAPTURE, **captures)
+            print(f"{len(captures)} captures saved: {PATH_CAPTURE}")
+        exit()
+
+    # python rpi_sen-dht.py async <gpio> [<gpio> ...]
+    if len(sys.argv) > 2 and sys.argv[1] == "async":
+        try:
+            asyncio.run(run_sampling(pi, [int(g) for g in sys.argv[2:]]))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pi.stop()
+        exit()
+
     sen = DHT(pi, 17)
     try:
         while True:
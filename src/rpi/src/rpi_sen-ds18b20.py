@@ -1,12 +1,10 @@
-from glob import glob
+import rpi_hal
 
 
 def read_ds18b20() -> float:
     temp = -273.15
     try:
-        p = glob("/sys/bus/w1/devices/" + "28*")[0] + "/temperature"
-        with open(p, "r") as f:
-            temp = float(f.read()) / 1_000
+        temp = float(rpi_hal.w1_read("28*", "temperature")) / 1_000
     except Exception as e:
         print(f"{e}")
     return temp
@@ -1,31 +1,45 @@
 from time import sleep
+from typing import Optional
 
-import RPi.GPIO as GPIO
-import board
 import adafruit_tcs34725
 
+import rpi_hal
+
 
 # ----
 # GPIO
 # -----------------------------------------------------------------------------
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
 INT = 17  # 11, GPIO 17
 LED = 18  # 12, GPIO 18
-GPIO.setup(INT, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(LED, GPIO.OUT, initial=GPIO.LOW)
+
+
+def setup_gpio() -> None:
+    GPIO = rpi_hal.GPIO
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(INT, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO.setup(LED, GPIO.OUT, initial=GPIO.LOW)
 
 
 # ---
 # i²c
 # -----------------------------------------------------------------------------
-i2c = board.I2C()
-tcs = adafruit_tcs34725.TCS34725(i2c)
-tcs.integration_time = 150  # ms: range[2.4, 614.4]
-tcs.gain = 4                # 1 | 4 | 16 | 60
+_tcs: Optional[adafruit_tcs34725.TCS34725] = None
+
+
+def get_tcs() -> adafruit_tcs34725.TCS34725:
+    """TCS34725 on i²c bus 1, opened on first use"""
+    global _tcs
+    if _tcs is None:
+        _tcs = adafruit_tcs34725.TCS34725(rpi_hal.board_i2c())
+        _tcs.integration_time = 150  # ms: range[2.4, 614.4]
+        _tcs.gain = 4                # 1 | 4 | 16 | 60
+    return _tcs
 
 
 if __name__ == "__main__":
+    setup_gpio()
+    tcs = get_tcs()
     try:
         while True:
             color_raw = tcs.color_raw
@@ -40,5 +54,5 @@ if __name__ == "__main__":
             )
             sleep(1.0)
     finally:
-        GPIO.cleanup()
+        rpi_hal.GPIO.cleanup()
         print(f"GPIO Cleaned up")
@@ -1,15 +1,49 @@
-from time import sleep
+import threading
+from collections import deque
+from time import monotonic, sleep, time
+from typing import Any, Callable, Deque, NamedTuple, Optional, Tuple
 
-import board
-import busio
 import adafruit_ads1x15.ads1115 as ADS
+import numpy as np
 from adafruit_ads1x15.analog_in import AnalogIn
 
+import rpi_hal
+from rpi_acquisition import SENSOR_ERROR_VALUE, load_driver
 
-i2c = busio.I2C(board.SCL, board.SDA)
-ads = ADS.ADS1115(i2c)
-ads.gain = 2/3  # +-6.144 V - CQR-TDS
-tds_in = AnalogIn(ads, ADS.P1)
+
+TDS_DFLT_TEMP   = 25.0  # °C, without temperature source
+TDS_TEMP_COEF   = 0.02  # /°C, conductivity compensation
+TDS_BURST       = 64    # ADS1115 samples per reading, at most
+TDS_MIN_SAMPLES = 8     # Per reading, at least
+TDS_TRIM        = 0.1   # Trimmed mean, fraction cut at each tail
+TDS_Q           = 1.0   # ppm²/s, Kalman process noise: random walk
+TDS_STEP_SIGMAS = 6.0   # Innovation resetting the filter, e.g. probe moved
+TDS_Z           = 1.96  # Confidence bounds: 95 %
+HISTORY         = 100   # Pipeline readings kept
+
+
+_tds_in: Optional[AnalogIn] = None
+
+
+def get_tds_in() -> AnalogIn:
+    """ADS1115 P1 input, opened on first use"""
+    global _tds_in
+    if _tds_in is None:
+        ads = ADS.ADS1115(rpi_hal.board_i2c())
+        ads.gain = 2/3  # +-6.144 V - CQR-TDS
+        _tds_in = AnalogIn(ads, ADS.P1)
+    return _tds_in
+
+
+def tds_from_voltage(v, temperature: float = TDS_DFLT_TEMP):
+    """TDS ppm of CQR sensor voltages, vectorised
+
+    Params:
+    - v: float | np.ndarray, volts
+    - temperature: float = TDS_DFLT_TEMP, celsius
+    """
+    v = np.asarray(v) / (TDS_TEMP_COEF * (temperature - 25.0) + 1)
+    return (133.42 * v ** 3 - 255.86 * v ** 2 + 857.39 * v) / 2
 
 
 def read_tds_cqr(temperature: float = 25.0) -> float:
@@ -20,15 +54,240 @@ def read_tds_cqr(temperature: float = 25.0) -> float:
     """
     tds = 0.0
     try:
-        compens_coef = 0.02 * (temperature - 25.0) + 1
-        v = tds_in.voltage / compens_coef
-        tds = (133.42 * pow(v, 3) - 255.86 * pow(v, 2) + 857.39 * v) / 2
+        tds = float(tds_from_voltage(get_tds_in().voltage, temperature))
     except Exception as e:
         print(f"{e}")
     return round(tds, 2)
 
 
+# ---------
+# Filtering
+# -----------------------------------------------------------------------------
+def robust_mean(
+    samples: np.ndarray,
+    method: str = "trimmed",
+    trim: float = TDS_TRIM,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Location and standard error over the last axis, vectorised
+
+    - "trimmed": `trim` cut at each tail, error from the winsorised variance
+    - "median": error from the MAD, 1.2533 * sigma / sqrt(n)
+    """
+    x = np.sort(samples, axis=-1)
+    n = x.shape[-1]
+    if method == "median":
+        med = np.median(x, axis=-1)
+        mad = np.median(np.abs(x - med[..., None]), axis=-1)
+        return med, 1.2533 * 1.4826 * mad / np.sqrt(n)
+    if method != "trimmed":
+        raise ValueError(f"Unknown method: {method}")
+
+    k = int(trim * n)
+    mean = x[..., k:n - k].mean(axis=-1)
+    winsorised = np.clip(x, x[..., k:k + 1], x[..., n - k - 1:n - k])
+    se = winsorised.std(axis=-1, ddof=1) / ((1 - 2 * k / n) * np.sqrt(n))
+    return mean, se
+
+
+class TDSReading(NamedTuple):
+    timestamp: float    # Epoch s
+    tds: float          # ppm, filtered
+    lo: float           # ppm, confidence bounds
+    hi: float
+    temperature: float  # °C, compensation
+    voltage: float      # V, burst location
+    samples: int        # Burst size
+
+
+def get_temperature_source(sensor: str = "ds18b20") -> Callable[[], float]:
+    """°C reads for the compensation: "ds18b20" probe, "bmp388" ambient"""
+    if sensor == "ds18b20":
+        return load_driver("rpi_sen-ds18b20.py").read_ds18b20
+    if sensor == "bmp388":
+        bmp388 = load_driver("rpi_sen-bmp388.py").BMP388()
+        return lambda: bmp388.get_data()[0] / 100  # centi-°C
+    raise ValueError(f"Unknown temperature sensor: {sensor}")
+
+
+class TDSPipeline:
+    """
+    Filtered, temperature compensated TDS readings from ADS1115 bursts
+
+    Each reading takes the samples streamed since the previous one, at most
+    `burst`: their trimmed mean or median and standard error are
+    compensated with the latest temperature, converted to ppm, then
+    filtered with a random walk Kalman filter, or an EMA when `alpha` is
+    set. Bounds are the filtered estimate +- TDS_Z sigmas. An innovation
+    over TDS_STEP_SIGMAS resets the filter to the measurement.
+
+    Temperatures are read every `temperature_period` in their own thread,
+    the last valid one is kept.
+
+    Params
+    - stream: ADS1115Stream         = None, own stream: P1, gain 2/3
+    - channel: str                  = "tds"
+    - burst: int                    = TDS_BURST
+    - method: str                   = "trimmed", "median"
+    - alpha: Optional[float]        = None, EMA weight, None: Kalman
+    - q: float                      = TDS_Q, ppm²/s
+    - temperature: Callable         = None, °C reads, None: TDS_DFLT_TEMP
+    - temperature_period: float     = 10.0, seconds
+    - history: int                  = HISTORY, readings kept
+    """
+
+    def __init__(
+        self,
+        stream: Any                 = None,
+        channel: str                = "tds",
+        burst: int                  = TDS_BURST,
+        method: str                 = "trimmed",
+        alpha: Optional[float]      = None,
+        q: float                    = TDS_Q,
+        temperature: Optional[Callable[[], float]] = None,
+        temperature_period: float   = 10.0,
+        history: int                = HISTORY,
+    ) -> None:
+        self._own_stream = stream is None
+        if stream is None:
+            ads = load_driver("rpi-ads1x15.py")
+            stream = ads.ADS1115Stream([ads.Channel(channel, "P1", 2/3)])
+        self.stream     = stream
+        self.channel    = channel
+        self.burst      = burst
+        self.method     = method
+        self.alpha      = alpha
+        self.q          = q
+        self.readings: Deque[TDSReading] = deque(maxlen=history)
+
+        self.temperature        = TDS_DFLT_TEMP
+        self._read_temperature  = temperature
+        self._temperature_period = temperature_period
+
+        # Filter state: estimate, variance
+        self._x: Optional[float] = None
+        self._p         = 0.0
+        self._t_last    = 0.0
+        self._count     = int(stream.counts[stream.index[channel]])
+        self._running   = False
+        self._threads   = []
+
+    def __repr__(self) -> str:
+        f = f"EMA {self.alpha}" if self.alpha else f"Kalman q={self.q}"
+        return f"TDSPipeline[{self.method} x{self.burst}, {f}]"
+
+    @property
+    def latest(self) -> Optional[TDSReading]:
+        return self.readings[-1] if self.readings else None
+
+    def update_temperature(self) -> float:
+        if self._read_temperature is not None:
+            try:
+                t = self._read_temperature()
+                if t is not None and t != SENSOR_ERROR_VALUE:
+                    self.temperature = t
+            except Exception as e:
+                print(f"{self} temperature read failed: {e}")
+        return self.temperature
+
+    def _filter(self, z: float, r: float, dt: float) -> None:
+        '''Update the estimate with measurement `z` of variance `r`'''
+        p = self._p + (0.0 if self.alpha else self.q * dt)
+        if self._x is None or (z - self._x) ** 2 > TDS_STEP_SIGMAS ** 2 \
+                * (p + r):
+            self._x, self._p = z, r  # First reading or step
+        elif self.alpha:
+            self._x += self.alpha * (z - self._x)
+            self._p = (1 - self.alpha) ** 2 * p + self.alpha ** 2 * r
+        else:
+            k = p / (p + r)
+            self._x += k * (z - self._x)
+            self._p = (1 - k) * p
+
+    def read(self) -> Optional[TDSReading]:
+        """Reading from the samples since the previous one, None: too few"""
+        count = int(self.stream.counts[self.stream.index[self.channel]])
+        n = min(count - self._count, self.burst, self.stream.size)
+        self._count = count
+        if n < TDS_MIN_SAMPLES:
+            return None
+        _, volts = self.stream.get(self.channel, n)
+
+        v, v_se = robust_mean(volts, self.method)
+        t = self.temperature
+        tds = float(tds_from_voltage(v, t))
+        # Standard error through the polynomial slope, monotonic
+        slope = float(tds_from_voltage(v + v_se, t)) - tds
+        now = monotonic()
+        self._filter(tds, max(slope ** 2, 1e-12),
+                     now - self._t_last if self._t_last else 0.0)
+        self._t_last = now
+
+        bound = TDS_Z * self._p ** 0.5
+        reading = TDSReading(time(), round(self._x, 2),
+                             round(self._x - bound, 2),
+                             round(self._x + bound, 2),
+                             t, float(v), n)
+        self.readings.append(reading)
+        return reading
+
+    def start(self, period: float = 1.0) -> None:
+        """Read every `period` seconds in the background, into `readings`"""
+        if self._running:
+            return
+        self._running = True
+        if self._own_stream:
+            self.stream.start()
+        self._threads = [
+            threading.Thread(target=self._every, args=(period, self.read),
+                             daemon=True),
+            threading.Thread(target=self._every,
+                             args=(self._temperature_period,
+                                   self.update_temperature),
+                             daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self) -> None:
+        self._running = False
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        if self._own_stream:
+            self.stream.stop()
+
+    def _every(self, period: float, f: Callable[[], object]) -> None:
+        deadline = monotonic()
+        while self._running:
+            f()
+            deadline += period
+            now = monotonic()
+            if now > deadline:
+                deadline += ((now - deadline) // period + 1) * period
+            while self._running and monotonic() < deadline:
+                sleep(max(min(deadline - monotonic(), 0.1), 0.0))
+
+
 if __name__ == "__main__":
-    while True:
-        print(f"TDS: {read_tds_cqr():.2f} ppm")
-        sleep(1)
+    import sys
+
+    if sys.argv[-1] == "pipeline":
+        # python rpi_sen-tds_cqr.py pipeline: ds18b20 compensated readings
+        pipeline = TDSPipeline(temperature=get_temperature_source())
+        print(f"Starting {pipeline}...")
+        pipeline.start(1.0)
+        try:
+            while True:
+                sleep(1)
+                r = pipeline.latest
+                if r:
+                    print(f"TDS: {r.tds:.2f} ppm [{r.lo:.2f}, {r.hi:.2f}], "
+                          f"{r.temperature:.2f}°C, {r.samples} samples")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pipeline.stop()
+    else:
+        while True:
+            print(f"TDS: {read_tds_cqr():.2f} ppm")
+            sleep(1)